@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import numpy as np
@@ -14,7 +15,30 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 from matplotlib.ticker import LinearLocator, FormatStrFormatter
 
-VALID_FIT_TYPES = ['sigmoid', 'linear', 'constant', '3d']
+import importlib.util
+
+# the calibration models are shared with the experiment code; the template
+# is not an installed package, so the module is loaded from its file (this
+# script must stay at calibration/ next to experiment/template/)
+CALIBRATION_MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       '..', 'experiment', 'template',
+                                       'calibration_models.py')
+
+def _load_calibration_models(path):
+    if not os.path.exists(path):
+        raise ImportError('calibration_models.py not found at %s' % path)
+    spec = importlib.util.spec_from_file_location('calibration_models', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules['calibration_models'] = module
+    return module
+
+calibration_models = _load_calibration_models(CALIBRATION_MODELS_PATH)
+MODELS = calibration_models.MODELS
+get_model = calibration_models.get_model
+create_fit = calibration_models.create_fit
+
+VALID_FIT_TYPES = list(MODELS)
 
 data_received = False
 calibration = None
@@ -49,29 +73,18 @@ class EvolverNamespace(BaseNamespace):
             print(calibration_name)
         data_received = True
 
-def sigmoid(x, a, b, c, d):
-    return a + (b - a)/(1 + (10**((c-x)*d)))
-
-def linear(x, a, b):
-    return np.array(x)*a + b
-
-def three_dim(data, c0, c1, c2, c3, c4, c5):
-    x = data[0]
-    y = data[1]
-    return c0 + c1*x + c2*y + c3*x**2 + c4*x*y + c5*y**2
+sigmoid = get_model('sigmoid').function
+linear = get_model('linear').function
+three_dim = get_model('3d').function
 
 def sigmoid_fit(calibration, fit_name, params, graph = True):
-    coefficients = []
-
     # For single param calibrations, just take the first value from the returned dictionary
     calibration_data = list(process_vial_data(calibration, param = params[0]).values())[0]
     medians = calibration_data["medians"]
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
-        paramsig, paramlin = curve_fit(sigmoid, measured_data[i], medians[i], p0 = [62721, 62721, 0, -1], maxfev=1000000000)
-        coefficients.append(np.array(paramsig).tolist())
+    coefficients = get_model('sigmoid').fit(measured_data[:16], medians[:16])
     print(coefficients)
 
     if graph:
@@ -79,17 +92,13 @@ def sigmoid_fit(calibration, fit_name, params, graph = True):
     return create_fit(coefficients, fit_name, "sigmoid", time.time(), params)
 
 def linear_fit(calibration, fit_name, params, graph = True):
-    coefficients = []
-
     # For single param calibrations, just take the first value from the returned dictionary
     calibration_data = list(process_vial_data(calibration, param = params[0]).values())[0]
     medians = calibration_data["medians"]
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
-        paramlin, cov = curve_fit(linear, medians[i], measured_data[i])
-        coefficients.append(paramlin.tolist())
+    coefficients = get_model('linear').fit(medians[:16], measured_data[:16])
 
     print(coefficients)
     if graph:
@@ -100,14 +109,11 @@ def linear_fit(calibration, fit_name, params, graph = True):
 def constant_fit(calibration, fit_name, params):
     calibration_data = list(process_vial_data(calibration, param = params[0]).values())[0]
     measured_data = calibration_data["measured_data"]
-    coefficients = []
-    for i in range(len(measured_data)):
-        coefficients.append(calibration_data['medians'][i][0]/measured_data[i])
+    coefficients = get_model('constant').fit(measured_data, calibration_data['medians'])
     print(coefficients)
     return create_fit(coefficients, fit_name, "constant", time.time(), params)
 
 def three_dimension_fit(calibration, fit_name, params, graph = True):
-    initial_parameters = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
     coefficients = []
     datas = []
     calibration_data = process_vial_data(calibration)
@@ -126,7 +132,7 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
 
         data = [x_data, y_data, z_data]
 
-        fitted_parameters, pcov = scipy.optimize.curve_fit(three_dim, [x_data, y_data], z_data, p0 = initial_parameters)
+        fitted_parameters = get_model('3d').fit_vial([x_data, y_data], z_data)
 
         modelPredictions = three_dim(data, *fitted_parameters)
         absError = modelPredictions - z_data
@@ -224,9 +230,6 @@ def process_vial_data(calibration, param = None):
 
     return calibration_data
 
-def create_fit(coefficients, fit_name, fit_type, time_fit, params):
-    return {"name": fit_name, "coefficients": coefficients, "type": fit_type, "timeFit": time_fit, "active": False, "params": params}
-
 def start_background_loop(loop):
     asyncio.set_event_loop(loop)
     loop.run_forever()
@@ -307,7 +310,7 @@ if __name__ == '__main__':
         elif fit_type == "linear":
             fit = linear_fit(calibration, fit_name, params, graph = not no_graph)
         elif fit_type == "constant":
-            fit = constant_fit(calibration, fit_name, params, graph = not no_graph)
+            fit = constant_fit(calibration, fit_name, params)
         elif fit_type == "3d":
             fit = three_dimension_fit(calibration, fit_name, params, graph = not no_graph)
 
@@ -0,0 +1,196 @@
+"""
+Archive of the full broadcast payloads (config, every channel, pump state)
+for debugging and replay.
+
+Broadcasts are JSON lines, appended first to <name>.open.jsonl. Every
+`chunk_size` broadcasts the open file is compressed (zstd if the zstandard
+package is installed, gzip otherwise) and appended as an independent frame
+to <name>.archive, and one line is added to <name>.index:
+
+    t0,t1,offset,length,count,codec
+
+so a reader can seek straight to the chunks covering a time range and only
+ever holds one decompressed chunk in memory.
+"""
+import os
+import sys
+import gzip
+import json
+import logging
+import threading
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('eVOLVER')
+
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'gzip'
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def _compress(raw, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+def _decompress(blob, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is needed to read zstd chunks')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return gzip.decompress(blob)
+
+def _record_time(line):
+    return json.loads(line)['time']
+
+class BroadcastArchive:
+
+    def __init__(self, path, chunk_size=500, codec=DEFAULT_CODEC):
+        """
+        Args:
+            path (str): Archive path without extension, e.g. <EXP_DIR>/broadcasts.
+            chunk_size (int): Broadcasts per compressed chunk.
+            codec (str): 'zstd' or 'gzip'.
+        """
+        if codec == 'zstd' and zstandard is None:
+            logger.warning('zstandard not installed, compressing broadcasts '
+                           'with gzip')
+            codec = 'gzip'
+        self.path = path
+        self.open_path = path + '.open.jsonl'
+        self.archive_path = path + '.archive'
+        self.index_path = path + '.index'
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending = None
+
+    def append(self, elapsed_time, data, received=None):
+        """
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            data (dict): The broadcast as received from eVOLVER.
+            received (float): Unix time the broadcast arrived.
+        """
+        line = json.dumps({'time': elapsed_time, 'received': received,
+                           'data': data}, default=_json_default) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.open_path, 'a+')
+                self._file.seek(0)
+                # broadcasts left in the open file by the last run
+                self._pending = sum(1 for _ in self._file)
+            self._file.write(line)
+            self._file.flush()
+            self._pending += 1
+            if self._pending >= self.chunk_size:
+                self._compress_chunk()
+
+    def _compress_chunk(self):
+        self._file.seek(0)
+        lines = self._file.readlines()
+        if not lines:
+            return
+        blob = _compress(''.join(lines).encode('utf-8'), self.codec)
+        with open(self.archive_path, 'ab') as f:
+            offset = f.tell()
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, 'a') as f:
+            f.write('{0},{1},{2},{3},{4},{5}\n'.format(
+                _record_time(lines[0]), _record_time(lines[-1]), offset,
+                len(blob), len(lines), self.codec))
+        # a crash before this truncate leaves the chunk in both files;
+        # readers skip open rows that are not newer than the last chunk
+        self._file.seek(0)
+        self._file.truncate()
+        self._pending = 0
+        logger.debug('archived %d broadcasts (%d bytes)' % (len(lines), len(blob)))
+
+    def close(self, compress=False):
+        """Closes the open file, compressing it into a last chunk if asked."""
+        with self._lock:
+            if self._file is None:
+                return
+            if compress:
+                self._compress_chunk()
+            self._file.close()
+            self._file = None
+
+def load_index(path):
+    """Returns the chunk entries of an archive as dicts, oldest first."""
+    entries = []
+    try:
+        with open(path + '.index') as f:
+            for line in f:
+                try:
+                    t0, t1, offset, length, count, codec = line.rstrip('\n').split(',')
+                    entries.append({'t0': float(t0), 't1': float(t1),
+                                    'offset': int(offset), 'length': int(length),
+                                    'count': int(count), 'codec': codec})
+                except ValueError:
+                    # torn last line
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+def iter_broadcasts(path, t0=None, t1=None):
+    """
+    Yields the archived broadcasts ({'time', 'received', 'data'}) with
+    t0 <= time <= t1 in order, one chunk in memory at a time.
+
+    Args:
+        path (str): Archive path without extension.
+        t0 (float): Start time in hours, None for the beginning.
+        t1 (float): End time in hours, None for the end.
+    """
+    entries = load_index(path)
+    if entries:
+        with open(path + '.archive', 'rb') as f:
+            for entry in entries:
+                if (t0 is not None and entry['t1'] < t0) or \
+                        (t1 is not None and entry['t0'] > t1):
+                    continue
+                f.seek(entry['offset'])
+                chunk = _decompress(f.read(entry['length']), entry['codec'])
+                for line in chunk.decode('utf-8').splitlines():
+                    record = json.loads(line)
+                    if (t0 is None or record['time'] >= t0) and \
+                            (t1 is None or record['time'] <= t1):
+                        yield record
+    last_time = entries[-1]['t1'] if entries else None
+    try:
+        with open(path + '.open.jsonl') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line
+                    continue
+                if last_time is not None and record['time'] <= last_time:
+                    continue
+                if (t0 is None or record['time'] >= t0) and \
+                        (t1 is None or record['time'] <= t1):
+                    yield record
+    except FileNotFoundError:
+        pass
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python3 broadcast_archive.py <experiment_dir> [t0] [t1]')
+        sys.exit(2)
+    t0 = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    t1 = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    for record in iter_broadcasts(os.path.join(sys.argv[1], 'broadcasts'), t0, t1):
+        print(json.dumps(record))
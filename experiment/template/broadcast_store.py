@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+# Raw readings are 16-bit ADC values, the top value being a saturated
+# reading. Missing/invalid readings are flagged in a <param>_missing bitmap
+# (one bit per vial); stores written before it use the top value instead.
+RAW_MAX = np.iinfo(np.uint16).max
+RAW_MISSING = RAW_MAX
+
+def _dtype_from_descr(descr):
+    fields = []
+    for field in descr:
+        if len(field) > 2:
+            fields.append((field[0], field[1], tuple(field[2])))
+        else:
+            fields.append((field[0], field[1]))
+    return np.dtype(fields)
+
+def stored_dtype(path):
+    """Returns the record layout stored next to a record file, or None."""
+    schema_path = path + '.json'
+    if not os.path.exists(schema_path):
+        return None
+    with open(schema_path) as f:
+        return _dtype_from_descr(json.load(f)['descr'])
+
+class RecordFile:
+    """
+    Append-only file of fixed-width numpy records. The record layout is stored
+    in a JSON sidecar (<path>.json) so the file can be memory-mapped by any
+    reader. Row i lives at byte i * itemsize, so row, tail and time-range
+    lookups are slices of a numpy.memmap instead of text parsing.
+    """
+
+    def __init__(self, path, dtype=None):
+        """
+        Args:
+            path (str): The record file path.
+            dtype (numpy.dtype): Record layout, required when creating a new
+                file. Must match the stored layout when opening an existing one.
+        """
+        self.path = path
+        self.schema_path = path + '.json'
+        stored = stored_dtype(path)
+        if stored is not None:
+            if dtype is not None and np.dtype(dtype) != stored:
+                raise ValueError('record layout of %s does not match the stored '
+                                 'layout' % path)
+            self.dtype = stored
+        elif dtype is None:
+            raise ValueError('no record layout found for %s' % path)
+        else:
+            self.dtype = np.dtype(dtype)
+            with open(self.schema_path, 'w') as f:
+                json.dump({'descr': self.dtype.descr}, f)
+        self._file = None
+        self._map = None
+        self._map_len = 0
+
+    def _open_for_append(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+            # drop a partial record left by an interrupted write
+            size = self._file.tell()
+            if size % self.dtype.itemsize:
+                self._file.truncate(size - size % self.dtype.itemsize)
+                self._file.seek(0, os.SEEK_END)
+        return self._file
+
+    def append(self, records):
+        """Appends one record or an array of records and flushes them."""
+        records = np.asarray(records, dtype=self.dtype)
+        f = self._open_for_append()
+        f.write(records.tobytes())
+        f.flush()
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.path) // self.dtype.itemsize
+        except OSError:
+            return 0
+
+    def records(self):
+        """Returns a read-only memmap over every complete record."""
+        n = len(self)
+        if n == 0:
+            return np.zeros(0, dtype=self.dtype)
+        if self._map is None or self._map_len != n:
+            self._map = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(n,))
+            self._map_len = n
+        return self._map
+
+    def row(self, i):
+        return self.records()[i]
+
+    def tail(self, n):
+        if n <= 0:
+            return np.zeros(0, dtype=self.dtype)
+        return self.records()[-n:]
+
+    def time_range(self, t0=None, t1=None, time_field='time'):
+        """
+        Returns records with t0 <= time <= t1 using binary search on the time
+        column (records are appended in time order).
+        """
+        records = self.records()
+        times = records[time_field]
+        start = 0 if t0 is None else np.searchsorted(times, t0, side='left')
+        stop = len(records) if t1 is None else np.searchsorted(times, t1, side='right')
+        return records[start:stop]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._map = None
+
+class VialRecordFile(RecordFile):
+    """
+    A RecordFile whose fields (other than time) hold one value per vial,
+    read back per vial in the legacy [time, value] layout.
+    """
+
+    def __init__(self, path, dtype=None):
+        super().__init__(path, dtype)
+        self.raw_params = [name[:-len('_raw')] for name in self.dtype.names
+                           if name.endswith('_raw')]
+        self.n_vials = self.dtype[self.dtype.names[1]].shape[0]
+
+    def field_for(self, param):
+        """Maps a legacy directory name (OD, temp, od_135_raw) to a field."""
+        if param == 'OD':
+            return 'od'
+        return param
+
+    def series(self, param, vial, t0=None, t1=None):
+        """Returns an (n, 2) array of [time, value] like the legacy text files."""
+        records = self.time_range(t0, t1)
+        values = records[self.field_for(param)][:, vial].astype(np.float64)
+        if param.endswith('_raw'):
+            values[self.missing(records, param[:-len('_raw')])[:, vial]] = np.nan
+        return np.column_stack((records['time'], values))
+
+    def missing(self, records, param):
+        """(n, n_vials) bool array of the raw readings of param that are missing."""
+        field = param + '_missing'
+        if field not in self.dtype.names:
+            return records[param + '_raw'] == RAW_MISSING
+        return np.unpackbits(records[field], axis=-1, count=self.n_vials,
+                             bitorder='little').astype(bool)
+
+    def _set_raw(self, record, raw):
+        for param in self.raw_params:
+            values, missing = raw_to_uint16(raw.get(param, []), self.n_vials)
+            if param + '_missing' in self.dtype.names:
+                record[param + '_missing'] = np.packbits(missing, bitorder='little')
+            else:
+                values[missing] = RAW_MISSING
+            record[param + '_raw'] = values
+
+    def export_text(self, param, out_dir, vials=None, header=None):
+        """
+        Regenerates the legacy vial{x}_{param}.txt files in out_dir. Existing
+        files are never overwritten (FileExistsError), so this cannot clobber
+        the text logs of a running experiment.
+
+        Args:
+            header (callable): header(vial) returns the first line of a
+                vial's file, or None for no header line.
+        """
+        if vials is None:
+            vials = range(self.n_vials)
+        os.makedirs(out_dir, exist_ok=True)
+        for x in vials:
+            file_path = os.path.join(out_dir, "vial{0}_{1}.txt".format(x, param))
+            with open(file_path, 'x') as f:
+                line = header(x) if header is not None else None
+                if line is not None:
+                    f.write(line + '\n')
+                np.savetxt(f, self.series(param, x), fmt=['%.4f', '%.6g'],
+                           delimiter=',')
+
+class BroadcastStore(VialRecordFile):
+    """
+    One fixed-width row per broadcast: elapsed time (hours, float64), OD and
+    temperature (float32 per vial) and every raw channel (uint16 per vial).
+    """
+
+    def __init__(self, path, raw_params=None, n_vials=16):
+        dtype = None
+        if raw_params is not None:
+            dtype = broadcast_dtype(raw_params, n_vials)
+            # a store from before the missing bitmaps is kept as it is
+            if stored_dtype(path) == broadcast_dtype(raw_params, n_vials,
+                                                     missing_bitmap=False):
+                dtype = None
+        super().__init__(path, dtype)
+
+    def append_broadcast(self, elapsed_time, od, temp, raw):
+        """
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            od (array-like): Transformed OD per vial.
+            temp (array-like): Transformed temperature per vial.
+            raw (dict): Raw readings per raw param, as received from eVOLVER.
+        """
+        record = np.zeros(1, dtype=self.dtype)
+        record['time'] = elapsed_time
+        record['od'] = np.asarray(od, dtype=np.float32)[:self.n_vials]
+        record['temp'] = np.asarray(temp, dtype=np.float32)[:self.n_vials]
+        self._set_raw(record, raw)
+        self.append(record)
+
+class RawArchive(VialRecordFile):
+    """
+    Raw photodiode/thermistor channels only: one row per broadcast with the
+    elapsed time, a packed uint16 array per raw param (2 bytes per vial
+    instead of a text line) and its missing bitmap. Replaces the <param>_raw text files when
+    RAW_ARCHIVE is on in custom_script.py.
+    """
+
+    def __init__(self, path, raw_params=None, n_vials=16):
+        dtype = None
+        # an existing archive keeps its layout, raw params added later are
+        # not archived
+        if raw_params is not None and not os.path.exists(path + '.json'):
+            dtype = raw_dtype(raw_params, n_vials)
+        super().__init__(path, dtype)
+
+    def append_raw(self, elapsed_time, raw):
+        """
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            raw (dict): Raw readings per raw param, as received from eVOLVER.
+        """
+        record = np.zeros(1, dtype=self.dtype)
+        record['time'] = elapsed_time
+        self._set_raw(record, raw)
+        self.append(record)
+
+    def load(self, param, t0=None, t1=None):
+        """
+        Returns every vial of a raw param in one read.
+
+        Args:
+            param (str): The raw param, e.g. 'od_135' or 'od_135_raw'.
+            t0 (float): Start time in hours, None for the beginning.
+            t1 (float): End time in hours, None for the end.
+        Returns:
+            tuple: (times, values) with values an (n, n_vials) uint16
+                masked array, missing readings masked.
+        """
+        if param.endswith('_raw'):
+            param = param[:-len('_raw')]
+        records = self.time_range(t0, t1)
+        values = np.ma.MaskedArray(np.array(records[param + '_raw']),
+                                   mask=self.missing(records, param))
+        return np.array(records['time']), values
+
+def _raw_fields(raw_params, n_vials, missing_bitmap):
+    fields = []
+    for param in raw_params:
+        fields.append((param + '_raw', '<u2', (n_vials,)))
+        if missing_bitmap:
+            fields.append((param + '_missing', 'u1', ((n_vials + 7) // 8,)))
+    return fields
+
+def broadcast_dtype(raw_params, n_vials=16, missing_bitmap=True):
+    fields = [('time', '<f8'), ('od', '<f4', (n_vials,)),
+              ('temp', '<f4', (n_vials,))]
+    return np.dtype(fields + _raw_fields(raw_params, n_vials, missing_bitmap))
+
+def raw_dtype(raw_params, n_vials=16, missing_bitmap=True):
+    fields = [('time', '<f8')]
+    return np.dtype(fields + _raw_fields(raw_params, n_vials, missing_bitmap))
+
+def raw_to_uint16(values, n_vials):
+    """
+    Returns:
+        tuple: (values, missing), the readings as uint16 (0 where missing)
+            and a bool array of the vials without a valid reading.
+    """
+    out = np.zeros(n_vials, dtype=np.uint16)
+    missing = np.ones(n_vials, dtype=bool)
+    for x, value in enumerate(values[:n_vials]):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if np.isfinite(value) and 0 <= value <= RAW_MAX:
+            out[x] = int(value)
+            missing[x] = False
+    return out, missing
+
+def legacy_header(exp_dir, param):
+    """
+    Returns header(vial) for export_text: the 'Experiment: ...' line (with
+    its start timestamp) of the experiment's own text file, if it has one.
+    """
+    def header(vial):
+        file_path = os.path.join(exp_dir, param,
+                                 "vial{0}_{1}.txt".format(vial, param))
+        try:
+            with open(file_path) as f:
+                line = f.readline().rstrip('\n')
+        except OSError:
+            return None
+        return line if line.startswith('Experiment:') else None
+    return header
+
+def export_legacy(store_path, out_dir):
+    """
+    Writes the legacy per-vial text layout (OD/, temp/, <param>_raw/) for the
+    GUI from a broadcast store into out_dir, which must not hold those files
+    already.
+    """
+    exp_dir = os.path.dirname(os.path.abspath(store_path))
+    store = BroadcastStore(store_path)
+    for param in ['OD', 'temp'] + [p + '_raw' for p in store.raw_params]:
+        store.export_text(param, os.path.join(out_dir, param),
+                          header=legacy_header(exp_dir, param))
+        logger.info('exported %s from %s' % (param, store_path))
+    store.close()
+
+def export_raw_legacy(archive_path, out_dir):
+    """
+    Writes the legacy <param>_raw/vial{x}_<param>_raw.txt files from a raw
+    archive into out_dir, which must not hold those files already.
+    """
+    exp_dir = os.path.dirname(os.path.abspath(archive_path))
+    archive = RawArchive(archive_path)
+    for param in archive.raw_params:
+        archive.export_text(param + '_raw', os.path.join(out_dir, param + '_raw'),
+                            header=legacy_header(exp_dir, param + '_raw'))
+        logger.info('exported %s_raw from %s' % (param, archive_path))
+    archive.close()
+
+def load_raw(exp_dir, param, t0=None, t1=None):
+    """
+    Loads a raw param of an experiment as (times, values), see RawArchive.load.
+    Meant for refitting calibrations against long runs.
+    """
+    archive = RawArchive(os.path.join(exp_dir, 'raw.bin'))
+    try:
+        return archive.load(param, t0, t1)
+    finally:
+        archive.close()
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--raw']
+    if len(args) != 2:
+        print('Usage: python3 broadcast_store.py [--raw] <experiment_dir> <output_dir>')
+        sys.exit(2)
+    exp_dir, out_dir = args
+    if os.path.realpath(out_dir) == os.path.realpath(exp_dir):
+        print('output_dir must not be the experiment directory, its text '
+              'files would be overwritten')
+        sys.exit(2)
+    if '--raw' in sys.argv:
+        export_raw_legacy(os.path.join(exp_dir, 'raw.bin'), out_dir)
+    else:
+        export_legacy(os.path.join(exp_dir, 'broadcasts.bin'), out_dir)
@@ -0,0 +1,81 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+
+from transform import SigmoidTable
+from calibration_models import coefficient_matrix
+
+logger = logging.getLogger('eVOLVER')
+
+def load_json_calibration(path):
+    """Loads a calibration fit and precomputes its (vials x k) coefficient matrix."""
+    with open(path) as f:
+        cal = json.load(f)
+    try:
+        cal['matrix'] = coefficient_matrix(cal['coefficients'])
+    except (KeyError, TypeError, ValueError):
+        # ragged coefficients (e.g. pump calibrations with missing pumps)
+        cal['matrix'] = None
+    return cal
+
+def load_od_calibration(path):
+    """load_json_calibration, plus the lookup table of sigmoid fits."""
+    cal = load_json_calibration(path)
+    if cal.get('type') == 'sigmoid' and cal['matrix'] is not None:
+        cal['table'] = SigmoidTable(cal['matrix'])
+        logger.info('built OD lookup table, max error %.2g OD' %
+                    cal['table'].max_error)
+    return cal
+
+def load_light_calibration(path):
+    light_calibration = np.loadtxt(path, delimiter="\t")
+    if len(light_calibration) == 16:
+        return light_calibration
+    return light_calibration[0,:]
+
+class CalibrationCache:
+    """
+    Keeps parsed calibration files in memory and only reloads one when its
+    modification time or size changes, so broadcasts do not re-read and
+    re-parse every calibration file.
+
+    Values handed out are shared between callers and must not be modified.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+
+    def get(self, path, loader):
+        """
+        Args:
+            path (str): The calibration file.
+            loader (callable): Parses the file, called with the path.
+        Returns:
+            The parsed calibration.
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+        value = loader(path)
+        with self._lock:
+            self._entries[path] = (key, value)
+            self.loads += 1
+        logger.debug('loaded calibration %s' % path)
+        return value
+
+    def invalidate(self, path=None):
+        """Drops one cached file, or all of them."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
@@ -0,0 +1,154 @@
+"""
+Calibration models shared by calibration/calibrate.py (fitting) and
+eVOLVER.py (converting every broadcast).
+
+Each model is fitted in the direction calibrate.py has always used:
+`evaluate(x, c)` is the fitted function and `invert(y, c)` its inverse.
+Sigmoid and constant fits map the measured value (OD, flow) to the raw
+reading, linear and 3D fits map raw readings to the measured value;
+`to_value` and `to_raw` hide that difference from the live loop.
+
+Coefficients are vectorized over vials: `c` is either one vial's
+coefficients (k,) or a (vials x k) matrix, with the last axis of `x`
+being the vials. Fits are stored as the dict made by `create_fit`.
+
+New models subclass CalibrationModel and are added with `register`.
+"""
+import numpy as np
+from scipy.optimize import curve_fit
+
+MODELS = {}
+
+def register(model):
+    MODELS[model.name] = model
+    return model
+
+def get_model(fit_type):
+    """Returns the model of a fit type, or None if it is not supported."""
+    return MODELS.get(fit_type)
+
+def coefficient_matrix(coefficients):
+    """Coefficients of every vial as a (vials x k) float array."""
+    return np.asarray(coefficients, dtype=np.float64).reshape(len(coefficients), -1)
+
+def create_fit(coefficients, fit_name, fit_type, time_fit, params):
+    return {"name": fit_name, "coefficients": coefficients, "type": fit_type, "timeFit": time_fit, "active": False, "params": params}
+
+class CalibrationModel:
+    name = None
+    # number of raw params the model takes (the 3D fit uses two photodiodes)
+    n_inputs = 1
+    # True if evaluate() takes the raw reading, False if it returns it
+    raw_input = True
+    # False if invert() is not defined (the 3D fit)
+    invertible = True
+    # number of coefficients per vial; curve_fit cannot tell it from the
+    # variadic function()
+    n_coefficients = None
+
+    def evaluate(self, x, c):
+        raise NotImplementedError
+
+    def invert(self, y, c):
+        raise NotImplementedError
+
+    def function(self, x, *coefficients):
+        """evaluate() with the coefficients as arguments, for curve_fit and plots."""
+        return self.evaluate(x, np.asarray(coefficients, dtype=np.float64))
+
+    def fit(self, xs, ys):
+        """
+        Fits every vial.
+
+        Args:
+            xs (list): Per vial inputs of evaluate().
+            ys (list): Per vial outputs of evaluate().
+        Returns:
+            list: Per vial coefficient lists.
+        """
+        return [np.asarray(self.fit_vial(x, y)).tolist() for x, y in zip(xs, ys)]
+
+    def fit_vial(self, x, y):
+        # curve_fit's own default start, all ones
+        coefficients, covariance = curve_fit(self.function, x, y,
+                                             p0 = [1.0] * self.n_coefficients)
+        return coefficients
+
+    def to_value(self, raw, c):
+        """Converts raw readings to the measured value (OD, degrees C...)."""
+        return self.evaluate(raw, c) if self.raw_input else self.invert(raw, c)
+
+    def can_convert_to_raw(self):
+        """True if to_raw works for this model, check before calling it."""
+        return self.invertible or not self.raw_input
+
+    def to_raw(self, value, c):
+        """Converts measured values back to raw readings (e.g. setpoints)."""
+        return self.invert(value, c) if self.raw_input else self.evaluate(value, c)
+
+class Sigmoid(CalibrationModel):
+    """raw = a + (b - a) / (1 + 10^((c - OD) * d))"""
+    name = 'sigmoid'
+    raw_input = False
+    n_coefficients = 4
+
+    def evaluate(self, x, c):
+        x = np.asarray(x, dtype=np.float64)
+        return c[..., 0] + (c[..., 1] - c[..., 0]) / (1 + (10 ** ((c[..., 2] - x) * c[..., 3])))
+
+    def invert(self, y, c):
+        y = np.asarray(y, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return c[..., 2] - np.log10((c[..., 1] - c[..., 0]) / (y - c[..., 0]) - 1) / c[..., 3]
+
+    def fit_vial(self, x, y):
+        coefficients, covariance = curve_fit(self.function, x, y, p0 = [62721, 62721, 0, -1], maxfev=1000000000)
+        return coefficients
+
+class Linear(CalibrationModel):
+    """value = a * raw + b"""
+    name = 'linear'
+    n_coefficients = 2
+
+    def evaluate(self, x, c):
+        return np.asarray(x, dtype=np.float64) * c[..., 0] + c[..., 1]
+
+    def invert(self, y, c):
+        return (np.asarray(y, dtype=np.float64) - c[..., 1]) / c[..., 0]
+
+class Constant(CalibrationModel):
+    """raw = c * value, fitted from a single point per vial"""
+    name = 'constant'
+    raw_input = False
+    n_coefficients = 1
+
+    def evaluate(self, x, c):
+        return np.asarray(x, dtype=np.float64) * c[..., 0]
+
+    def invert(self, y, c):
+        return np.asarray(y, dtype=np.float64) / c[..., 0]
+
+    def fit(self, xs, ys):
+        # one coefficient per vial, stored as a bare number
+        return [y[0] / x for x, y in zip(xs, ys)]
+
+class ThreeDimension(CalibrationModel):
+    """value = c0 + c1*x + c2*y + c3*x^2 + c4*x*y + c5*y^2 for two raw params x, y"""
+    name = '3d'
+    n_inputs = 2
+    invertible = False
+    n_coefficients = 6
+
+    def evaluate(self, data, c):
+        x = np.asarray(data[0], dtype=np.float64)
+        y = np.asarray(data[1], dtype=np.float64)
+        return (c[..., 0] + c[..., 1] * x + c[..., 2] * y + c[..., 3] * x ** 2 +
+                c[..., 4] * x * y + c[..., 5] * y ** 2)
+
+    def invert(self, y, c):
+        raise ValueError('a 3D fit has no unique inverse, see can_convert_to_raw')
+
+register(Sigmoid())
+register(Linear())
+register(Constant())
+register(ThreeDimension())
@@ -0,0 +1,110 @@
+import copy
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+# field value that leaves a field of the server config unchanged
+NO_CHANGE = '--'
+
+def _fields(values):
+    return [str(value) for value in values]
+
+class CommandManager:
+    """
+    Sits between EvolverNamespace and its 'command' emits.
+
+    The server reports its current config (stir, temp, light, pump...) in
+    every broadcast; that is taken as the last acknowledged state of each
+    parameter. Recurring commands that would not change it are suppressed.
+    While a broadcast is being handled (`begin` ... `flush`), commands are
+    held and merged per parameter, later fields overriding earlier ones, so
+    each parameter is sent at most once per broadcast. Outside of that,
+    commands are sent right away.
+
+    One-shot commands (pump boluses) are only suppressed when every field
+    is '--'; they are never compared with the config.
+    """
+
+    def __init__(self, send):
+        """
+        Args:
+            send (callable): send(command) emits a command dict.
+        """
+        self.send = send
+        self.acked = {}
+        self.batching = False
+        self._pending = {}
+        self.sent = {}
+        self.suppressed = {}
+
+    def observe(self, config):
+        """Records the server config of a broadcast, {param: {'value': [...]}}."""
+        for param, entry in config.items():
+            if isinstance(entry, dict) and 'value' in entry:
+                self.acked[param] = _fields(entry['value'])
+
+    def is_noop(self, command):
+        value = command.get('value')
+        if not isinstance(value, list):
+            return False
+        fields = _fields(value)
+        if all(field == NO_CHANGE for field in fields):
+            return True
+        if not command.get('recurring', False):
+            return False
+        acked = self.acked.get(command['param'])
+        if acked is None or len(acked) != len(fields):
+            return False
+        return all(field == NO_CHANGE or field == current
+                   for field, current in zip(fields, acked))
+
+    def submit(self, command):
+        """Sends a command now, or holds it until flush while batching."""
+        if not self.batching:
+            self._send(command)
+            return
+        key = (command['param'], bool(command.get('recurring', False)))
+        pending = self._pending.get(key)
+        if pending is None or not isinstance(command.get('value'), list) or \
+                len(pending['value']) != len(command['value']):
+            self._pending[key] = copy.deepcopy(command)
+            return
+        # merge into the held command, later fields win
+        merged = pending['value']
+        for i, field in enumerate(command['value']):
+            if str(field) != NO_CHANGE:
+                merged[i] = field
+        pending['immediate'] = pending.get('immediate', False) or \
+            command.get('immediate', False)
+
+    def begin(self):
+        self.batching = True
+
+    def flush(self):
+        """Sends the commands held since begin."""
+        self.batching = False
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for command in pending:
+            self._send(command)
+
+    def discard(self, param):
+        """Drops held commands of a parameter (e.g. pumps after a stop)."""
+        for key in [key for key in self._pending if key[0] == param]:
+            del self._pending[key]
+
+    def _send(self, command):
+        param = command['param']
+        if self.is_noop(command):
+            self.suppressed[param] = self.suppressed.get(param, 0) + 1
+            logger.debug('%s command suppressed, no change' % param)
+            return
+        self.sent[param] = self.sent.get(param, 0) + 1
+        self.send(command)
+
+    def summary(self):
+        params = sorted(set(self.sent) | set(self.suppressed))
+        return 'commands: ' + ', '.join(
+            '%s sent=%d suppressed=%d' % (param, self.sent.get(param, 0),
+                                          self.suppressed.get(param, 0))
+            for param in params)
@@ -0,0 +1,187 @@
+import os
+import logging
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+# growth rates kept per vial, enough for any median/count the selection
+# logic takes over recent curves
+RECENT_GROWTH_RATES = 100
+# pump events kept per vial, for aligning dilutions with the OD window
+RECENT_PUMPS = 20
+
+def _read_rows(path):
+    """Non-empty lines of a log file split on commas, [] if it is missing."""
+    try:
+        with open(path) as f:
+            return [line.strip().split(',') for line in f if line.strip()]
+    except OSError as e:
+        logger.warning('could not read %s: %s' % (path, e))
+        return []
+
+def _floats(row, n):
+    """The first n fields of a row as floats, NaN for header lines."""
+    try:
+        return [float(value) for value in row[:n]]
+    except (TypeError, ValueError):
+        return [np.nan] * n
+
+class VialState:
+    """
+    What the turbidostat needs to know about one vial between broadcasts.
+
+    Attributes:
+        ODset (float): The current OD setpoint.
+        ODset_time (float): When the setpoint was last changed.
+        ODset_rows (int): Lines of the ODset file, header included, as
+            counted by the np.genfromtxt read it replaces; half of it is
+            the number of growth curves.
+        last_pump (float): Time of the last pump_log event.
+        pump_times (deque): Times of the recent pump_log events.
+        step_log (list): The last step_log line, [elapsed_time,
+            step_change_time, current_step, current_conc].
+        growth_count (int): Growth rates measured so far.
+        growth_times (deque): Times of the recent growth rates.
+        growth_rates (deque): The recent growth rates.
+    """
+    __slots__ = ('vial', 'ODset', 'ODset_time', 'ODset_rows', 'last_pump',
+                 'pump_times', 'step_log', 'growth_count', 'growth_times',
+                 'growth_rates')
+
+    def __init__(self, vial):
+        self.vial = vial
+        self.ODset = np.nan
+        self.ODset_time = np.nan
+        self.ODset_rows = 0
+        self.last_pump = np.nan
+        self.pump_times = deque(maxlen=RECENT_PUMPS)
+        self.step_log = [np.nan] * 4
+        self.growth_count = 0
+        self.growth_times = deque(maxlen=RECENT_GROWTH_RATES)
+        self.growth_rates = deque(maxlen=RECENT_GROWTH_RATES)
+
+    @property
+    def num_curves(self):
+        return self.ODset_rows / 2
+
+    def curves_since(self, t):
+        """Growth rates measured after t (at most RECENT_GROWTH_RATES)."""
+        return sum(1 for gr_time in self.growth_times if gr_time > t)
+
+    def recent_growth_rates(self, n):
+        return list(self.growth_rates)[-n:]
+
+    def record(self, param, elapsed_time, values):
+        """Updates the state from an event appended to the vial's logs."""
+        if param == 'ODset':
+            self.ODset = float(values[0])
+            self.ODset_time = elapsed_time
+            self.ODset_rows += 1
+        elif param == 'pump_log':
+            self.last_pump = elapsed_time
+            self.pump_times.append(elapsed_time)
+        elif param == 'step_log':
+            self.step_log = [elapsed_time] + _floats(values, 3)
+        elif param == 'gr':
+            self.growth_count += 1
+            self.growth_times.append(elapsed_time)
+            self.growth_rates.append(float(values[0]))
+
+class ControllerState:
+    """
+    In-memory controller state of every vial, restored once when the
+    experiment starts or resumes and then kept up to date by
+    eVOLVER.append_log, so the turbidostat does not parse the ODset,
+    pump_log, step_log and growthrate files on every broadcast.
+
+    The state is restored from the recovered state journal when it holds
+    every event of the experiment (state_journal.complete); the files are
+    only read for experiments started before the journal existed.
+    """
+
+    def __init__(self, exp_dir, vials, journal_state=None):
+        """
+        Args:
+            exp_dir (str): The experiment data directory (EXP_DIR).
+            vials (list): The vials to keep state for.
+            journal_state (dict): StateJournal.state, after recover().
+        """
+        self.exp_dir = exp_dir
+        if journal_state is not None and journal_state.get('complete', False):
+            records = journal_state['vials']
+            self.vials = {x: self._from_journal(x, records.get(str(x), {}))
+                          for x in vials}
+        else:
+            logger.info('no complete state journal, reading the controller '
+                        'state from the log files')
+            self.vials = {x: self._load(x) for x in vials}
+
+    def __getitem__(self, vial):
+        return self.vials[vial]
+
+    def __contains__(self, vial):
+        return vial in self.vials
+
+    def _path(self, directory, vial, param):
+        return os.path.join(self.exp_dir, directory,
+                            'vial{0}_{1}.txt'.format(vial, param))
+
+    def _load(self, vial):
+        state = VialState(vial)
+        rows = _read_rows(self._path('ODset', vial, 'ODset'))
+        state.ODset_rows = len(rows)
+        if rows:
+            state.ODset_time, state.ODset = _floats(rows[-1], 2)
+        rows = _read_rows(self._path('pump_log', vial, 'pump_log'))
+        if rows:
+            state.last_pump = _floats(rows[-1], 1)[0]
+        pump_times = [_floats(row, 1)[0] for row in rows[-RECENT_PUMPS:]]
+        state.pump_times.extend(t for t in pump_times if np.isfinite(t))
+        rows = _read_rows(self._path('step_log', vial, 'step_log'))
+        if rows:
+            state.step_log = _floats(rows[-1], 4)
+        # the first two lines of a growthrate file are the header and the
+        # 0,0 placeholder
+        rows = _read_rows(self._path('growthrate', vial, 'gr'))[2:]
+        state.growth_count = len(rows)
+        for row in rows[-RECENT_GROWTH_RATES:]:
+            gr_time, gr = _floats(row, 2)
+            state.growth_times.append(gr_time)
+            state.growth_rates.append(gr)
+        return state
+
+    def _from_journal(self, vial, records):
+        """Same state as _load gives, from a vial's journal records."""
+        state = VialState(vial)
+        # the files start with a header and a 0,0 (0,0,0,0,0) line
+        state.ODset_rows = 2
+        state.ODset_time, state.ODset = 0., 0.
+        state.last_pump = 0.
+        state.pump_times.append(0.)
+        state.step_log = [0.] * 4
+        record = records.get('ODset')
+        if record:
+            state.ODset_rows += record['count']
+            state.ODset_time = record['time']
+            state.ODset = _floats(record['values'], 1)[0]
+        record = records.get('pump_log')
+        if record:
+            state.last_pump = record['time']
+            state.pump_times.extend(row[0] for row in record['recent'])
+        record = records.get('step_log')
+        if record:
+            state.step_log = [record['time']] + _floats(record['values'], 3)
+        record = records.get('gr')
+        if record:
+            state.growth_count = record['count']
+            for row in record['recent']:
+                gr_time, gr = _floats(row, 2)
+                state.growth_times.append(gr_time)
+                state.growth_rates.append(gr)
+        return state
+
+    def record(self, vial, param, elapsed_time, values):
+        if vial in self.vials:
+            self.vials[vial].record(param, elapsed_time, values)
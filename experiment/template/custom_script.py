@@ -6,6 +6,9 @@ import os.path
 import time
 import step_utils as su
 import light_control
+from turbidostat_kernel import turbidostat_step
+from turbidostat_kernel import ODSET_LOWER, GROWTH_CURVE, ODSET_UPPER, DILUTION, NAN_DILUTION
+from dilution_alignment import pending_dilutions
 import pandas as pd
 import traceback
 
@@ -32,6 +35,9 @@ STIR_INITIAL = [10] * 16 #try 8,10,12 etc; makes 16-value list
 #Alternatively enter 16-value list to set different values
 #STIR_INITIAL = [7,7,7,7,8,8,8,8,9,9,9,9,10,10,10,10]
 
+ACTIVE_VIALS = None # vials in use, e.g. [0,1,2,3]; None for all 16 (or see ACTIVE_VIALS_FROM_GUI). Other vials are not calibrated, saved, logged or sent pump/light commands
+ACTIVE_VIALS_FROM_GUI = False # True to leave out vials the GUI marks as unused (9999 thresholds or 'active': false) when ACTIVE_VIALS is None; their OD and temperature are then not logged either
+
 VOLUME =  25 #mL, determined by vial cap straw length
 OPERATION_MODE = 'turbidostat' #use to choose between 'turbidostat' and 'chemostat' functions
 # if using a different mode, name your function as the OPERATION_MODE variable
@@ -40,8 +46,31 @@ OPERATION_MODE = 'turbidostat' #use to choose between 'turbidostat' and 'chemost
 LIGHT_CAL_FILE = 'light_cal.txt'
 EXCEL_CONFIG_FILE = "experiment_configurations.xlsx"
 
+### Data Saving Settings ###
+POOLED_WRITERS = True # keep data files open for the whole experiment; False opens/closes them on every broadcast
+FLUSH_EVERY_N_BROADCASTS = 1 # write buffered data to disk every N broadcasts; keep at 1 if custom functions read back the OD files
+FLUSH_INTERVAL_S = None # (sec) also write buffered data if this much time has passed since the last write; None to disable
+BROADCAST_STORE = False # True to also save each broadcast as one fixed-width binary row in <EXP_NAME>/broadcasts.bin (see broadcast_store.py)
+RAW_ARCHIVE = False # True to save raw photodiode/thermistor readings as packed 16-bit arrays in <EXP_NAME>/raw.bin instead of <param>_raw text files (export with: python3 broadcast_store.py --raw <EXP_NAME>)
+BROADCAST_ARCHIVE = False # True to keep every full broadcast (config, all channels, pump state) as compressed JSON lines in <EXP_NAME>/broadcasts.archive (read with broadcast_archive.iter_broadcasts)
+BROADCAST_ARCHIVE_CHUNK = 500 # broadcasts per compressed chunk of the broadcast archive
+SQLITE_STORE = False # True to also save measurements and pump/ODset/step/light logs in a SQLite database <EXP_NAME>/<EXP_NAME>.db (see sqlite_store.py)
+PERSIST_IN_BACKGROUND = True # write data that custom functions do not read back on a background thread so slow disks do not delay pump commands
+PERSISTENCE_QUEUE_SIZE = 64 # max pending background writes before broadcasts wait for the disk
+JOURNAL_SNAPSHOT_EVERY = 500 # compact the controller state journal into a snapshot every N records
+LOG_SEGMENT_HOURS = None # (hours) rotate OD/temp/raw data files into compressed segments this long (e.g. 24); None to keep one file
+OD_LOOKUP_TABLE = False # True to convert sigmoid OD readings with per-vial lookup tables (within 1e-4 OD of the fit, see transform.SigmoidTable); numpy's log10 is usually as fast
+OD_WINDOW_SIZE = 100 # recent OD readings kept in memory per vial for the control code (eVOLVER.od_window); must cover OD_values_to_average and 2 * dilution_window
+COMMAND_OUTBOX = True # queue commands in <EXP_NAME>/<EXP_NAME>.outbox and replay them in order after a disconnect (see outbox.py)
+OUTBOX_BOLUS_MAX_AGE_S = 60 # (s) pump boluses queued longer than this while disconnected are dropped, not sent late
+TIME_INDEX_STRIDE = 64 # rows between checkpoints in the .idx time index next to each data/log file; None to disable
+PYRAMID_PARAMS = ['OD', 'temp'] # data files to keep 1min/10min/1h min/max/mean summaries of (<param>/pyramid/), used by the graphing server
+
 ##### END OF USER DEFINED GENERAL SETTINGS #####
 
+# vials of turbidostat_vials already reported as not active
+_skipped_vials = set()
+
 
 def turbidostat(eVOLVER, input_data, vials, elapsed_time):
     OD_data = input_data['transformed']['od']
@@ -49,12 +78,12 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
     ##### USER DEFINED VARIABLES #####
 
     ### Turbidostat Settings ###
-    turbidostat_vials = vials #vials is all 16, can set to different range (ex. [0,1,2,3]) to only trigger tstat on those vials
+    turbidostat_vials = vials #vials is the active vials (ACTIVE_VIALS, all 16 by default), can set to a subset of them (ex. [0,1,2,3]) to only trigger tstat on those vials
     stop_after_n_curves = np.inf #set to np.inf to never stop, or integer value to stop diluting after certain number of growth curves
     OD_values_to_average = 6  # Number of values to calculate the OD average
 
-    lower_thresh = [1.6] * len(vials) #to set all vials to the same value, creates 16-value list
-    upper_thresh = [2] * len(vials) #to set all vials to the same value, creates 16-value list
+    lower_thresh = [1.6] * 16 #to set all vials to the same value, creates 16-value list
+    upper_thresh = [2] * 16 #to set all vials to the same value, creates 16-value list
 
     if eVOLVER.experiment_params is not None:
         lower_thresh = list(map(lambda x: x['lower'], eVOLVER.experiment_params['vial_configuration']))
@@ -80,7 +109,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
     selection_stock_concs = [1000]*2 + [0]*2 + [1000]*7 + [50]*4 + [200] # stock concentrations for each vial; should be low enough that minimum selection level is possible given min_bolus_s
     max_selections = [500]*2 + [0]*2 + [25]*2 + [500]*5 + [20]*4 + [80] # maximum value your selection can go to; for chemical selection = proportion of stock concentration (don't want to use all of stock)
     min_selections = [25]*2  + [0]*2 + [25]*2 + [25]*5  + [1]*4 + [8] # minimum value your selection can go to
-    selection_step_nums = [20] * len(turbidostat_vials) # number of steps between min_selection and max_selection
+    selection_step_nums = [20] * 16 # number of steps between min_selection and max_selection
 
     ## Experiment Settings ##
     curves_to_start = 5 # number of growth curves to wait before starting selection; allows us to calculate WT growth rate
@@ -123,13 +152,13 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
     
     ##### VARIABLE INITIALIZATION #####
     ## Check that min_selection is high enough given stock concentration and bolus_slow ##
-    for i, vial in enumerate(turbidostat_vials):
+    for vial in turbidostat_vials:
         if vial in selection_steps: # if steps defined manually
             min_selection = selection_steps[vial][0]
             max_selection = selection_steps[vial][-1]
         else:
-            min_selection = min_selections[i]
-            max_selection = max_selections[i]
+            min_selection = min_selections[vial]
+            max_selection = max_selections[vial]
         if min_selection > max_selection:
             logger.warning(f"Vial {vial}: min_selection {min_selection} must be less than max_selection {max_selection}.")
             eVOLVER.stop_exp()
@@ -141,7 +170,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
         min_conc = ((selection_stock_concs[vial] * bolus_slow) + (0 * VOLUME)) / (bolus_slow + VOLUME) # Adding bolus_slow stock into plain media
         if min_conc > min_selection:
             # Solve for stock concentration that will be able to add bolus_slow and reach min_conc
-            new_stock_conc = ((min_selections[i] * (bolus_slow + VOLUME)) - (min_conc * VOLUME)) / bolus_slow
+            new_stock_conc = ((min_selections[vial] * (bolus_slow + VOLUME)) - (min_conc * VOLUME)) / bolus_slow
             logger.warning(f"Vial {vial}: min_selection must be greater than {round(min_conc, 3)}. Decrease stock concentration to at least {int(new_stock_conc)}.")
             eVOLVER.stop_exp()
             print('Experiment stopped, goodbye!')
@@ -150,29 +179,29 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
     ## Selection Step Automatic Generation ##
     # Compare current selection settings to previous and print if they have changed
-    for i, vial in enumerate(turbidostat_vials):
+    for vial in turbidostat_vials:
         # Print and log if the config is updated
         if generate_steps:
-            current_config = [elapsed_time, int(log_steps), selection_stock_concs[i], min_selections[i], max_selections[i], selection_step_nums[i]]
+            current_config = [elapsed_time, int(log_steps), selection_stock_concs[vial], min_selections[vial], max_selections[vial], selection_step_nums[vial]]
             config_change = su.compare_configs('step_gen', vial, current_config) # Check if config has changed and write to file if it has
         
             if config_change: # generate steps automatically
-                if min_selections[i] - max_selections[i] == 0: # Only one step
-                    selection_steps[vial] = [min_selections[i]]
+                if min_selections[vial] - max_selections[vial] == 0: # Only one step
+                    selection_steps[vial] = [min_selections[vial]]
                 elif log_steps:
-                    if min_selections[i] <= 0: # check if min_selection is greater than 0
+                    if min_selections[vial] <= 0: # check if min_selection is greater than 0
                         logger.warning(f"Vial {vial}: min_selection must be greater than 0 for logarithmic steps.")
                         eVOLVER.stop_exp()
                         print('Experiment stopped, goodbye!')
                         logger.warning('experiment stopped, goodbye!')
                         raise ValueError(f"Vial {vial}: min_selection must be greater than 0 for logarithmic steps.") # raise an error if min_selection is less than 0
-                    selection_steps[vial] = np.round(np.logspace(np.log10(min_selections[i]), np.log10(max_selections[i]), num=selection_step_nums[i]), 3)
+                    selection_steps[vial] = np.round(np.logspace(np.log10(min_selections[vial]), np.log10(max_selections[vial]), num=selection_step_nums[vial]), 3)
                 else: # Linear step generation
-                    selection_steps[vial] = np.round(np.linspace(min_selections[i], max_selections[i], num=selection_step_nums[i]), 1)
+                    selection_steps[vial] = np.round(np.linspace(min_selections[vial], max_selections[vial], num=selection_step_nums[vial]), 1)
             
                 # Write steps to step_config file and log
-                print(f"\nVial {vial}: Generated {len(selection_steps[vial])} steps from {min_selections[i]} to {max_selections[i]} {selection_units}")
-                logger.info(f"Vial {vial}: Generated {len(selection_steps[vial])} steps from {min_selections[i]} to {max_selections[i]} {selection_units}")
+                print(f"\nVial {vial}: Generated {len(selection_steps[vial])} steps from {min_selections[vial]} to {max_selections[vial]} {selection_units}")
+                logger.info(f"Vial {vial}: Generated {len(selection_steps[vial])} steps from {min_selections[vial]} to {max_selections[vial]} {selection_units}")
                 file_name =  f"vial{vial}_step_config.txt"
                 file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'step_config', file_name)
                 with open(file_path, "a+") as text_file:
@@ -194,11 +223,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
         current_conc = su.get_last_n_lines('step_log', vial, 1)[0][3] # Get just the concentration from the last step
         if config_change and current_conc != 0: # TODO: what if the current conc = 0 and config change? Need a better way of skipping this if experiment just started
             # Update log file with new steps
-            file_name = f"vial{vial}_step_log.txt"
-            file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'step_log', file_name)
-            text_file = open(file_path, "a+")
-            text_file.write(f"{elapsed_time},{elapsed_time},{round(selection_steps[vial][0], 3)},{current_conc},CONFIG CHANGE\n") # Format: [elapsed_time, step_time, current_step, current_conc]
-            text_file.close()
+            eVOLVER.append_log(vial, 'step_log', elapsed_time, [elapsed_time, round(selection_steps[vial][0], 3), current_conc, 'CONFIG CHANGE']) # Format: [elapsed_time, step_time, current_step, current_conc]
             logger.info(f"Vial {vial}: step log updated to first step: {round(selection_steps[vial][0], 3)} {selection_units}")
     ## End of Selection Step Initialization ##
 
@@ -206,103 +231,83 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
     ##### Turbidostat Control Code Below #####
 
-    # fluidic message: initialized so that no change is sent
-    MESSAGE = ['--'] * 48
-    for x in turbidostat_vials: #main loop through each vial
-        # Update turbidostat configuration files for each vial
-        # initialize OD and find OD path
-
-        file_name =  "vial{0}_ODset.txt".format(x)
-        ODset_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'ODset', file_name)
-        data = np.genfromtxt(ODset_path, delimiter=',')
-        ODset = data[len(data)-1][1]
-        ODsettime = data[len(data)-1][0]
-        num_curves=len(data)/2;
-
-        file_name =  "vial{0}_OD.txt".format(x)
-        OD_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'OD', file_name)
-        data = eVOLVER.tail_to_np(OD_path, OD_values_to_average)
-        average_OD = 0
-
-        # Determine whether turbidostat dilutions are needed
-        #enough_ODdata = (len(data) > 7) #logical, checks to see if enough data points (couple minutes) for sliding window
-        collecting_more_curves = (num_curves <= (stop_after_n_curves + 2)) #logical, checks to see if enough growth curves have happened
-
+    # only active vials have a controller state and OD window
+    skipped = [x for x in turbidostat_vials if x not in vials]
+    if skipped:
+        if not set(skipped) <= _skipped_vials:
+            logger.warning('turbidostat vials %s are not active (ACTIVE_VIALS), '
+                           'skipping them' % skipped)
+            _skipped_vials.update(skipped)
+        turbidostat_vials = [x for x in turbidostat_vials if x in vials]
+
+    # fluidic message and events for all vials at once (turbidostat_kernel.py)
+    # controller state and median recent OD per vial, NaN where not controlled
+    average_OD = np.full(16, np.nan)
+    ODset = np.full(16, np.nan)
+    ODset_time = np.full(16, np.nan)
+    num_curves = np.zeros(16)
+    last_pump = np.full(16, np.nan)
+    for x in turbidostat_vials:
+        # ODset, growth curves and last pump are kept in memory (controller_state.py)
+        state = eVOLVER.controller_state[x]
+        ODset[x] = state.ODset
+        ODset_time[x] = state.ODset_time
+        num_curves[x] = state.num_curves
+        last_pump[x] = state.last_pump
+        # recent OD is kept in memory (od_window.py), format: [[elapsed_time, OD], ...]
+        data = eVOLVER.od_window.last(x, OD_values_to_average)
         if data.size != 0:
             # Take median to avoid outlier
-            od_values_from_file = data[:,1]
-            average_OD = float(np.median(od_values_from_file))
-
-            #if recently exceeded upper threshold, note end of growth curve in ODset, allow dilutions to occur and growthrate to be measured
-            if (average_OD > upper_thresh[x]) and (ODset != lower_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time,
-                                                   lower_thresh[x]))
-                text_file.close()
-                ODset = lower_thresh[x]
-                # calculate growth rate
-                eVOLVER.calc_growth_rate(x, ODsettime, elapsed_time)
-
-            #if have approx. reached lower threshold, note start of growth curve in ODset
-            if (average_OD < (lower_thresh[x] + (upper_thresh[x] - lower_thresh[x]) / 3)) and (ODset != upper_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time, upper_thresh[x]))
-                text_file.close()
-                ODset = upper_thresh[x]
-
-            #if need to dilute to lower threshold, then calculate amount of time to pump
-            if average_OD > ODset and collecting_more_curves:
-
-                time_in = - (np.log(lower_thresh[x]/average_OD)*VOLUME)/flow_rate[x]
-
-                if time_in > 20:
-                    time_in = 20
-
-                time_in = round(time_in, 2)
-
-                file_name =  "vial{0}_pump_log.txt".format(x)
-                file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME,
-                                         'pump_log', file_name)
-                data = np.genfromtxt(file_path, delimiter=',')
-                last_pump = data[len(data)-1][0]
-                if (((elapsed_time - last_pump)*60) >= pump_wait): # if sufficient time since last pump, send command to Arduino
-                    if not np.isnan(time_in):
-                        logger.info('turbidostat dilution for vial %d' % x)
-                        # influx pump
-                        MESSAGE[x] = str(time_in)
-                        # efflux pump
-                        MESSAGE[x + 16] = str(time_in + time_out)
-
-                        file_name =  "vial{0}_pump_log.txt".format(x)
-                        file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'pump_log', file_name)
-
-                        text_file = open(file_path, "a+")
-                        text_file.write("{0},{1}\n".format(elapsed_time, time_in))
-                        text_file.close()
-                    else:
-                        print(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
-                        logger.warning(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
-                    
+            average_OD[x] = np.median(data[:,1])
         else:
             logger.debug('not enough OD measurements for vial %d' % x)
 
+    MESSAGE, events = turbidostat_step(elapsed_time, average_OD, ODset, ODset_time,
+                                       num_curves, last_pump, lower_thresh, upper_thresh,
+                                       flow_rate, stop_after_n_curves, VOLUME, pump_wait,
+                                       time_out)
+    for x, event, value in events:
+        if event == ODSET_LOWER:
+            #recently exceeded upper threshold, note end of growth curve in ODset, allow dilutions to occur and growthrate to be measured
+            eVOLVER.append_log(x, 'ODset', elapsed_time, [lower_thresh[x]])
+        elif event == GROWTH_CURVE:
+            # calculate growth rate
+            eVOLVER.calc_growth_rate(x, value, elapsed_time)
+        elif event == ODSET_UPPER:
+            #have approx. reached lower threshold, note start of growth curve in ODset
+            eVOLVER.append_log(x, 'ODset', elapsed_time, [upper_thresh[x]])
+        elif event == DILUTION:
+            logger.info('turbidostat dilution for vial %d' % x)
+            eVOLVER.append_log(x, 'pump_log', elapsed_time, [value])
+        elif event == NAN_DILUTION:
+            print(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
+            logger.warning(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
+
     ##### END OF Turbidostat Control Code #####
     
     ##### SELECTION LOGIC #####
     # TODO?: Change step_log to selection_log - more clear what it is
     # TODO?: Start logging event types (ie DILUTION, DECREASE, RESCUE) and reasons for that change (GROWTH_STALLED, EXCEDED_MAX_GROWTH)
+    # OD change across every dilution not yet in the step_log, all vials at once (dilution_alignment.py)
+    OD_times, OD_values = eVOLVER.od_window.ordered(turbidostat_vials)
+    factors, counts = pending_dilutions(OD_times, OD_values,
+                                        [eVOLVER.controller_state[vial].pump_times for vial in turbidostat_vials],
+                                        [eVOLVER.controller_state[vial].step_log[0] for vial in turbidostat_vials],
+                                        dilution_window)
+    dilution_factors = np.ones(16)
+    dilution_factors[turbidostat_vials] = factors
+    dilution_counts = np.zeros(16, dtype=int)
+    dilution_counts[turbidostat_vials] = counts
     for vial in turbidostat_vials:
-        # Get all growth rate data for this vial (read in as a Pandas dataframe)
-        file_name =  f"vial{vial}_gr.txt"
-        gr_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'growthrate', file_name)
-        gr_data = pd.read_csv(gr_path, delimiter=',', header=1, names=['time', 'gr'], dtype={'time': float, 'gr': float})
-        OD_data = su.get_last_n_lines('OD', vial, dilution_window*2) # Get OD data from before and after dilution
+        # Growth rates of this vial (kept in memory, see controller_state.py)
+        state = eVOLVER.controller_state[vial]
+        OD_data = eVOLVER.od_window.last(vial, dilution_window*2) # Get OD data from before and after dilution
 
         # Check for selection start
-        if (len(gr_data) >= curves_to_start) and (len(OD_data) == dilution_window*2): # If the number of growth curves is more than the number we need to wait
+        if (state.growth_count >= curves_to_start) and (len(OD_data) == dilution_window*2): # If the number of growth curves is more than the number we need to wait
             # Find the current selection step
             steps = np.array(selection_steps[vial])
-            last_step_log = su.get_last_n_lines('step_log', vial, 1)[0] # Format: [elapsed_time, step_change_time, current_step, current_conc]
+            last_step_log = state.step_log # Format: [elapsed_time, step_change_time, current_step, current_conc]
             last_time = float(last_step_log[0]) # time of the last step log; includes concentration adjustment calculations for dilutions
             last_step_change_time = float(last_step_log[1]) # experiment time that selection level was last changed
             last_step = float(last_step_log[2]) # last selection target level (chemical concentration)
@@ -324,14 +329,14 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
             # Decision: whether to go to next step, decrease to previous step, or stay at current step
             try:
                 # Determine the number of growth curves that have happened on the current step
-                num_curves_this_step = len(gr_data[gr_data['time'] > last_step_change_time])
+                num_curves_this_step = state.curves_since(last_step_change_time)
                 # TODO?: Move rescue dilution to fluidics section
                 
                 # Wait for min_curves_per_step growth curves on each step before deciding on a selection level
                 # TODO: Make selection level logic more clear. Growth stalling is the only exception to requiring min_curves_per_step
                 if (step_time >= min_step_time) and (len(steps) != 1):
-                    last_gr_time = gr_data['time'].values[-1] # time of the last growth rate measurement (ie dilution time)
-                    last_gr = gr_data.tail(min_curves_per_step)['gr'].median() # median growth rate over the last curves
+                    last_gr_time = state.growth_times[-1] # time of the last growth rate measurement (ie dilution time)
+                    last_gr = np.nanmedian(state.recent_growth_rates(min_curves_per_step)) # median growth rate over the last curves
 
                     selection_change = '' # Which change type we are making
                     reason = '' # The reason for the change
@@ -399,11 +404,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
                                 time_in = round(time_in, 2)
                                 MESSAGE[vial] = str(time_in) # influx pump
                                 MESSAGE[vial + 16] = str(round(time_in + time_out,2)) # efflux pump
-                                file_name =  f"vial{vial}_pump_log.txt"
-                                file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'pump_log', file_name)
-                                text_file = open(file_path, "a+")
-                                text_file.write("{0},{1}\n".format(elapsed_time, time_in))
-                                text_file.close()
+                                eVOLVER.append_log(vial, 'pump_log', elapsed_time, [time_in])
                                 selection_status_message += f'RESCUE DILUTION | '
                                             
                     # INCREASE to the next selection level because selection level is too low
@@ -432,17 +433,11 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
             ## SELECTION DILUTION HANDLING AND SELECTION CHEMICAL PUMPING ##
             try:
                 # CHEMICAL CONCENTRATION FROM DILUTION #
-                # Load the last pump event
-                last_dilution = su.get_last_n_lines('pump_log', vial, 1)[0] # Format: [elapsed_time, time_in]
-                last_dilution_time = last_dilution[0] # time of the last pump event
-
-                # Calculate the dilution factor based off of proportion of OD change
-                OD_times = OD_data[:, 0]
-                if last_dilution_time == OD_times[-(dilution_window+1)]: # Waiting until we have dilution_window length OD data before and after dilution 
+                # Dilution factor from the proportion of OD change, once there is dilution_window
+                # length OD data before and after each dilution (several multiply)
+                if dilution_counts[vial] > 0:
                     # Calculate current concentration of selection chemical
-                    OD_before = np.median(OD_data[:dilution_window, 1]) # Find OD before and after dilution
-                    OD_after = np.median(OD_data[-dilution_window:, 1])
-                    dilution_factor = OD_after / OD_before # Calculate dilution factor
+                    dilution_factor = dilution_factors[vial]
                     current_conc = last_conc * dilution_factor
                     # TODO rewrite last dilution_window steps to this concentration
                     selection_status_message += f'DILUTION {round(dilution_factor, 3)}X | '
@@ -481,11 +476,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
                         MESSAGE[vial + 32] = str(time_in) # set the pump message
                     
                         # Update slow pump log
-                        file_name =  f"vial{vial}_slow_pump_log.txt"
-                        file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'slow_pump_log', file_name)
-                        text_file = open(file_path, "a+")
-                        text_file.write("{0},{1}\n".format(elapsed_time, time_in))
-                        text_file.close()
+                        eVOLVER.append_log(vial, 'slow_pump_log', elapsed_time, [time_in])
                         selection_status_message += f'SELECTION CHEMICAL ADDED {round(calculated_bolus, 3)}mL | '
 
                 elif (np.median(OD_data[:,1]) < lower_thresh[vial]) and (current_step != 0):
@@ -494,11 +485,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
                 # Log current selection state
                 if (step_changed_time != last_step_change_time) or (current_step != last_step) or (current_conc != last_conc) or (selection_status_message != ''): # Only log if step changed or conc changed
-                    file_name =  f"vial{vial}_step_log.txt"
-                    file_path = os.path.join(eVOLVER.exp_dir, EXP_NAME, 'step_log', file_name)
-                    text_file = open(file_path, "a+")
-                    text_file.write(f"{elapsed_time},{step_changed_time},{current_step},{round(current_conc, 5)},{selection_status_message}\n") # Format: [elapsed_time, step_changed_time, current_step, current_conc]
-                    text_file.close()
+                    eVOLVER.append_log(vial, 'step_log', elapsed_time, [step_changed_time, current_step, round(current_conc, 5), selection_status_message]) # Format: [elapsed_time, step_changed_time, current_step, current_conc]
 
             except Exception as e:
                 print(f"Vial {vial}: Error in Selection Fluidics Step: \n\t{e}\nTraceback:\n\t{traceback.format_exc()}")
@@ -0,0 +1,203 @@
+import os
+import time
+import logging
+import threading
+
+from metrics import LatencyStats
+import log_segments
+from time_index import TimeIndexWriter
+from pyramid import PyramidWriter
+
+logger = logging.getLogger('eVOLVER')
+
+class DataWriter:
+    """
+    Keeps the per-vial data files (vial{x}_{param}.txt) open for the life of
+    the experiment instead of opening and closing them on every broadcast.
+
+    Rows are buffered in the open file objects and flushed as a group every
+    `flush_every` broadcasts and/or every `flush_interval` seconds. `sync()`
+    flushes and fsyncs every open file and should be called when the
+    experiment is paused or stopped.
+
+    A broadcast may be written in several calls (e.g. OD right away and the
+    other parameters from the persistence thread); calls with the same
+    elapsed time count as one broadcast and share its flush decision.
+
+    With `segment_hours` set, each file is rotated when a row falls into a
+    new segment: the finished segment is compressed by log_segments and the
+    active file starts empty. Pooled or not; after a restart the segment a
+    file is in is that of its first row.
+
+    Every file also gets a sparse time index sidecar (see time_index.py),
+    so range reads can seek instead of parsing from the top, and the
+    parameters in `pyramid_params` get min/max/mean summaries (pyramid.py).
+    """
+
+    def __init__(self, exp_dir, flush_every=1, flush_interval=None, pooled=True,
+                 segment_hours=None, index_stride=None, pyramid_params=None):
+        """
+        Args:
+            exp_dir (str): The experiment data directory (EXP_DIR).
+            flush_every (int): Flush all files every N broadcasts. Keep at 1 if
+                custom functions read back the files written here.
+            flush_interval (float): Also flush when this many seconds have
+                passed since the last flush. None to disable.
+            pooled (bool): False falls back to opening and closing each file
+                for every row (the original behavior), timed with the same
+                counters so both paths can be compared.
+            segment_hours (float): Length of a file segment in experiment
+                hours. None to never rotate.
+            index_stride (int): Rows between time index checkpoints. None to
+                not write index sidecars.
+            pyramid_params (list): Parameters to keep 1min/10min/1h summaries
+                of, e.g. ['OD', 'temp'].
+        """
+        self.exp_dir = exp_dir
+        self.pooled = pooled
+        self.flush_every = max(1, int(flush_every or 1))
+        self.flush_interval = flush_interval
+        self.segment_hours = segment_hours
+        self._files = {}
+        self._offsets = {}
+        self._segment_of = {}
+        self.index = TimeIndexWriter(index_stride) if index_stride else None
+        self.pyramid_params = set(pyramid_params or [])
+        self.pyramid = PyramidWriter() if self.pyramid_params else None
+        self._pending = 0
+        self._last_flush = time.time()
+        self._last_time = None
+        self._flush_now = False
+        self._lock = threading.RLock()
+
+        self.write_latency = LatencyStats('write')
+        self.flush_latency = LatencyStats('flush')
+        self.sync_latency = LatencyStats('fsync')
+
+    def _get_file(self, vial, param, elapsed_time=None):
+        key = (vial, param)
+        if self.segment_hours and elapsed_time is not None:
+            self._check_segment(key, elapsed_time)
+        text_file = self._files.get(key)
+        if text_file is None:
+            path = self._path(vial, param)
+            text_file = open(path, "a+")
+            self._files[key] = text_file
+            self._offsets[key] = os.path.getsize(path)
+        return text_file
+
+    def _path(self, vial, param):
+        file_name = "vial{0}_{1}.txt".format(vial, param)
+        return os.path.join(self.exp_dir, param, file_name)
+
+    def _check_segment(self, key, elapsed_time):
+        index = int(elapsed_time // self.segment_hours)
+        current = self._segment_of.get(key)
+        if current is None:
+            # first row since (re)starting: the file holds the segment of
+            # its first row, which may be an earlier one
+            first = log_segments.first_time(self._path(*key)) \
+                if os.path.exists(self._path(*key)) else None
+            current = index if first is None else int(first // self.segment_hours)
+        self._segment_of[key] = max(index, current)
+        if index <= current:
+            return
+        text_file = self._files.pop(key, None)
+        if text_file is not None:
+            text_file.close()
+        entry = log_segments.rotate(self._path(*key), current)
+        if self.index is not None:
+            self.index.reset(self._path(*key))
+        if entry is not None:
+            logger.info('rotated %s into %s' % (self._path(*key), entry['file']))
+
+    def write_broadcast(self, elapsed_time, series, vials):
+        """
+        Appends one row per vial for every parameter of a broadcast.
+
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            series (dict): Maps parameter name (also the data directory) to
+                a per-vial sequence of values. Empty sequences are skipped.
+            vials (list): The vials to write.
+        """
+        start = time.perf_counter()
+        rows = []
+        for param, data in series.items():
+            if len(data) == 0:
+                continue
+            for x in vials:
+                rows.append((x, param, "{0},{1}\n".format(elapsed_time, data[x])))
+                if param in self.pyramid_params:
+                    self.pyramid.add(self._path(x, param), elapsed_time, data[x])
+        if not self.pooled:
+            for x, param, row in rows:
+                if self.segment_hours:
+                    self._check_segment((x, param), elapsed_time)
+                with open(self._path(x, param), "a+") as text_file:
+                    if self.index is not None:
+                        self.index.record(text_file.name, elapsed_time,
+                                          text_file.tell())
+                    text_file.write(row)
+            self.write_latency.add(time.perf_counter() - start)
+            return
+        with self._lock:
+            for x, param, row in rows:
+                text_file = self._get_file(x, param, elapsed_time)
+                if self.index is not None:
+                    self.index.record(text_file.name, elapsed_time,
+                                      self._offsets[(x, param)])
+                text_file.write(row)
+                self._offsets[(x, param)] += len(row.encode('utf-8'))
+
+            if elapsed_time != self._last_time:
+                self._last_time = elapsed_time
+                self._pending += 1
+                self._flush_now = self._should_flush()
+            if self._flush_now:
+                self.flush()
+        self.write_latency.add(time.perf_counter() - start)
+
+    def _should_flush(self):
+        if self._pending >= self.flush_every:
+            return True
+        if self.flush_interval is not None and \
+                time.time() - self._last_flush >= self.flush_interval:
+            return True
+        return False
+
+    def flush(self):
+        """Pushes buffered rows of every open file to the OS."""
+        with self._lock, self.flush_latency.time():
+            for text_file in self._files.values():
+                text_file.flush()
+            self._pending = 0
+            self._last_flush = time.time()
+
+    def sync(self):
+        """Flushes and fsyncs every open file (on pause/stop)."""
+        self.flush()
+        with self._lock, self.sync_latency.time():
+            for text_file in self._files.values():
+                try:
+                    os.fsync(text_file.fileno())
+                except OSError as e:
+                    logger.warning('could not fsync %s: %s' % (text_file.name, e))
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            for text_file in self._files.values():
+                text_file.close()
+            self._files = {}
+
+    def stats(self):
+        return {'open_files': len(self._files),
+                'write': self.write_latency.as_dict(),
+                'flush': self.flush_latency.as_dict(),
+                'fsync': self.sync_latency.as_dict()}
+
+    def summary(self):
+        return 'data writer (%d open files) | %s | %s | %s' % (
+            len(self._files), self.write_latency.summary(),
+            self.flush_latency.summary(), self.sync_latency.summary())
@@ -0,0 +1,67 @@
+"""
+Aligns pump events with the OD readings around them to measure how much
+each dilution diluted a vial (OD after / OD before).
+
+A dilution at time tp is placed in a vial's OD times with
+j = searchsorted(times, tp, 'right'): the `window` readings before it are
+rows j-window..j-1 (the last of them taken at the broadcast that started
+the pump) and the readings after it rows j..j+window-1. This does not need
+the pump time to equal an OD time, so a slipped broadcast does not make a
+dilution go unnoticed. All pending dilutions of all vials are located
+with one searchsorted call and their medians taken in one gather.
+"""
+import numpy as np
+
+def pending_dilutions(times, values, pump_times, since, window):
+    """
+    Args:
+        times (numpy.ndarray): (vials x n) OD times, oldest first, NaN for
+            empty slots (see ODWindow.ordered).
+        values (numpy.ndarray): (vials x n) OD readings.
+        pump_times (list): Per vial, the times of recent pump events.
+        since (array): Per vial, dilutions whose after-window was complete
+            at or before this time are already accounted for (the time of
+            the last step_log line).
+        window (int): Readings on each side of a dilution.
+    Returns:
+        tuple: (factors, counts) per vial, the product of the dilution
+        factors of the pending dilutions (1 if none) and their number.
+    """
+    pump_times = [np.asarray(p, dtype=np.float64) for p in pump_times]
+    pump_times = [p[np.isfinite(p)] for p in pump_times]
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n_vials, size = times.shape
+    factors = np.ones(n_vials)
+    counts = np.zeros(n_vials, dtype=np.intp)
+    rows = np.concatenate([np.full(len(p), row, dtype=np.intp)
+                           for row, p in enumerate(pump_times)] +
+                          [np.zeros(0, dtype=np.intp)])
+    if len(rows) == 0 or window <= 0:
+        return factors, counts
+    pumps = np.concatenate(pump_times)
+
+    # one sorted key over all vials: row offset + time, empty slots just
+    # below the row's first reading
+    filled = np.isfinite(times)
+    first = size - filled.sum(axis=1)
+    span = max(np.nanmax(times, initial=0.), pumps.max()) + 2
+    offsets = np.arange(n_vials) * span
+    keys = np.where(filled, times, -1.) + offsets[:, None]
+    j = np.searchsorted(keys.ravel(), pumps + offsets[rows], 'right') - rows * size
+
+    complete = (j - window >= first[rows]) & (j + window <= size)
+    rows, j = rows[complete], j[complete]
+    done_time = times[rows, j + window - 1]
+    pending = done_time > np.asarray(since, dtype=np.float64)[rows]
+    rows, j = rows[pending], j[pending]
+    if len(rows) == 0:
+        return factors, counts
+
+    before = j[:, None] - window + np.arange(window)
+    after = j[:, None] + np.arange(window)
+    OD_before = np.median(values[rows[:, None], before], axis=1)
+    OD_after = np.median(values[rows[:, None], after], axis=1)
+    np.multiply.at(factors, rows, OD_after / OD_before)
+    np.add.at(counts, rows, 1)
+    return factors, counts
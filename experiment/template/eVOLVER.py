@@ -7,6 +7,7 @@ import pickle
 import shutil
 import logging
 import argparse
+import asyncio
 import numpy as np
 import pandas as pd
 import json
@@ -19,11 +20,41 @@ import custom_script
 from custom_script import EXP_NAME
 from custom_script import EVOLVER_PORT, OPERATION_MODE
 from custom_script import STIR_INITIAL, TEMP_INITIAL, LIGHT_CAL_FILE, EXCEL_CONFIG_FILE
+from custom_script import ACTIVE_VIALS, ACTIVE_VIALS_FROM_GUI, OD_WINDOW_SIZE
+from custom_script import COMMAND_OUTBOX, OUTBOX_BOLUS_MAX_AGE_S
+from custom_script import POOLED_WRITERS, FLUSH_EVERY_N_BROADCASTS, FLUSH_INTERVAL_S
+from custom_script import BROADCAST_STORE, SQLITE_STORE, RAW_ARCHIVE
+from custom_script import BROADCAST_ARCHIVE, BROADCAST_ARCHIVE_CHUNK
+from custom_script import PERSIST_IN_BACKGROUND, PERSISTENCE_QUEUE_SIZE
+from custom_script import JOURNAL_SNAPSHOT_EVERY, LOG_SEGMENT_HOURS
+from custom_script import TIME_INDEX_STRIDE, PYRAMID_PARAMS
+from custom_script import OD_LOOKUP_TABLE
 import step_utils as su
+import transform
+import calibration_models
+from calibration_cache import CalibrationCache
+from calibration_cache import load_json_calibration, load_light_calibration
+from calibration_cache import load_od_calibration
+from temperature import TemperatureController
+from controller_state import ControllerState
+from od_window import ODWindow
+import log_segments
+import time_index
+from time_index import TimeIndexWriter
+from data_writer import DataWriter
+from broadcast_store import BroadcastStore, RawArchive
+from broadcast_archive import BroadcastArchive
+from sqlite_store import SQLiteStore
+from persistence import PersistenceWorker
+from state_journal import StateJournal
+from commands import CommandManager
+from outbox import CommandOutbox
+from runtime import AsyncRuntime, LoopStats, STATS_INTERVAL_S
+from processes import AcquisitionNamespace, Pipeline, QueueIO
 
 # Should not be changed
-# vials to be considered/excluded should be handled
-# inside the custom functions
+# vials to be considered/excluded are set with ACTIVE_VIALS
+# in custom_script.py, see get_active_vials
 VIALS = [x for x in range(16)]
 
 SAVE_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -33,6 +64,13 @@ TEMP_CAL_PATH = os.path.join(SAVE_PATH, 'temp_cal.json')
 PUMP_CAL_PATH = os.path.join(SAVE_PATH, 'pump_cal.json')
 LIGHT_CAL_PATH = os.path.join(SAVE_PATH, LIGHT_CAL_FILE)
 JSON_PARAMS_FILE = os.path.join(SAVE_PATH, 'eVOLVER_parameters.json')
+BROADCAST_STORE_PATH = os.path.join(EXP_DIR, 'broadcasts.bin')
+RAW_ARCHIVE_PATH = os.path.join(EXP_DIR, 'raw.bin')
+BROADCAST_ARCHIVE_PATH = os.path.join(EXP_DIR, 'broadcasts')
+SQLITE_PATH = os.path.join(EXP_DIR, '{0}.db'.format(EXP_NAME))
+JOURNAL_PATH = os.path.join(EXP_DIR, '{0}.journal'.format(EXP_NAME))
+SNAPSHOT_PATH = os.path.join(EXP_DIR, '{0}.snapshot'.format(EXP_NAME))
+OUTBOX_PATH = os.path.join(EXP_DIR, '{0}.outbox'.format(EXP_NAME))
 
 SIGMOID = 'sigmoid'
 LINEAR = 'linear'
@@ -51,22 +89,107 @@ class EvolverNamespace(BaseNamespace):
     experiment_params = None
     ip_address = None
     exp_dir = SAVE_PATH
+    writer = None
+    store = None
+    store_disabled = False
+    raw_archive = None
+    archive = None
+    calibrations = None
+    temperature = None
+    temperature_unsupported = False
+    controller_state = None
+    od_window = None
+    active_vials = VIALS
+    db = None
+    persistence = None
+    journal = None
+    runtime = None
+    commands = None
+    outbox = None
+    connects = 0
+    reconnects = 0
+    disconnects = 0
+    log_index = None
+
+    def __init__(self, io, path):
+        super().__init__(io, path)
+        # per namespace, calibrations may arrive before initialize_exp
+        self.calibrations = CalibrationCache()
 
     def on_connect(self, *args):
         print("Connected to eVOLVER as client")
-        logger.info('connected to eVOLVER as client')
+        self.connects += 1
+        logger.info('connected to eVOLVER as client (%d connects, %d reconnects, '
+                    '%d disconnects)' % (self.connects, self.reconnects,
+                                         self.disconnects))
+        self.replay_commands()
 
     def on_disconnect(self, *args):
         print("Disconected from eVOLVER as client")
-        logger.info('disconnected to eVOLVER as client')
+        self.disconnects += 1
+        logger.info('disconnected from eVOLVER as client (%d disconnects)' %
+                    self.disconnects)
+        if self.outbox is not None:
+            self.outbox.disconnected()
 
     def on_reconnect(self, *args):
         print("Reconnected to eVOLVER as client")
-        logger.info("reconnected to eVOLVER as client")
+        self.reconnects += 1
+        logger.warning('reconnected to eVOLVER as client (%d reconnects)' %
+                       self.reconnects)
+        self.replay_commands()
 
     def on_broadcast(self, data):
+        received_time = time.time()
+        # a broadcast means the connection is back, even if the library
+        # reconnected without telling the namespace
+        if self.outbox is not None and not self.outbox.online:
+            self.replay_commands()
+        # with the asyncio runtime, broadcasts are queued for its loop
+        if self.runtime is not None:
+            self.runtime.receive_broadcast(data, received_time)
+        else:
+            self.handle_broadcast(data, received_time)
+
+    def replay_commands(self):
+        if self.outbox is None:
+            return
+        if self.runtime is not None:
+            self.runtime.dispatch(self.outbox.reconnected)
+        else:
+            self.outbox.reconnected()
+
+    def handle_broadcast(self, data, received_time=None, control=True):
+        """
+        Processes one broadcast. Commands issued while doing so are sent
+        together once it is done, without those the eVOLVER config in the
+        broadcast already agrees with (see commands.py).
+
+        Args:
+            data (dict): The broadcast.
+            received_time (float): When it was received (time.time()),
+                its data is saved at that experiment time.
+            control (bool): False to only save it, for broadcasts a newer
+                one in the backlog supersedes (see runtime.py).
+        """
+        commands = self.get_commands()
+        commands.observe(data.get('config', {}))
+        if self.outbox is not None:
+            self.outbox.confirm(data.get('config', {}))
+        commands.begin()
+        try:
+            self.process_broadcast(data, received_time, control)
+        finally:
+            commands.flush()
+        logger.debug(commands.summary())
+
+    def process_broadcast(self, data, received_time=None, control=True):
         logger.info('Broadcast received')
-        elapsed_time = round((time.time() - self.start_time) / 3600, 4)
+        if received_time is None:
+            received_time = time.time()
+        # transform_data adds to the dict, keep the payload as received
+        received = dict(data)
+        elapsed_time = round((received_time - self.start_time) / 3600, 4)
         logger.info('Elapsed time: %.4f hours' % elapsed_time)
         print("{0}: {1} Hours".format(EXP_NAME, elapsed_time))
         # are the calibrations in yet?
@@ -75,14 +198,14 @@ class EvolverNamespace(BaseNamespace):
                            'functions')
             return
 
-        with open(OD_CAL_PATH) as f:
-            od_cal = json.load(f)
-        with open(TEMP_CAL_PATH) as f:
-            temp_cal = json.load(f)
+        od_cal = self.calibrations.get(OD_CAL_PATH, load_od_calibration
+                                       if OD_LOOKUP_TABLE else load_json_calibration)
+        temp_cal = self.calibrations.get(TEMP_CAL_PATH, load_json_calibration)
 
         # apply calibrations
         # update temperatures if needed
-        data = self.transform_data(data, VIALS, od_cal, temp_cal)
+        vials = self.active_vials
+        data = self.transform_data(data, vials, od_cal, temp_cal)
         if data is None:
             logger.error('could not tranform raw data, skipping user-'
                          'defined functions')
@@ -96,33 +219,60 @@ class EvolverNamespace(BaseNamespace):
             self.OD_initial = np.zeros(len(VIALS))
         data['transformed']['od'] = (data['transformed']['od'] -
                                         self.OD_initial)
-        # save data
-        try:
-            self.save_data(data['transformed']['od'], elapsed_time,
-                            VIALS, 'OD')
-            self.save_data(data['transformed']['temp'], elapsed_time,
-                            VIALS, 'temp')
-
-            for param in od_cal['params']:
-                self.save_data(data['data'].get(param, []), elapsed_time,
-                            VIALS, param + '_raw')
-            for param in temp_cal['params']:
-                self.save_data(data['data'].get(param, []), elapsed_time,
-                            VIALS, param + '_raw')
-        except OSError:
+        if self.od_window is None:
             logger.info("Broadcast received before experiment initialization - skipping custom function...")
             return
+        # control code reads recent OD from memory, so all data files can
+        # be written by the persistence stage
+        self.od_window.append(elapsed_time, data['transformed']['od'])
 
+        # save data
+        series = {'OD': data['transformed']['od'],
+                  'temp': data['transformed']['temp']}
+        for param in od_cal['params'] + temp_cal['params']:
+            series[param + '_raw'] = data['data'].get(param, [])
+        if control:
+            self.control_temperature(data, elapsed_time, temp_cal)
+        # with the raw archive on, raw channels are not written as text
+        text_series = {param: values for param, values in series.items()
+                       if not (RAW_ARCHIVE and param.endswith('_raw'))}
+        self.persist(self.save_broadcast, text_series, elapsed_time, vials)
+        if BROADCAST_ARCHIVE:
+            self.persist(self.archive_broadcast, received, elapsed_time,
+                         received_time)
+        if RAW_ARCHIVE:
+            self.persist(self.save_raw, data['data'], elapsed_time,
+                         od_cal['params'] + temp_cal['params'])
+        if BROADCAST_STORE:
+            self.persist(self.save_to_store, data, elapsed_time,
+                         od_cal['params'] + temp_cal['params'])
+        if SQLITE_STORE:
+            self.persist(self.get_db().write_broadcast, elapsed_time, series,
+                         vials)
+
+        if not control:
+            logger.info('newer broadcast queued, saved this one without '
+                        'running custom functions')
+            return
         # run custom functions
-        self.custom_functions(data, VIALS, elapsed_time)
+        self.custom_functions(data, vials, elapsed_time)
         # save variables
-        self.save_variables(self.start_time, self.OD_initial)
+        self.persist(self.save_variables, self.start_time, self.OD_initial,
+                     droppable=True)
+        if self.persistence is not None:
+            logger.debug(self.persistence.summary())
 
         # Restart logging for db/gdrive syncing
         logging.shutdown()
         logging.getLogger('eVOLVER')
 
     def on_activecalibrations(self, data):
+        if self.runtime is not None:
+            self.runtime.dispatch(self.handle_calibrations, data)
+        else:
+            self.handle_calibrations(data)
+
+    def handle_calibrations(self, data):
         print('Calibrations recieved')
         logger.info('Calibrations recieved')
         for calibration in data:
@@ -138,9 +288,12 @@ class EvolverNamespace(BaseNamespace):
                 if fit['active']:
                     with open(file_path, 'w') as f:
                         json.dump(fit, f)
+                    # do not wait for the mtime check to pick up the new fit
+                    self.calibrations.invalidate(file_path)
                     # Create raw data directories and files for params needed
+                    # (not with RAW_ARCHIVE, raw channels go to raw.bin)
                     for param in fit['params']:
-                        if not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')) and param != 'pump':
+                        if not RAW_ARCHIVE and not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')) and param != 'pump':
                             os.makedirs(os.path.join(EXP_DIR, param + '_raw'))
                             for x in range(len(fit['coefficients'])):
                                 exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
@@ -149,14 +302,40 @@ class EvolverNamespace(BaseNamespace):
                                 self._create_file(x, param + '_raw', defaults=[exp_str])
                     break
 
+    def get_commands(self):
+        if self.commands is None:
+            self.commands = CommandManager(self.send_command)
+        return self.commands
+
+    def send_command(self, data):
+        # through the outbox, so commands survive disconnects (outbox.py)
+        if self.outbox is not None:
+            self.outbox.put(data)
+        else:
+            self.emit_command(data)
+
+    def emit_command(self, data, seq=None):
+        if seq is not None and isinstance(self._io, QueueIO):
+            # the acquisition process reports the commands it cannot emit
+            # by seq, for the outbox to queue them again
+            self._io.emit('command', data, seq=seq)
+            return
+        self.emit('command', data, namespace = '/dpu-evolver')
+
     def request_calibrations(self):
         logger.debug('requesting active calibrations')
         self.emit('getactivecal',
                   {}, namespace = '/dpu-evolver')
 
     def transform_data(self, data, vials, od_cal, temp_cal):
+        od_model = calibration_models.get_model(od_cal['type'])
+        temp_model = calibration_models.get_model(temp_cal['type'])
+        if od_model is None or temp_model is None:
+            logger.error('calibration type not supported: OD %s, temperature %s'
+                         % (od_cal['type'], temp_cal['type']))
+            return None
         od_data_2 = None
-        if od_cal['type'] == THREE_DIMENSION:
+        if od_model.n_inputs == 2:
             od_data_2 = data['data'].get(od_cal['params'][1], None)
 
         od_data = data['data'].get(od_cal['params'][0], None)
@@ -172,124 +351,114 @@ class EvolverNamespace(BaseNamespace):
             logger.error('NaN received, error with measurements')
             return None
 
-        od_data = np.array([float(x) for x in od_data])
-        if od_data_2:
-            od_data_2 = np.array([float(x) for x in od_data_2])
-        temp_data = np.array([float(x) for x in temp_data])
-        set_temp_data = np.array([float(x) for x in set_temp_data])
-
-        temps = []
-        for x in vials:
-            file_name =  "vial{0}_temp_config.txt".format(x)
-            file_path = os.path.join(EXP_DIR, 'temp_config', file_name)
-            temp_set_data = np.genfromtxt(file_path, delimiter=',')
-            temp_set = temp_set_data[len(temp_set_data)-1][1]
-            temps.append(temp_set)
-            od_coefficients = od_cal['coefficients'][x]
-            temp_coefficients = temp_cal['coefficients'][x]
-            try:
-                if od_cal['type'] == SIGMOID:
-                    #convert raw photodiode data into ODdata using calibration curve
-                    od_data[x] = np.real(od_coefficients[2] -
-                                        ((np.log10((od_coefficients[1] -
-                                                    od_coefficients[0]) /
-                                                    (float(od_data[x]) -
-                                                    od_coefficients[0])-1)) /
-                                                    od_coefficients[3]))
-                    if not np.isfinite(od_data[x]):
-                        od_data[x] = 'NaN'
-                        logger.debug('OD from vial %d: %s' % (x, od_data[x]))
-                    else:
-                        logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
-                elif od_cal['type'] == THREE_DIMENSION:
-                    od_data[x] = np.real(od_coefficients[0] +
-                                        (od_coefficients[1]*od_data[x]) +
-                                        (od_coefficients[2]*od_data_2[x]) +
-                                        (od_coefficients[3]*(od_data[x]**2)) +
-                                        (od_coefficients[4]*od_data[x]*od_data_2[x]) +
-                                        (od_coefficients[5]*(od_data_2[x]**2)))
-                else:
-                    logger.error('OD calibration not of supported type!')
-                    od_data[x] = 'NaN'
-            except ValueError:
-                print("OD Read Error")
-                logger.error('OD read error for vial %d, setting to NaN' % x)
-                od_data[x] = 'NaN'
-            try:
-                temp_data[x] = (float(temp_data[x]) *
-                                temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('temperature from vial %d: %.3f' % (x, temp_data[x]))
-            except ValueError:
-                print("Temp Read Error")
-                logger.error('temperature read error for vial %d, setting to NaN'
-                            % x)
-                temp_data[x]  = 'NaN'
-            try:
-                set_temp_data[x] = (float(set_temp_data[x]) *
-                                    temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('set_temperature from vial %d: %.3f' % (x,
-                                                                set_temp_data[x]))
-            except ValueError:
-                print("Set Temp Read Error")
-                logger.error('set temperature read error for vial %d, setting to NaN'
-                            % x)
-                set_temp_data[x]  = 'NaN'
-
-        temps = np.array(temps)
-        # update temperatures only if difference with expected
-        # value is above 0.2 degrees celsius
-        delta_t = np.abs(set_temp_data - temps).max()
-        if delta_t > 0.2:
-            logger.info('updating temperatures (max. deltaT is %.2f)' %
-                        delta_t)
-            coefficients = temp_cal['coefficients']
-            raw_temperatures = [str(int((temps[x] - temp_cal['coefficients'][x][1]) /
-                                        temp_cal['coefficients'][x][0]))
-                                for x in vials]
-            self.update_temperature(raw_temperatures)
+        od_data = transform.to_float_array(od_data)
+        if od_data_2 is not None:
+            od_data_2 = transform.to_float_array(od_data_2)
+        temp_data = transform.to_float_array(temp_data)
+        set_temp_data = transform.to_float_array(set_temp_data)
+        unreadable = np.isnan(od_data[vials]) | np.isnan(temp_data[vials])
+        if unreadable.any():
+            print("OD/Temp Read Error")
+            logger.error('read error for vials %s, setting to NaN' %
+                         np.asarray(vials)[unreadable].tolist())
+
+        # every calibration is one expression over all vials; unparsable or
+        # out of range readings end up as NaN
+        od_coefficients = transform.coefficient_matrix(od_cal, vials)
+        temp_coefficients = transform.coefficient_matrix(temp_cal, vials)
+        if od_cal.get('table') is not None:
+            od_data[vials] = od_cal['table'].evaluate(od_data[vials], vials)
+        elif od_model.n_inputs == 2:
+            od_data[vials] = od_model.to_value([od_data[vials], od_data_2[vials]],
+                                               od_coefficients)
         else:
-            # config from server agrees with local config
-            # report if actual temperature doesn't match
-            delta_t = np.abs(temps - temp_data).max()
-            if delta_t > 0.2:
-                logger.debug('actual temperature doesn\'t match configuration '
-                            '(yet? max deltaT is %.2f)' % delta_t)
-                logger.debug('temperature config: %s' % temps)
-                logger.debug('actual temperatures: %s' % temp_data)
+            #convert raw photodiode data into ODdata using calibration curve
+            od_data[vials] = od_model.to_value(od_data[vials], od_coefficients)
+        od_data = transform.finite_or_nan(od_data)
+        temp_data[vials] = temp_model.to_value(temp_data[vials], temp_coefficients)
+        # the temperature command carries every vial, so setpoints are
+        # converted for all of them
+        set_temp_data[VIALS] = temp_model.to_value(
+            set_temp_data[VIALS], transform.coefficient_matrix(temp_cal, VIALS))
+        # readings of inactive vials are not calibrated, do not pass them on
+        inactive = np.ones(len(od_data), dtype=bool)
+        inactive[vials] = False
+        od_data[inactive] = np.nan
+        temp_data[inactive] = np.nan
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('OD: %s' % np.round(od_data[vials], 3).tolist())
+            logger.debug('temperature: %s' % np.round(temp_data[vials], 3).tolist())
+            logger.debug('set_temperature: %s' %
+                         np.round(set_temp_data[vials], 3).tolist())
 
         # add a new field in the data dictionary
         data['transformed'] = {}
         data['transformed']['od'] = od_data
         data['transformed']['temp'] = temp_data
+        data['transformed']['set_temp'] = set_temp_data
         return data
 
     def update_stir_rate(self, stir_rates, immediate = False):
         data = {'param': 'stir', 'value': stir_rates,
                 'immediate': immediate, 'recurring': True}
         logger.debug('stir rate command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        self.get_commands().submit(data)
+
+    def control_temperature(self, data, elapsed_time, temp_cal):
+        # setpoints live in memory, see temperature.py
+        if self.temperature is None:
+            return
+        temp_model = calibration_models.get_model(temp_cal['type'])
+        if not temp_model.can_convert_to_raw():
+            if not self.temperature_unsupported:
+                self.temperature_unsupported = True
+                logger.error('a %s temperature calibration cannot convert '
+                             'setpoints to raw values, temperature commands '
+                             'are not sent' % temp_cal['type'])
+            return
+        coefficients = transform.coefficient_matrix(temp_cal, VIALS)
+        raw_temperatures = self.temperature.update(
+            elapsed_time, data['transformed']['set_temp'][VIALS],
+            lambda temps: temp_model.to_raw(temps, coefficients))
+        if raw_temperatures is not None:
+            self.update_temperature(raw_temperatures)
+        else:
+            # config from server agrees with local config
+            # report if actual temperature doesn't match
+            vials = self.active_vials
+            delta_t = np.abs(self.temperature.current[vials] -
+                             data['transformed']['temp'][vials]).max(initial=0)
+            if delta_t > 0.2:
+                logger.debug('actual temperature doesn\'t match configuration '
+                            '(yet? max deltaT is %.2f)' % delta_t)
+
+    def save_setpoint(self, vial, elapsed_time, temp):
+        self.append_log(vial, 'temp_config', elapsed_time, [temp])
+
+    def save_ramp(self, vial, elapsed_time, ramp):
+        if self.journal is not None:
+            self.journal.append('temp_ramp', vial, elapsed_time, ramp)
 
     def update_temperature(self, temperatures, immediate = False):
         data = {'param': 'temp', 'value': temperatures,
                 'immediate': immediate, 'recurring': True}
         logger.debug('temperature command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        self.get_commands().submit(data)
 
     def update_light(self, light_vals, immediate = False):
         data = {'param': 'light', 'value': light_vals,
                 'immediate': immediate, 'recurring': True}
         logger.debug('light command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')    
+        self.get_commands().submit(data)
 
     def fluid_command(self, MESSAGE):
         logger.debug('fluid command: %s' % MESSAGE)
         command = {'param': 'pump', 'value': MESSAGE,
                    'recurring': False ,'immediate': True}
-        self.emit('command', command, namespace='/dpu-evolver')
+        self.get_commands().submit(command)
 
     def update_chemo(self, data, vials, bolus_in_s, period_config, immediate = False):
-        current_pump = data['config']['pump']['value']
-
         MESSAGE = {'fields_expected_incoming': 49,
                    'fields_expected_outgoing': 49,
                    'recurring': True,
@@ -311,9 +480,12 @@ class EvolverNamespace(BaseNamespace):
                 MESSAGE['value'][x + 16] = '%.2f|%d' % (bolus_in_s[x] * 2,
                                                         period_config[x])
 
-        if MESSAGE['value'] != current_pump:
+        # fields the pump config of the broadcast already has are no change
+        commands = self.get_commands()
+        commands.observe(data.get('config', {}))
+        if not commands.is_noop(MESSAGE):
             logger.info('updating chemostat: %s' % MESSAGE)
-            self.emit('command', MESSAGE, namespace = '/dpu-evolver')
+        commands.submit(MESSAGE)
 
     def stop_all_pumps(self, ):
         data = {'param': 'pump',
@@ -321,7 +493,12 @@ class EvolverNamespace(BaseNamespace):
                 'recurring': False,
                 'immediate': True}
         logger.info('stopping all pumps')
-        self.emit('command', data, namespace = '/dpu-evolver')
+        # always sent, right away, and pump commands not sent yet are dropped
+        if self.commands is not None:
+            self.commands.discard('pump')
+        if self.outbox is not None:
+            self.outbox.discard('pump')
+        self.send_command(data)
 
     def _create_file(self, vial, param, directory=None, defaults=None):
         if defaults is None:
@@ -369,6 +546,10 @@ class EvolverNamespace(BaseNamespace):
                     # Log config change
                     print(f'Vial {vial}: updating {config_name} config')
                     logger.info(f'Vial {vial}: updating {config_name} config')
+                    if self.journal is not None:
+                        self.journal.append(config_name + '_config', vial,
+                                            elapsed_time,
+                                            list(current_config[1:]))
         
         # Explicitly close the file handle
         excel_file.close()
@@ -376,6 +557,7 @@ class EvolverNamespace(BaseNamespace):
     def initialize_exp(self, vials, experiment_params, log_name, quiet, verbose, ip_address, always_yes = False):
         self.ip_address = ip_address
         self.experiment_params = experiment_params
+        self.active_vials = get_active_vials(vials, experiment_params)
         logger.info('initializing experiment')
 
         if os.path.exists(EXP_DIR):
@@ -430,6 +612,11 @@ class EvolverNamespace(BaseNamespace):
             os.makedirs(os.path.join(EXP_DIR, 'light_log')) # light values over time
   
             setup_logging(log_name, quiet, verbose)
+            self.journal = StateJournal(JOURNAL_PATH, SNAPSHOT_PATH,
+                                        JOURNAL_SNAPSHOT_EVERY)
+            # every controller event of this experiment will be journaled,
+            # so resuming it does not need to read the logs back
+            self.journal.append('start', None, 0, {})
             for x in vials:
                 exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
                                                                  x,
@@ -508,19 +695,63 @@ class EvolverNamespace(BaseNamespace):
             else:
                 self.use_blank = False
                 self.OD_initial = np.zeros(len(vials))
+            self.save_variables(start_time, self.OD_initial)
         else:
             # load existing experiment
-            pickle_name =  "{0}.pickle".format(EXP_NAME)
-            pickle_path = os.path.join(EXP_DIR, pickle_name)
-            logger.info('loading previous experiment data: %s' % pickle_path)
-            with open(pickle_path, 'rb') as f:
-                loaded_var  = pickle.load(f)
-            x = loaded_var
-            start_time = x[0]
-            self.OD_initial = x[1]
+            self.journal = StateJournal(JOURNAL_PATH, SNAPSHOT_PATH,
+                                        JOURNAL_SNAPSHOT_EVERY)
+            if self.journal.exists():
+                logger.info('recovering previous experiment state: %s' %
+                            JOURNAL_PATH)
+                state = self.journal.recover()
+                start_time = state['variables']['start_time']
+                OD_initial = state['variables'].get('OD_initial')
+                if OD_initial is not None:
+                    self.OD_initial = np.array(OD_initial)
+            else:
+                # experiments started before the state journal existed
+                pickle_name =  "{0}.pickle".format(EXP_NAME)
+                pickle_path = os.path.join(EXP_DIR, pickle_name)
+                logger.info('loading previous experiment data: %s' % pickle_path)
+                with open(pickle_path, 'rb') as f:
+                    loaded_var  = pickle.load(f)
+                x = loaded_var
+                start_time = x[0]
+                self.OD_initial = x[1]
+                self.save_variables(start_time, self.OD_initial)
 
         elapsed_time = round((time.time() - start_time) / 3600, 4)
-        self.load_excel_configs(elapsed_time, vials, config_filename=EXCEL_CONFIG_FILE) # Load configurations from an Excel file and compare them with existing configs for each vial.
+        self.load_excel_configs(elapsed_time, self.active_vials, config_filename=EXCEL_CONFIG_FILE) # Load configurations from an Excel file and compare them with existing configs for each vial.
+
+        # after load_excel_configs, which may append a temp_config line the
+        # controller reads its setpoints from
+        self.temperature = TemperatureController(EXP_DIR, vials,
+                                                 on_setpoint=self.save_setpoint,
+                                                 on_ramp=self.save_ramp)
+        if len(self.active_vials) < len(vials):
+            logger.info('active vials: %s' % self.active_vials)
+        if COMMAND_OUTBOX:
+            self.outbox = CommandOutbox(OUTBOX_PATH, self.emit_command,
+                                        lambda: self._io.connected,
+                                        OUTBOX_BOLUS_MAX_AGE_S)
+            if exp_continue == 'y':
+                # sent when the connection is up again, stale boluses dropped
+                self.outbox.load()
+            else:
+                self.outbox.reset()
+        # ODset/pump/growth rate history, updated by append_log from here on
+        self.controller_state = ControllerState(EXP_DIR, self.active_vials,
+                                                self.journal.state)
+        od_window = ODWindow(self.active_vials, OD_WINDOW_SIZE)
+        if exp_continue == 'y':
+            od_window.seed_from_files(lambda x: os.path.join(
+                EXP_DIR, 'OD', 'vial{0}_OD.txt'.format(x)))
+        self.od_window = od_window
+        # ramps still running when the experiment was stopped
+        self.temperature.restore({vial: state['temp_ramp']['values']
+                                  for vial, state in self.journal.state['vials'].items()
+                                  if 'temp_ramp' in state})
+
 
         # copy current custom script to txt file
         backup_filename = '{0}_{1}.txt'.format(EXP_NAME,
@@ -544,19 +775,126 @@ class EvolverNamespace(BaseNamespace):
             result = False
         return result
 
-    def save_data(self, data, elapsed_time, vials, parameter):
-        if len(data) == 0:
+    def get_writer(self):
+        if self.writer is None:
+            self.writer = DataWriter(EXP_DIR,
+                                     flush_every=FLUSH_EVERY_N_BROADCASTS,
+                                     flush_interval=FLUSH_INTERVAL_S,
+                                     pooled=POOLED_WRITERS,
+                                     segment_hours=LOG_SEGMENT_HOURS,
+                                     index_stride=TIME_INDEX_STRIDE,
+                                     pyramid_params=PYRAMID_PARAMS)
+        return self.writer
+
+    def save_broadcast(self, series, elapsed_time, vials):
+        # all rows of a broadcast go through the pooled writer in one pass
+        writer = self.get_writer()
+        writer.write_broadcast(elapsed_time, series, vials)
+        logger.debug(writer.summary())
+
+    def save_to_store(self, data, elapsed_time, raw_params):
+        # one fixed-width binary row per broadcast, see broadcast_store.py
+        if self.store_disabled:
             return
-        for x in vials:
-            file_name =  "vial{0}_{1}.txt".format(x, parameter)
-            file_path = os.path.join(EXP_DIR, parameter, file_name)
-            text_file = open(file_path, "a+")
-            text_file.write("{0},{1}\n".format(elapsed_time, data[x]))
-            text_file.close()
+        try:
+            if self.store is None:
+                self.store = BroadcastStore(BROADCAST_STORE_PATH, raw_params,
+                                            n_vials=len(VIALS))
+            self.store.append_broadcast(elapsed_time,
+                                        data['transformed']['od'],
+                                        data['transformed']['temp'],
+                                        data['data'])
+        except ValueError as e:
+            # e.g. a layout mismatch, which the next broadcast would repeat
+            self.store_disabled = True
+            logger.error('could not save broadcast to %s, not saving to it '
+                         'any more: %s' % (BROADCAST_STORE_PATH, e))
+
+    def save_raw(self, raw, elapsed_time, raw_params):
+        # packed uint16 raw channels, see RawArchive in broadcast_store.py
+        try:
+            if self.raw_archive is None:
+                self.raw_archive = RawArchive(RAW_ARCHIVE_PATH, raw_params,
+                                              n_vials=len(VIALS))
+            self.raw_archive.append_raw(elapsed_time, raw)
+        except ValueError as e:
+            logger.error('could not save raw data to %s: %s' %
+                         (RAW_ARCHIVE_PATH, e))
+
+    def archive_broadcast(self, data, elapsed_time, received_time):
+        # full payloads as compressed JSON lines, see broadcast_archive.py
+        if self.archive is None:
+            self.archive = BroadcastArchive(BROADCAST_ARCHIVE_PATH,
+                                            chunk_size=BROADCAST_ARCHIVE_CHUNK)
+        self.archive.append(elapsed_time, data, received_time)
+
+    def persist(self, func, *args, droppable=False):
+        """
+        Runs a disk write on the persistence thread (or process, with
+        --multiprocess), or right away if PERSIST_IN_BACKGROUND is off.
+        """
+        if self.persistence is None and not PERSIST_IN_BACKGROUND:
+            func(*args)
+            return
+        if self.persistence is None:
+            self.persistence = PersistenceWorker(PERSISTENCE_QUEUE_SIZE).start()
+        self.persistence.submit(func, *args, droppable=droppable)
+
+    def get_db(self):
+        if self.db is None and SQLITE_STORE:
+            self.db = SQLiteStore(SQLITE_PATH)
+        return self.db
+
+    def append_log(self, vial, param, elapsed_time, values, directory=None):
+        """
+        Appends an event line (elapsed_time,value1,value2,...) to
+        vial{vial}_{param}.txt and mirrors it to the SQLite store if enabled.
+
+        Args:
+            vial (int): The vial number.
+            param (str): The log name, e.g. 'pump_log', 'ODset', 'step_log'.
+            elapsed_time (float): Experiment time in hours.
+            values (list): The values following the time on the line.
+            directory (str, optional): The log directory, defaults to param.
+        """
+        if directory is None:
+            directory = param
+        file_name = "vial{0}_{1}.txt".format(vial, param)
+        file_path = os.path.join(EXP_DIR, directory, file_name)
+        line = ','.join(str(v) for v in [elapsed_time] + list(values))
+        if TIME_INDEX_STRIDE:
+            if self.log_index is None:
+                self.log_index = TimeIndexWriter(TIME_INDEX_STRIDE)
+            offset = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            self.log_index.record(file_path, elapsed_time, offset)
+        with open(file_path, "a+") as text_file:
+            text_file.write(line + '\n')
+        if self.controller_state is not None:
+            self.controller_state.record(vial, param, elapsed_time, values)
+        if self.journal is not None:
+            self.journal.append(param, vial, elapsed_time, list(values))
+        db = self.get_db()
+        if db is not None:
+            self.persist(db.log_event, vial, param, elapsed_time, list(values))
+
+    def save_data(self, data, elapsed_time, vials, parameter):
+        self.save_broadcast({parameter: data}, elapsed_time, vials)
 
     def save_variables(self, start_time, OD_initial):
         # save variables needed for restarting experiment later
-        save_path = os.path.dirname(os.path.realpath(__file__))
+        # only changes are journaled, so this is a no-op on most broadcasts
+        variables = {'start_time': start_time, 'OD_initial': None}
+        if OD_initial is not None:
+            variables['OD_initial'] = np.asarray(OD_initial).tolist()
+        if self.journal is None:
+            return
+        # compared as JSON so NaN blanks compare equal
+        if (json.dumps(self.journal.state['variables'], sort_keys=True) ==
+                json.dumps(variables, sort_keys=True)):
+            return
+        elapsed_time = round((time.time() - start_time) / 3600, 4)
+        self.journal.append('variables', None, elapsed_time, variables)
+        # the pickle is still written for older versions of this script
         pickle_name = "{0}.pickle".format(EXP_NAME)
         pickle_path = os.path.join(EXP_DIR, pickle_name)
         logger.debug('saving all variables: %s' % pickle_path)
@@ -564,25 +902,31 @@ class EvolverNamespace(BaseNamespace):
             pickle.dump([start_time, OD_initial], f)
 
     def get_flow_rate(self):
-        pump_cal = None
-        with open(PUMP_CAL_PATH) as f:
-            pump_cal = json.load(f)
+        pump_cal = self.calibrations.get(PUMP_CAL_PATH, load_json_calibration)
         return pump_cal['coefficients']
     
     def get_light_calibration(self):
-        file_path = os.path.join(SAVE_PATH, LIGHT_CAL_FILE)
-        light_calibration = np.loadtxt(file_path, delimiter="\t")
-        if len(light_calibration) == 16:
-            light_vals = light_calibration
-        else:
-            light_vals = light_calibration[0,:]
-        return light_vals
+        return self.calibrations.get(LIGHT_CAL_PATH, load_light_calibration)
 
     def calc_growth_rate(self, vial, gr_start, elapsed_time):
         ODfile_name =  "vial{0}_OD.txt".format(vial)
         # Grab Data and make setpoint
         OD_path = os.path.join(EXP_DIR, 'OD', ODfile_name)
-        OD_data = np.genfromtxt(OD_path, delimiter=',')
+        # only the rows after gr_start are read (time index / segments);
+        # the newest rows come from the OD window, the persistence stage
+        # may not have written them yet
+        OD_data = time_index.read_range(OD_path, t0=gr_start)
+        if self.od_window is not None and vial in self.od_window:
+            recent = self.od_window.window(vial, t0=gr_start)
+            if recent.size != 0:
+                if OD_data.size != 0:
+                    OD_data = OD_data[OD_data[:, 0] < recent[0, 0]]
+                    OD_data = np.concatenate((OD_data, recent))
+                else:
+                    OD_data = recent
+        if OD_data.size == 0:
+            logger.debug('no OD data after %s for vial %s' % (gr_start, vial))
+            return
         raw_time = OD_data[:, 0]
         raw_OD = OD_data[:, 1]
         raw_time = raw_time[np.isfinite(raw_OD)]
@@ -600,11 +944,7 @@ class EvolverNamespace(BaseNamespace):
         logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
 
         # Save slope to file
-        file_name =  "vial{0}_gr.txt".format(vial)
-        gr_path = os.path.join(EXP_DIR, 'growthrate', file_name)
-        text_file = open(gr_path, "a+")
-        text_file.write("{0},{1}\n".format(elapsed_time, slope))
-        text_file.close()
+        self.append_log(vial, 'gr', elapsed_time, [slope], directory='growthrate')
 
     def custom_functions(self, data, vials, elapsed_time):
         # load user script from custom_script.py
@@ -631,6 +971,58 @@ class EvolverNamespace(BaseNamespace):
 
     def stop_exp(self):
         self.stop_all_pumps()
+        if self.persistence is not None:
+            # finish every queued write before syncing the files
+            if not self.persistence.drain(timeout=60):
+                logger.error('persistence queue not drained after 60 s')
+            logger.info(self.persistence.summary())
+        if self.journal is not None:
+            self.journal.sync()
+        self.close_files()
+
+    def close_files(self):
+        if self.writer is not None:
+            # make sure everything written so far is on disk
+            self.writer.sync()
+            logger.info(self.writer.summary())
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.raw_archive is not None:
+            self.raw_archive.close()
+            self.raw_archive = None
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+def get_active_vials(vials, experiment_params=None):
+    """
+    Returns the vials the experiment runs on: ACTIVE_VIALS from
+    custom_script.py if set, otherwise every vial, or with
+    ACTIVE_VIALS_FROM_GUI the vials the GUI configuration does not mark as
+    unused (9999 thresholds, or 'active': false).
+
+    Args:
+        vials (list): All vials of the eVOLVER.
+        experiment_params (dict): Parameters from eVOLVER_parameters.json.
+    Returns:
+        list: The active vials, in order.
+    """
+    if ACTIVE_VIALS is not None:
+        return [x for x in vials if x in ACTIVE_VIALS]
+    if not ACTIVE_VIALS_FROM_GUI or not experiment_params or \
+            'vial_configuration' not in experiment_params:
+        return list(vials)
+    configuration = experiment_params['vial_configuration']
+    active = []
+    for x in vials:
+        config = configuration[x] if x < len(configuration) else {}
+        if not config.get('active', True):
+            continue
+        if config.get('lower') == 9999 and config.get('upper') == 9999:
+            continue
+        active.append(x)
+    return active
 
 def setup_logging(filename, quiet, verbose):
     if quiet:
@@ -662,6 +1054,14 @@ def get_options():
     parser.add_argument('-i', '--ip-address', action='store', dest='ip_address',
                         help='IP address of eVOLVER to run experiment on.')
 
+    parser.add_argument('--legacy-loop', action='store_true', default=False,
+                        help='Poll the eVOLVER connection and stdin every '
+                             '0.1 s as before, instead of the asyncio runtime')
+    parser.add_argument('--multiprocess', action='store_true', default=False,
+                        help='Run the socket, the experiment code and the '
+                             'disk writes in separate processes (needs -y, '
+                             'the experiment process cannot ask questions)')
+
     log_nolog = parser.add_mutually_exclusive_group()
     log_nolog.add_argument('-v', '--verbose', action='count',
                            default=0,
@@ -672,49 +1072,131 @@ def get_options():
                            help='Disable logging to file entirely')
     return parser.parse_args(), parser
 
-if __name__ == '__main__':
-    options, parser = get_options()
-
-
-    #changes terminal tab title in OSX
-    print('\x1B]0;eVOLVER EXPERIMENT: PRESS Ctrl-C TO PAUSE\x07')
+def pause_on_interrupt(socketIO, settle=None):
+    """
+    Pauses the experiment after a Ctrl-C until the user presses enter.
+
+    Args:
+        socketIO (SocketIO): The connection to the eVOLVER.
+        settle (callable): Waits for socket calls still running on another
+            thread (see AsyncRuntime.settle), before disconnecting.
+    Returns:
+        bool: False if a second Ctrl-C asked to terminate the experiment.
+    """
+    try:
+        print('Ctrl-C detected, pausing experiment')
+        logger.warning('interrupt received, pausing experiment')
+        EVOLVER_NS.stop_exp()
+        if settle is not None:
+            settle()
+        # stop receiving broadcasts
+        socketIO.disconnect()
+        while True:
+            key = input('Experiment paused. Press enter key to restart '
+                        ' or hit Ctrl-C again to terminate experiment')
+            logger.warning('resuming experiment')
+            # no need to have something like "restart_chemo" here
+            # with the new server logic
+            socketIO.connect()
+            break
+        return True
+    except KeyboardInterrupt:
+        print('Second Ctrl-C detected, shutting down')
+        logger.warning('second interrupt received, terminating '
+                        'experiment')
+        EVOLVER_NS.stop_exp()
+        print('Experiment stopped, goodbye!')
+        logger.warning('experiment stopped, goodbye!')
+        return False
+
+def stop_on_error(e):
+    logger.critical('exception %s stopped the experiment' % str(e))
+    print('error "%s" stopped the experiment' % str(e))
+    traceback.print_exc(file=sys.stdout)
+    EVOLVER_NS.stop_exp()
+    print('Experiment stopped, goodbye!')
+    logger.warning('experiment stopped, goodbye!')
+
+def reset_connection(socketIO):
+    # reset connection to avoid buildup of broadcast
+    # messages (unlikely but could happen for very long
+    # experiments with slow dpu code/computer)
+    logger.info('resetting connection to eVOLVER to avoid '
+                'potential buildup of broadcast messages')
+    socketIO.disconnect()
+    socketIO.connect()
 
-    experiment_params = None
-    if os.path.exists(JSON_PARAMS_FILE):
-        with open(JSON_PARAMS_FILE) as f:
-            experiment_params = json.load(f)
-    evolver_ip = experiment_params['ip'] if experiment_params is not None else options.ip_address
-    if evolver_ip is None:
-        logger.error('No IP address found. Please provide on the command line or through the GUI.')
-        parser.print_help()
-        sys.exit(2)
+def run_event_loop(socketIO, report=None):
+    """
+    Runs the experiment on the asyncio runtime (see runtime.py).
+
+    Args:
+        socketIO (SocketIO): The connection to the eVOLVER.
+        report (callable): Also called at every stats report.
+    """
+    # broadcasts that pile up are coalesced by the runtime, so there is
+    # no periodic reconnect as in the legacy loop
+    runtime = AsyncRuntime(socketIO, EVOLVER_NS)
+    if report is not None:
+        runtime.call_every(STATS_INTERVAL_S, report)
+    while True:
+        try:
+            asyncio.run(runtime.run())
+        except KeyboardInterrupt:
+            # the socket thread may still be in a wait: ignore what it
+            # receives, and let it return before disconnecting
+            runtime.pause()
+            if not pause_on_interrupt(socketIO, settle=runtime.settle):
+                break
+            runtime.resume()
+        except Exception as e:
+            stop_on_error(e)
+            break
+    runtime.close()
+
+def run_multiprocess(evolver_ip, experiment_params, options):
+    """
+    Runs the experiment over acquisition, control and persistence processes
+    (see processes.py); this process is the acquisition one.
+    """
+    global EVOLVER_NS
+    log_args = (options.log_name, options.quiet, options.verbose)
+    pipeline = Pipeline(EvolverNamespace, '/dpu-evolver',
+                        (VIALS, experiment_params) + log_args +
+                        (evolver_ip, options.always_yes),
+                        log_args, setup_logging, PERSISTENCE_QUEUE_SIZE,
+                        STATS_INTERVAL_S)
+    # processes are started before the socket and its heartbeat thread
+    pipeline.start()
+    setup_logging(*log_args)
+    logger.info('running in multiprocess mode')
 
     socketIO = SocketIO(evolver_ip, EVOLVER_PORT)
-    EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
-
+    EVOLVER_NS = socketIO.define(AcquisitionNamespace, '/dpu-evolver')
     # start by stopping any existing chemostat
     EVOLVER_NS.stop_all_pumps()
-    #
-    EVOLVER_NS.start_time = EVOLVER_NS.initialize_exp(VIALS,
-                                                      experiment_params,
-                                                      options.log_name,
-                                                      options.quiet,
-                                                      options.verbose,
-                                                      evolver_ip,
-                                                      options.always_yes
-                                                      )
+    pipeline.attach(EVOLVER_NS)
+    run_event_loop(socketIO, report=pipeline.report)
+
+    # stop experiment one last time
+    socketIO.connect()
+    EVOLVER_NS.stop_exp()
+    pipeline.close()
 
+def run_legacy_loop(socketIO):
+    """The polling loop, kept for comparison (--legacy-loop)."""
     # Using a non-blocking stream reader to be able to listen
-    # for commands from the electron app. 
+    # for commands from the electron app.
     nbsr = NBSR(sys.stdin)
     paused = False
-
-    # logging setup
+    stats = LoopStats('legacy loop')
+    stats_timer = time.time()
 
     reset_connection_timer = time.time()
-    while True:        
+    while True:
         try:
             # infinite loop
+            stats.wakeup()
 
             # check if a message has come in from the DPU
             message = nbsr.readline()
@@ -728,56 +1210,79 @@ if __name__ == '__main__':
                 paused = True
                 EVOLVER_NS.stop_exp()
                 socketIO.disconnect()
-                
+
             if 'continue-script' in message:
                 print('Restarting experiment', flush = True)
                 logger.info('Restarting experiment')
                 paused = False
                 socketIO.connect()
+            if message:
+                stats.commands.add(time.monotonic() - nbsr.received_at)
 
             if not paused:
                     socketIO.wait(seconds=0.1)
                     if time.time() - reset_connection_timer > 3600 and not paused:
-                        # reset connection to avoid buildup of broadcast
-                        # messages (unlikely but could happen for very long
-                        # experiments with slow dpu code/computer)
-                        logger.info('resetting connection to eVOLVER to avoid '
-                                    'potential buildup of broadcast messages')
-                        socketIO.disconnect()
-                        socketIO.connect()
+                        reset_connection(socketIO)
                         reset_connection_timer = time.time()
+            if time.time() - stats_timer > STATS_INTERVAL_S:
+                logger.info(stats.summary())
+                if EVOLVER_NS.commands is not None:
+                    logger.info(EVOLVER_NS.commands.summary())
+                if EVOLVER_NS.outbox is not None:
+                    logger.info(EVOLVER_NS.outbox.summary())
+                stats.reset()
+                stats_timer = time.time()
         except KeyboardInterrupt:
-            try:
-                print('Ctrl-C detected, pausing experiment')
-                logger.warning('interrupt received, pausing experiment')
-                EVOLVER_NS.stop_exp()
-                # stop receiving broadcasts
-                socketIO.disconnect()
-                while True:
-                    key = input('Experiment paused. Press enter key to restart '
-                                ' or hit Ctrl-C again to terminate experiment')
-                    logger.warning('resuming experiment')
-                    # no need to have something like "restart_chemo" here
-                    # with the new server logic
-                    socketIO.connect()
-                    break
-            except KeyboardInterrupt:
-                print('Second Ctrl-C detected, shutting down')
-                logger.warning('second interrupt received, terminating '
-                                'experiment')
-                EVOLVER_NS.stop_exp()
-                print('Experiment stopped, goodbye!')
-                logger.warning('experiment stopped, goodbye!')
+            if not pause_on_interrupt(socketIO):
                 break
         except Exception as e:
-            logger.critical('exception %s stopped the experiment' % str(e))
-            print('error "%s" stopped the experiment' % str(e))
-            traceback.print_exc(file=sys.stdout)
-            EVOLVER_NS.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
+            stop_on_error(e)
             break
 
+if __name__ == '__main__':
+    options, parser = get_options()
+
+
+    #changes terminal tab title in OSX
+    print('\x1B]0;eVOLVER EXPERIMENT: PRESS Ctrl-C TO PAUSE\x07')
+
+    experiment_params = None
+    if os.path.exists(JSON_PARAMS_FILE):
+        with open(JSON_PARAMS_FILE) as f:
+            experiment_params = json.load(f)
+    evolver_ip = experiment_params['ip'] if experiment_params is not None else options.ip_address
+    if evolver_ip is None:
+        logger.error('No IP address found. Please provide on the command line or through the GUI.')
+        parser.print_help()
+        sys.exit(2)
+
+    if options.multiprocess:
+        if options.legacy_loop or not options.always_yes:
+            parser.error('--multiprocess needs -y and cannot be used with '
+                         '--legacy-loop')
+        run_multiprocess(evolver_ip, experiment_params, options)
+        sys.exit(0)
+
+    socketIO = SocketIO(evolver_ip, EVOLVER_PORT)
+    EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
+
+    # start by stopping any existing chemostat
+    EVOLVER_NS.stop_all_pumps()
+    #
+    EVOLVER_NS.start_time = EVOLVER_NS.initialize_exp(VIALS,
+                                                      experiment_params,
+                                                      options.log_name,
+                                                      options.quiet,
+                                                      options.verbose,
+                                                      evolver_ip,
+                                                      options.always_yes
+                                                      )
+
+    if options.legacy_loop:
+        run_legacy_loop(socketIO)
+    else:
+        run_event_loop(socketIO)
+
     # stop experiment one last time
     # covers corner case where user presses Ctrl-C twice quickly
     socketIO.connect()
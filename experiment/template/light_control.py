@@ -109,11 +109,7 @@ def log_light_update(eVOLVER, vial, elapsed_time, light_uE, light_pwm, light_sta
         light_time = 0 # Reset light time
 
         # Log the light update to the log file
-        file_name =  f"vial{vial}_light_log.txt"
-        file_path = os.path.join(eVOLVER.exp_dir, expt_name, 'light_log', file_name)
-        text_file = open(file_path, "a+")
-        text_file.write(f"{elapsed_time},{light_time},{light_uE},{light_pwm},0,0,0,0\n") # Format: [elapsed_time, step_changed_time, current_step, current_conc]
-        text_file.close()
+        eVOLVER.append_log(vial, 'light_log', elapsed_time, [light_time, light_uE, light_pwm, 0, 0, 0, 0]) # Format: [elapsed_time, light_time, light1_uE, PWM_1, light2_uE, PWM_2, light3_uE, PWM_3]
 
         # Log the update message to console and file
         message = f"Vial {vial}: LIGHT {light_status} {light_uE}uE, PWM={light_pwm}"
@@ -0,0 +1,138 @@
+"""
+Time-segmented data files.
+
+When rotation is on, the active file (e.g. OD/vial0_OD.txt) only holds the
+current segment. Older segments are gzip-compressed into <dir>/segments/
+and listed in <dir>/manifest.json:
+
+    {"vial0_OD.txt": [{"file": "segments/vial0_OD.0000.txt.gz",
+                       "t0": 0.0, "t1": 23.9985, "lines": 4321}, ...]}
+
+The readers below stitch segments and the active file back together, so
+callers see one continuous file.
+"""
+import os
+import gzip
+import json
+import numpy as np
+
+SEGMENT_DIR = 'segments'
+MANIFEST = 'manifest.json'
+
+def _line_time(line):
+    try:
+        return float(line.split(',', 1)[0])
+    except ValueError:
+        return None
+
+def load_manifest(directory):
+    manifest_path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def _save_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, MANIFEST)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def segments(path):
+    """Returns the manifest entries of a data file, oldest first."""
+    directory, file_name = os.path.split(path)
+    return load_manifest(directory).get(file_name, [])
+
+def rotate(path, index):
+    """
+    Compresses the active file into segment `index` and empties it.
+    The file must not be open for writing.
+
+    Returns:
+        dict: The new manifest entry, or None if the file was empty.
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    times = [t for t in (_line_time(line) for line in lines) if t is not None]
+    if not times:
+        return None
+
+    directory, file_name = os.path.split(path)
+    os.makedirs(os.path.join(directory, SEGMENT_DIR), exist_ok=True)
+    segment_name = os.path.join(SEGMENT_DIR, '{0}.{1:04d}.txt.gz'.format(
+        os.path.splitext(file_name)[0], index))
+    segment_path = os.path.join(directory, segment_name)
+    with gzip.open(segment_path + '.tmp', 'wt') as f:
+        f.writelines(lines)
+    os.replace(segment_path + '.tmp', segment_path)
+
+    entry = {'file': segment_name, 't0': times[0], 't1': times[-1],
+             'lines': len(lines)}
+    manifest = load_manifest(directory)
+    manifest.setdefault(file_name, []).append(entry)
+    _save_manifest(directory, manifest)
+    # a crash before this truncate leaves the rows in both places; readers
+    # skip active rows that are not newer than the last segment
+    open(path, 'w').close()
+    return entry
+
+def _read_segment(path, entry):
+    segment_path = os.path.join(os.path.dirname(path), entry['file'])
+    with gzip.open(segment_path, 'rt') as f:
+        return f.readlines()
+
+def _active_lines(path, entries):
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    if not entries:
+        return lines
+    last_time = entries[-1]['t1']
+    return [line for line in lines
+            if _line_time(line) is None or _line_time(line) > last_time]
+
+def first_time(path):
+    """
+    Returns the time of the first row of the active file not already in a
+    segment, or None if it holds none.
+    """
+    for line in _active_lines(path, segments(path)):
+        t = _line_time(line)
+        if t is not None:
+            return t
+    return None
+
+def read_lines(path, t0=None):
+    """
+    Yields every line of a data file across its segments. Segments that end
+    before t0 are not decompressed; lines of the remaining segments are
+    yielded as is, callers filter by time themselves.
+    """
+    entries = segments(path)
+    for entry in entries:
+        if t0 is not None and entry['t1'] < t0:
+            continue
+        for line in _read_segment(path, entry):
+            yield line
+    for line in _active_lines(path, entries):
+        yield line
+
+def read_array(path, t0=None):
+    """np.genfromtxt over read_lines, as a 2D array."""
+    data = np.genfromtxt(read_lines(path, t0), delimiter=',')
+    return np.atleast_2d(data)
+
+def previous_lines(path, n_lines):
+    """
+    Returns the last n_lines lines stored in segments (not the active file),
+    decompressing only as many segments as needed, newest first.
+    """
+    lines = []
+    for entry in reversed(segments(path)):
+        if len(lines) >= n_lines:
+            break
+        lines = _read_segment(path, entry) + lines
+    return [line.rstrip('\n') for line in lines[-n_lines:]] if n_lines > 0 else []
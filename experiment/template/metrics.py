@@ -0,0 +1,84 @@
+import time
+import bisect
+from contextlib import contextmanager
+
+class LatencyStats:
+    """
+    Running count, total and maximum of a timed operation, in seconds.
+    Cheap enough to update on every broadcast.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - start)
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def as_dict(self):
+        return {'count': self.count, 'total_s': self.total,
+                'mean_ms': self.mean * 1000, 'max_ms': self.max * 1000,
+                'last_ms': self.last * 1000}
+
+    def summary(self):
+        return '%s: n=%d mean=%.3fms max=%.3fms last=%.3fms' % (
+            self.name, self.count, self.mean * 1000, self.max * 1000,
+            self.last * 1000)
+
+class LatencyHistogram(LatencyStats):
+    """
+    LatencyStats that also counts the latencies in buckets of roughly
+    doubling width (1 ms to 1 min), for percentiles of a pipeline stage.
+    """
+
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2.,
+              5., 10., 30., 60.)
+
+    def reset(self):
+        super().reset()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        super().add(seconds)
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def percentile(self, q):
+        """Upper bound (s) of the bucket holding the q-th percentile."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100. * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS + (self.max,), self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return '%s p50<=%.1fms p90<=%.1fms p99<=%.1fms' % (
+            super().summary(), self.percentile(50) * 1000,
+            self.percentile(90) * 1000, self.percentile(99) * 1000)
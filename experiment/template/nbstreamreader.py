@@ -1,16 +1,22 @@
+import time
 from threading import Thread
 from collections import deque
 
 class NonBlockingStreamReader:
 
-    def __init__(self, stream):
+    def __init__(self, stream, callback=None):
         '''
         stream: the stream to read from.
                 Usually a process' stdout or stderr.
+        callback: optional, called from the reader thread with
+                  (line, receive time) for every line instead of queueing it.
         '''
 
         self._s = stream
         self._q = deque()
+        # time.monotonic() at which the last line returned by readline
+        # was read from the stream
+        self.received_at = None
 
         def _populateQueue(stream, queue):
             '''
@@ -19,8 +25,10 @@ class NonBlockingStreamReader:
 
             while True:
                 line = stream.readline()
-                if line:
-                    queue.append(line)
+                if line and callback is not None:
+                    callback(line, time.monotonic())
+                elif line:
+                    queue.append((line, time.monotonic()))
                 else:
                     raise UnexpectedEndOfStream
 
@@ -31,8 +39,9 @@ class NonBlockingStreamReader:
 
     def readline(self):
         if len(self._q) > 0:
-            return self._q.popleft()
+            line, self.received_at = self._q.popleft()
+            return line
         else:
-            return '' 
+            return ''
 
 class UnexpectedEndOfStream(Exception): pass
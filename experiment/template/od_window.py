@@ -0,0 +1,112 @@
+import logging
+import numpy as np
+
+import step_utils as su
+import time_index
+
+logger = logging.getLogger('eVOLVER')
+
+class ODWindow:
+    """
+    Ring buffer of the most recent calibrated OD readings of every vial,
+    with their times, filled by on_broadcast so that control code gets
+    recent OD without reading the OD files back.
+
+    Queries return rows of (elapsed_time, OD), oldest first, the same layout
+    as step_utils.tail_to_np on an OD file.
+    """
+
+    def __init__(self, vials, size=100):
+        """
+        Args:
+            vials (list): The vials to keep readings of.
+            size (int): Readings kept per vial.
+        """
+        self.vials = list(vials)
+        self.size = size
+        self._rows = {x: i for i, x in enumerate(self.vials)}
+        self.times = np.full((len(self.vials), size), np.nan)
+        self.values = np.full((len(self.vials), size), np.nan)
+        # next write position and number of readings held, per vial
+        self.head = np.zeros(len(self.vials), dtype=np.intp)
+        self.count = np.zeros(len(self.vials), dtype=np.intp)
+
+    def __contains__(self, vial):
+        return vial in self._rows
+
+    def append(self, elapsed_time, od):
+        """
+        Adds one broadcast.
+
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            od (numpy.ndarray): OD of every vial, indexed by vial number.
+        """
+        rows = np.arange(len(self.vials))
+        self.times[rows, self.head] = elapsed_time
+        self.values[rows, self.head] = np.asarray(od, dtype=np.float64)[self.vials]
+        self.head = (self.head + 1) % self.size
+        np.minimum(self.count + 1, self.size, out=self.count)
+
+    def seed(self, vial, rows):
+        """Fills a vial's buffer from (time, OD) rows, oldest first."""
+        row = self._rows[vial]
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, 2)[-self.size:]
+        n = len(rows)
+        self.times[row, :n] = rows[:, 0]
+        self.values[row, :n] = rows[:, 1]
+        self.head[row] = n % self.size
+        self.count[row] = n
+
+    def seed_from_files(self, path_for):
+        """
+        Seeds every vial from the tail of its OD file, for resumed
+        experiments.
+
+        Args:
+            path_for (callable): path_for(vial) returns the vial's OD file.
+        """
+        for vial in self.vials:
+            path = path_for(vial)
+            data = su.tail_to_np(path, self.size)
+            if data.size == 0 or data.dtype != np.float64:
+                # fewer rows than the buffer holds (the header was reached)
+                data = time_index.read_range(path)
+            try:
+                rows = np.asarray(data, dtype=np.float64).reshape(-1, 2)
+            except (TypeError, ValueError):
+                logger.warning('could not seed OD window from %s' % path)
+                continue
+            self.seed(vial, rows[np.isfinite(rows[:, 0])])
+
+    def last(self, vial, n):
+        """
+        Returns the last n readings of a vial as an (n, 2) array, or an
+        empty array if fewer than n have been received.
+        """
+        row = self._rows[vial]
+        if n <= 0 or n > self.count[row]:
+            return np.asarray([])
+        index = (self.head[row] - n + np.arange(n)) % self.size
+        return np.column_stack((self.times[row, index], self.values[row, index]))
+
+    def ordered(self, vials):
+        """
+        Returns (times, values), (vials x size) arrays of the given vials'
+        readings oldest first, NaN in the leading empty slots.
+        """
+        rows = np.array([self._rows[x] for x in vials], dtype=np.intp)
+        index = (self.head[rows][:, None] + np.arange(self.size)) % self.size
+        return self.times[rows[:, None], index], self.values[rows[:, None], index]
+
+    def window(self, vial, t0=None, t1=None):
+        """Returns the held readings of a vial with t0 <= time <= t1."""
+        data = self.last(vial, self.count[self._rows[vial]])
+        if data.size == 0:
+            return data
+        keep = np.ones(len(data), dtype=bool)
+        if t0 is not None:
+            keep &= data[:, 0] >= t0
+        if t1 is not None:
+            keep &= data[:, 0] <= t1
+        return data[keep]
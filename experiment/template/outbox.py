@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('eVOLVER')
+
+NO_CHANGE = '--'
+# sent entries kept to requeue the ones reported undelivered
+IN_FLIGHT = 256
+
+def is_bolus(command):
+    """One-shot pump command that runs at least one pump (not a stop)."""
+    return (command['param'] == 'pump' and not command.get('recurring', False)
+            and any(str(field) not in (NO_CHANGE, '0')
+                    for field in command.get('value', [])))
+
+def _merge(older, newer):
+    """Fields of newer, with older's where newer leaves them unchanged."""
+    if len(older) != len(newer):
+        return list(newer)
+    return [new if str(new) != NO_CHANGE else old
+            for old, new in zip(older, newer)]
+
+def _supersedes(newer, older):
+    """True if command newer makes the queued command older redundant."""
+    if newer['param'] != older['param']:
+        return False
+    if newer.get('recurring', False):
+        return older.get('recurring', False)
+    return is_bolus(newer) and is_bolus(older)
+
+class CommandOutbox:
+    """
+    Ordered, persistent queue of the commands sent to the eVOLVER.
+
+    Every command gets a sequence number and is appended to the outbox file
+    before it is emitted, and marked sent once emitted. While the socket is
+    down commands stay queued, and on (re)connect they are replayed in
+    order. Queued commands are collapsed on the way in: a recurring command
+    absorbs the queued one of the same parameter, and a pump bolus the
+    queued bolus, so only the latest state is replayed.
+
+    Boluses are sent at most once: they are marked sent before they are
+    emitted, dropped if emitting fails (the library may have sent them
+    before failing), and dropped if older than `bolus_max_age` seconds when
+    their turn comes, as the control code has decided on newer OD by then.
+    Recurring commands and stops are idempotent and kept until sent.
+
+    When something else emits the commands (the acquisition process in
+    --multiprocess mode), it reports those it could not emit with
+    `undelivered` and they are queued again.
+
+    File format: one JSON object per line, {"put": seq, "time", "command"},
+    {"sent": seq} or {"dropped": seq}, a command queued again being put
+    again with its seq; it is truncated to {"seq": seq}
+    whenever the queue is empty.
+    """
+
+    def __init__(self, path, send, is_connected=None, bolus_max_age=60):
+        """
+        Args:
+            path (str): The outbox file.
+            send (callable): send(command, seq) emits a command, raising
+                on connection errors.
+            is_connected (callable): Returns False while the socket is
+                closed (e.g. paused), None to rely on connected().
+            bolus_max_age (float): Seconds after which a queued bolus is
+                dropped instead of sent.
+        """
+        self.path = path
+        self.send = send
+        self.is_connected = is_connected
+        self.bolus_max_age = bolus_max_age
+        self.online = True
+        self.seq = 0
+        self.pending = []
+        self.sent = 0
+        self.queued = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.requeued = 0
+        self.consistency = LatencyStats('reconnect to consistent state')
+        self._reconnected_at = None
+        # param: fields of the last recurring command sent since reconnecting
+        self._expected = {}
+        self._in_flight = collections.deque(maxlen=IN_FLIGHT)
+        self._file = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Restores the commands left queued by a previous run."""
+        pending = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last line
+                        break
+                    if 'seq' in record:
+                        self.seq = max(self.seq, record['seq'])
+                    elif 'put' in record:
+                        self.seq = max(self.seq, record['put'])
+                        pending[record['put']] = {'seq': record['put'],
+                                                  'time': record['time'],
+                                                  'command': record['command']}
+                    else:
+                        pending.pop(record.get('sent', record.get('dropped')), None)
+        self.pending = [pending[seq] for seq in sorted(pending)]
+        if self.pending:
+            logger.info('outbox: %d commands queued by the previous run' %
+                        len(self.pending))
+        self._rewrite()
+
+    def reset(self):
+        """Starts an empty outbox, for new experiments."""
+        self.seq = 0
+        self.pending = []
+        self._rewrite()
+
+    def _rewrite(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'w')
+        self._write({'seq': self.seq})
+        for entry in self.pending:
+            self._write({'put': entry['seq'], 'time': entry['time'],
+                         'command': entry['command']})
+
+    def _write(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def connected(self):
+        if not self.online:
+            return False
+        return self.is_connected is None or self.is_connected()
+
+    def put(self, command):
+        """
+        Queues a command and sends what can be sent.
+
+        Returns:
+            int: The command's sequence number.
+        """
+        with self._lock:
+            self.seq += 1
+            entry = {'seq': self.seq, 'time': time.time(),
+                     'command': dict(command)}
+            absorbed = self._collapse(entry)
+            self.pending.append(entry)
+            self.queued += 1
+            self._write({'put': entry['seq'], 'time': entry['time'],
+                         'command': entry['command']})
+            for older in absorbed:
+                self._write({'dropped': older['seq']})
+            seq = entry['seq']
+            self.flush()
+        return seq
+
+    def _collapse(self, entry):
+        """Merges queued commands the new one supersedes into it."""
+        absorbed = []
+        for older in list(self.pending):
+            if _supersedes(entry['command'], older['command']):
+                self._absorb(entry, older)
+                self.pending.remove(older)
+                absorbed.append(older)
+        return absorbed
+
+    def _absorb(self, entry, older):
+        """Merges the fields of the queued entry older into entry."""
+        command = entry['command']
+        command['value'] = _merge(older['command']['value'], command['value'])
+        if is_bolus(command):
+            # a bolus ages from the oldest decision it carries
+            entry['time'] = min(entry['time'], older['time'])
+        self.collapsed += 1
+
+    def discard(self, param):
+        """Drops queued commands of a parameter (pumps on a stop)."""
+        with self._lock:
+            for entry in [e for e in self.pending
+                          if e['command']['param'] == param]:
+                self.pending.remove(entry)
+                self._write({'dropped': entry['seq']})
+                self.dropped += 1
+
+    def flush(self):
+        """Sends the queued commands in order while connected."""
+        with self._lock:
+            while self.pending and self.connected():
+                entry = self.pending[0]
+                command = entry['command']
+                once = is_bolus(command)
+                if once and time.time() - entry['time'] > self.bolus_max_age:
+                    logger.warning('outbox: dropping pump bolus #%d queued %.0f s '
+                                   'ago (logged in pump_log but not sent): %s' %
+                                   (entry['seq'], time.time() - entry['time'],
+                                    command['value']))
+                    self._done(entry, 'dropped')
+                    self.dropped += 1
+                    continue
+                if once:
+                    self._done(entry, 'sent')
+                try:
+                    self.send(command, entry['seq'])
+                except Exception as e:
+                    self.online = False
+                    if once:
+                        logger.error('outbox: pump bolus #%d may not have been '
+                                     'sent, not retrying it: %s' % (entry['seq'], e))
+                    else:
+                        logger.warning('outbox: could not send command #%d, '
+                                       'keeping it queued: %s' % (entry['seq'], e))
+                    return
+                if not once:
+                    self._done(entry, 'sent')
+                self.sent += 1
+                self._in_flight.append(entry)
+                if self._reconnected_at is not None and command.get('recurring', False):
+                    self._expected[command['param']] = [str(v) for v in command['value']]
+            if not self.pending:
+                self._rewrite()
+
+    def _done(self, entry, how):
+        self.pending.remove(entry)
+        self._write({how: entry['seq']})
+
+    def undelivered(self, seq, maybe_sent=False):
+        """
+        Queues a sent command again, for when whoever emits the commands
+        reports it could not.
+
+        Args:
+            seq (int): The command's sequence number.
+            maybe_sent (bool): True if emitting failed part way, so the
+                command may have reached the eVOLVER.
+        """
+        with self._lock:
+            self.online = False
+            entry = next((e for e in self._in_flight if e['seq'] == seq), None)
+            if entry is None:
+                logger.error('outbox: command #%d reported undelivered is no '
+                             'longer known, not retrying it' % seq)
+                return
+            self._in_flight.remove(entry)
+            self.sent -= 1
+            if maybe_sent and is_bolus(entry['command']):
+                logger.error('outbox: pump bolus #%d may not have been sent, '
+                             'not retrying it' % seq)
+                return
+            logger.warning('outbox: command #%d was not delivered, keeping it '
+                           'queued' % seq)
+            self.requeued += 1
+            newer = next((e for e in self.pending if e['seq'] > seq and
+                          _supersedes(e['command'], entry['command'])), None)
+            if newer is not None:
+                # queued after it and taking its place, as in put
+                self._absorb(newer, entry)
+                entry = newer
+            else:
+                # back in sequence order, ahead of what was queued after it
+                index = 0
+                while index < len(self.pending) and self.pending[index]['seq'] < seq:
+                    index += 1
+                self.pending.insert(index, entry)
+            self._write({'put': entry['seq'], 'time': entry['time'],
+                         'command': entry['command']})
+
+    def disconnected(self):
+        self.online = False
+
+    def reconnected(self):
+        """Replays the queued commands after a (re)connect."""
+        with self._lock:
+            self.online = True
+            self._reconnected_at = time.monotonic()
+            self._expected = {}
+            if self.pending:
+                logger.info('outbox: replaying %d queued commands (#%d-#%d)' %
+                            (len(self.pending), self.pending[0]['seq'],
+                             self.pending[-1]['seq']))
+            self.flush()
+
+    def confirm(self, config):
+        """
+        Checks a broadcast's config against the commands replayed since the
+        last reconnect and reports how long it took for the eVOLVER to get
+        to that state.
+        """
+        with self._lock:
+            if self._reconnected_at is None or self.pending:
+                return
+            for param, fields in self._expected.items():
+                current = [str(v) for v in config.get(param, {}).get('value', [])]
+                if len(current) != len(fields) or any(
+                        field != NO_CHANGE and field != value
+                        for field, value in zip(fields, current)):
+                    return
+            seconds = time.monotonic() - self._reconnected_at
+            self.consistency.add(seconds)
+            logger.info('outbox: consistent %.1f s after reconnecting' % seconds)
+            self._reconnected_at = None
+            self._expected = {}
+
+    def summary(self):
+        return ('outbox: queued=%d sent=%d collapsed=%d dropped=%d '
+                'requeued=%d pending=%d, %s mean %.1f s max %.1f s' % (
+                    self.queued, self.sent, self.collapsed, self.dropped,
+                    self.requeued, len(self.pending), self.consistency.name,
+                    self.consistency.mean, self.consistency.max))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,102 @@
+import queue
+import logging
+import threading
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('eVOLVER')
+
+class PersistenceWorker:
+    """
+    Runs disk writes on a dedicated thread fed by a bounded queue, so a slow
+    SD card does not delay the control code (and the pump commands) of a
+    broadcast.
+
+    When the queue is full, `submit` either waits for room (a stall) or, for
+    jobs that are superseded by the next broadcast anyway, drops the job.
+    Both are counted, together with the queue high-water mark.
+    """
+
+    def __init__(self, maxsize=64):
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='persistence')
+        self._thread.daemon = True
+        self.max_depth = 0
+        self.stalls = 0
+        self.drops = 0
+        self.errors = 0
+        self.job_latency = LatencyStats('persist')
+        self.stall_latency = LatencyStats('stall')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, func, *args, droppable=False):
+        """
+        Queues func(*args) for the writer thread.
+
+        Args:
+            func (callable): The write to run.
+            droppable (bool): True if the job may be dropped when the queue is
+                full (e.g. a state snapshot the next broadcast rewrites).
+        Returns:
+            bool: False if the job was dropped.
+        """
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            if droppable:
+                self.drops += 1
+                logger.warning('persistence queue full, dropping %s' %
+                               getattr(func, '__name__', func))
+                return False
+            self.stalls += 1
+            logger.warning('persistence queue full, waiting for the disk')
+            with self.stall_latency.time():
+                self._queue.put((func, args))
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def _run(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                with self.job_latency.time():
+                    func(*args)
+            except Exception as e:
+                self.errors += 1
+                logger.error('background write %s failed: %s' %
+                             (getattr(func, '__name__', func), e))
+            finally:
+                self._queue.task_done()
+
+    def drain(self, timeout=None):
+        """
+        Waits until every queued write has been done.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(
+                lambda: self._queue.unfinished_tasks == 0, timeout)
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {'depth': self.depth, 'max_depth': self.max_depth,
+                'stalls': self.stalls, 'drops': self.drops,
+                'errors': self.errors, 'jobs': self.job_latency.as_dict(),
+                'stall': self.stall_latency.as_dict()}
+
+    def summary(self):
+        return ('persistence queue depth=%d max=%d stalls=%d drops=%d '
+                'errors=%d | %s | %s' % (self.depth, self.max_depth,
+                                         self.stalls, self.drops, self.errors,
+                                         self.job_latency.summary(),
+                                         self.stall_latency.summary()))
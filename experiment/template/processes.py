@@ -0,0 +1,480 @@
+"""
+Multi-process mode of eVOLVER.py (--multiprocess).
+
+The work of a broadcast is split over three processes connected by
+multiprocessing queues, so a slow custom function or disk does not hold up
+the connection to the eVOLVER:
+
+- acquisition (the main process) owns the socket. It timestamps broadcasts
+  and passes them on, runs the asyncio runtime (socket heartbeats, commands
+  from the electron app) and emits the commands of the control process.
+  Stops are emitted here directly, without waiting for the control process.
+- control runs the EvolverNamespace experiment code (calibrations,
+  temperature, custom_script functions) on a QueueIO, which passes its
+  emits to the acquisition process. Broadcasts that queue up while it is
+  busy are all saved, control runs on the newest (as in runtime.py).
+- persistence runs the disk writes EvolverNamespace.persist hands off (data
+  files, stores, archives, SQLite, see PERSISTENCE_JOBS). State the control
+  code reads back (controller state, journal, event logs) stays with it.
+
+Every stage keeps a LatencyHistogram, logged every `stats_interval`.
+"""
+import time
+import queue
+import signal
+import logging
+import threading
+import traceback
+import multiprocessing
+
+from socketIO_client import BaseNamespace
+
+from metrics import LatencyHistogram
+from persistence import PersistenceWorker
+
+logger = logging.getLogger('eVOLVER')
+
+# EvolverNamespace.persist jobs run by the persistence process: method name
+# and whether it is a method of the namespace or of its SQLite store
+PERSISTENCE_JOBS = {'save_broadcast': 'namespace',
+                    'save_to_store': 'namespace',
+                    'save_raw': 'namespace',
+                    'archive_broadcast': 'namespace',
+                    'write_broadcast': 'db',
+                    'log_event': 'db'}
+# seconds the worker processes block on their queue between stats checks
+POLL_S = 1
+
+class ControlProcessError(Exception): pass
+
+class QueueIO:
+    """
+    Takes the place of the SocketIO object under the control process's
+    EvolverNamespace: emits go on the queue to the acquisition process and
+    `connected` mirrors the acquisition process's socket.
+    """
+
+    def __init__(self, outgoing, connected, url='multiprocess'):
+        self._queue = outgoing
+        self._connected = connected
+        # read by socketIO_client's namespaces for their log name
+        self._url = url
+
+    @property
+    def connected(self):
+        return self._connected is not None and bool(self._connected.value)
+
+    def emit(self, event, *args, seq=None, **kw):
+        """
+        Args:
+            seq (int): Outbox sequence number of a command, reported back
+                in an 'undelivered' message if it cannot be emitted.
+        """
+        self._queue.put(('emit', event, args, time.time(), seq))
+
+class ProcessPersistence:
+    """
+    EvolverNamespace.persistence of the control process: PERSISTENCE_JOBS
+    go to the persistence process, other jobs to a local PersistenceWorker.
+    Same submit/drain/summary interface as PersistenceWorker.
+    """
+
+    def __init__(self, jobs, done, maxsize=64):
+        self._jobs = jobs
+        self._done = done
+        self._token = 0
+        self.local = PersistenceWorker(maxsize).start()
+        self.stalls = 0
+        self.drops = 0
+
+    def submit(self, func, *args, droppable=False):
+        name = getattr(func, '__name__', None)
+        target = PERSISTENCE_JOBS.get(name)
+        if target is None:
+            return self.local.submit(func, *args, droppable=droppable)
+        job = ('job', target, name, args, time.time())
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            if droppable:
+                self.drops += 1
+                logger.warning('persistence process queue full, dropping %s' %
+                               name)
+                return False
+            self.stalls += 1
+            logger.warning('persistence process queue full, waiting for the '
+                           'disk')
+            self._jobs.put(job)
+        return True
+
+    def drain(self, timeout=None):
+        """
+        Waits until every queued write has been done and the persistence
+        process has synced its files.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.local.drain(timeout):
+            return False
+        self._token += 1
+        self._jobs.put(('drain', self._token))
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            try:
+                token = self._done.get(timeout=remaining)
+            except queue.Empty:
+                return False
+            # earlier tokens are replies to drains that timed out
+            if token == self._token:
+                return True
+
+    def summary(self):
+        return ('persistence process stalls=%d drops=%d | local %s' %
+                (self.stalls, self.drops, self.local.summary()))
+
+class StageReport:
+    """Logs a process's histograms every `interval` seconds."""
+
+    def __init__(self, interval, *histograms):
+        self.interval = interval
+        self.histograms = histograms
+        self._last = time.monotonic()
+
+    def maybe_report(self):
+        if not self.interval or time.monotonic() - self._last < self.interval:
+            return
+        for histogram in self.histograms:
+            logger.info(histogram.summary())
+            histogram.reset()
+        self._last = time.monotonic()
+
+def _ignore_interrupts():
+    # Ctrl-C reaches the whole process group; the acquisition process
+    # pauses or stops the experiment and tells the others
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _get_batch(inbox, timeout):
+    """Returns the messages queued in inbox, waiting for the first one."""
+    try:
+        messages = [inbox.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while True:
+        try:
+            messages.append(inbox.get_nowait())
+        except queue.Empty:
+            return messages
+
+def run_control(namespace_class, path, inbox, outgoing, connected, jobs, done,
+                init_args, persistence_queue_size, stats_interval):
+    """Control process: runs the experiment code on the broadcasts."""
+    _ignore_interrupts()
+    namespace = namespace_class(QueueIO(outgoing, connected), path)
+    namespace.persistence = ProcessPersistence(jobs, done,
+                                               persistence_queue_size)
+    try:
+        namespace.start_time = namespace.initialize_exp(*init_args)
+    except Exception as e:
+        traceback.print_exc()
+        outgoing.put(('error', 'could not initialize the experiment: %s' % e))
+        return
+    outgoing.put(('ready', namespace.start_time))
+
+    queued = LatencyHistogram('control: broadcast queue')
+    handling = LatencyHistogram('control: broadcast handling')
+    report = StageReport(stats_interval, queued, handling)
+    while True:
+        messages = _get_batch(inbox, POLL_S)
+        broadcasts = [i for i, message in enumerate(messages)
+                      if message[0] == 'broadcast']
+        if len(broadcasts) > 1:
+            logger.warning('control process is behind, coalescing %d queued '
+                           'broadcasts' % len(broadcasts))
+        for i, message in enumerate(messages):
+            kind = message[0]
+            try:
+                if kind == 'broadcast':
+                    _, data, received_time = message
+                    queued.add(time.time() - received_time)
+                    with handling.time():
+                        namespace.handle_broadcast(data, received_time,
+                                                   control=(i == broadcasts[-1]))
+                elif kind == 'calibrations':
+                    namespace.handle_calibrations(message[1])
+                elif kind == 'reconnected':
+                    namespace.replay_commands()
+                elif kind == 'disconnected':
+                    if namespace.outbox is not None:
+                        namespace.outbox.disconnected()
+                elif kind == 'undelivered':
+                    if namespace.outbox is not None:
+                        namespace.outbox.undelivered(*message[1:])
+                elif kind == 'stop':
+                    namespace.stop_exp()
+                elif kind == 'exit':
+                    if not namespace.persistence.drain(timeout=60):
+                        logger.error('persistence queue not drained after 60 s')
+                    return
+            except Exception as e:
+                logger.critical('control process: %s' % traceback.format_exc())
+                outgoing.put(('error', '%s: %s' % (type(e).__name__, e)))
+        report.maybe_report()
+
+def run_persistence(namespace_class, path, jobs, done, log_args, stats_interval,
+                    setup_logging):
+    """Persistence process: runs the writes handed off by the control one."""
+    _ignore_interrupts()
+    namespace = namespace_class(QueueIO(None, None), path)
+    waited = LatencyHistogram('persistence: queue')
+    work = LatencyHistogram('persistence: write')
+    report = StageReport(stats_interval, waited, work)
+    errors = 0
+    while True:
+        messages = _get_batch(jobs, POLL_S)
+        for message in messages:
+            kind = message[0]
+            if kind == 'start':
+                # the experiment directory exists from here on
+                setup_logging(*log_args)
+            elif kind == 'job':
+                _, target, name, args, submitted = message
+                waited.add(time.time() - submitted)
+                owner = namespace if target == 'namespace' else namespace.get_db()
+                try:
+                    with work.time():
+                        getattr(owner, name)(*args)
+                except Exception as e:
+                    errors += 1
+                    logger.error('background write %s failed (%d errors): %s' %
+                                 (name, errors, e))
+            elif kind == 'drain':
+                namespace.close_files()
+                done.put(message[1])
+            elif kind == 'exit':
+                namespace.close_files()
+                return
+        report.maybe_report()
+
+class Pipeline:
+    """The queues and the control and persistence processes."""
+
+    def __init__(self, namespace_class, path, init_args, log_args,
+                 setup_logging, persistence_queue_size=64, stats_interval=600):
+        """
+        Args:
+            namespace_class (type): EvolverNamespace.
+            path (str): The socket.io namespace path.
+            init_args (tuple): Arguments of EvolverNamespace.initialize_exp.
+            log_args (tuple): Arguments of setup_logging.
+            setup_logging (callable): Configures the log of a process.
+            persistence_queue_size (int): Max pending jobs of the
+                persistence process before the control process waits.
+            stats_interval (float): Seconds between stats reports.
+        """
+        # acquisition -> control
+        self.inbox = multiprocessing.Queue()
+        # control -> acquisition
+        self.outgoing = multiprocessing.Queue()
+        # control -> persistence, and drain replies back
+        self.jobs = multiprocessing.Queue(persistence_queue_size)
+        self.done = multiprocessing.Queue()
+        self.connected = multiprocessing.Value('b', 0)
+        self.namespace = None
+        self.forwarded = LatencyHistogram('acquisition: command forwarding')
+        self._early = []
+        self._forwarder = None
+        self.persistence = multiprocessing.Process(
+            target=run_persistence, name='evolver-persistence', daemon=True,
+            args=(namespace_class, path, self.jobs, self.done, log_args,
+                  stats_interval, setup_logging))
+        self.control = multiprocessing.Process(
+            target=run_control, name='evolver-control', daemon=True,
+            args=(namespace_class, path, self.inbox, self.outgoing,
+                  self.connected, self.jobs, self.done, init_args,
+                  persistence_queue_size, stats_interval))
+
+    def start(self):
+        """
+        Starts both processes and waits for the control process to
+        initialize the experiment.
+
+        Returns:
+            float: The experiment start time.
+        """
+        self.persistence.start()
+        self.control.start()
+        while True:
+            try:
+                message = self.outgoing.get(timeout=POLL_S)
+            except queue.Empty:
+                if not self.control.is_alive():
+                    raise ControlProcessError('control process exited during '
+                                              'initialization')
+                continue
+            if message[0] == 'ready':
+                self.jobs.put(('start',))
+                return message[1]
+            if message[0] == 'error':
+                raise ControlProcessError(message[1])
+            # commands of initialize_exp, sent once the socket is up
+            self._early.append(message)
+
+    def attach(self, namespace):
+        """Connects the acquisition namespace and starts passing commands."""
+        self.namespace = namespace
+        namespace.pipeline = self
+        namespace.set_connected(namespace._io.connected)
+        self._forwarder = threading.Thread(target=self._forward,
+                                           name='command-forwarder')
+        self._forwarder.daemon = True
+        self._forwarder.start()
+
+    def _forward(self):
+        early, self._early = self._early, []
+        for message in early:
+            self._handle(message)
+        while True:
+            message = self.outgoing.get()
+            if message[0] == 'exit':
+                return
+            self._handle(message)
+
+    def _handle(self, message):
+        if message[0] == 'emit':
+            _, event, args, sent, seq = message
+            self.namespace.forward(event, args, seq)
+            self.forwarded.add(time.time() - sent)
+        elif message[0] == 'error':
+            self.namespace.control_failed(message[1])
+
+    def put(self, *message):
+        self.inbox.put(message)
+
+    def report(self):
+        logger.info(self.forwarded.summary())
+        self.forwarded.reset()
+        for process in (self.control, self.persistence):
+            if not process.is_alive():
+                logger.error('%s process is not running (exit code %s)' %
+                             (process.name, process.exitcode))
+
+    def close(self, timeout=90):
+        """Stops the control process, then the persistence process."""
+        self.inbox.put(('exit',))
+        self.control.join(timeout)
+        self.jobs.put(('exit',))
+        self.persistence.join(timeout)
+        self.outgoing.put(('exit',))
+        for process in (self.control, self.persistence):
+            if process.is_alive():
+                logger.error('%s process did not stop, terminating it' %
+                             process.name)
+                process.terminate()
+
+class AcquisitionNamespace(BaseNamespace):
+    """
+    Socket namespace of the acquisition process: passes broadcasts and
+    calibrations to the control process and emits its commands.
+    """
+    pipeline = None
+    runtime = None
+    commands = None
+    outbox = None
+    connects = 0
+    reconnects = 0
+    disconnects = 0
+
+    def on_connect(self, *args):
+        print("Connected to eVOLVER as client")
+        self.connects += 1
+        logger.info('connected to eVOLVER (%d connects)' % self.connects)
+        self.set_connected(True)
+
+    def on_reconnect(self, *args):
+        print("Reconnected to eVOLVER as client")
+        self.reconnects += 1
+        logger.warning('reconnected to eVOLVER (%d reconnects)' % self.reconnects)
+        self.set_connected(True)
+
+    def on_disconnect(self, *args):
+        print("Disconected from eVOLVER as client")
+        self.disconnects += 1
+        logger.info('disconnected from eVOLVER (%d disconnects)' % self.disconnects)
+        self.set_connected(False)
+
+    def set_connected(self, connected):
+        """Tells the control process's outbox when the socket goes up or down."""
+        if self.pipeline is None or bool(self.pipeline.connected.value) == connected:
+            return
+        self.pipeline.connected.value = connected
+        self.pipeline.put('reconnected' if connected else 'disconnected')
+
+    def on_broadcast(self, data):
+        received_time = time.time()
+        if self.runtime is not None and self.runtime.paused:
+            # received by a wait still running when the run was paused
+            logger.debug('experiment paused, ignoring broadcast')
+            return
+        # a broadcast means the connection is back, even if the library
+        # reconnected without telling the namespace
+        self.set_connected(True)
+        self.pipeline.put('broadcast', data, received_time)
+
+    def on_activecalibrations(self, data):
+        self.pipeline.put('calibrations', data)
+
+    def forward(self, event, args, seq=None):
+        """
+        Emits a message of the control process. Outbox commands (seq not
+        None) that cannot be emitted are reported back as undelivered, so
+        the control process's outbox keeps them queued.
+        """
+        # emitting on a closed socket would reopen it (e.g. while paused)
+        if not self._io.connected:
+            logger.warning('not connected, could not emit %s %s from the '
+                           'control process' % (event, args))
+            self.undelivered(seq, False)
+            return
+        try:
+            self.emit(event, *args)
+        except Exception as e:
+            logger.warning('could not emit %s: %s' % (event, e))
+            self.undelivered(seq, True)
+
+    def undelivered(self, seq, maybe_sent):
+        # before 'disconnected', so the command is queued again before the
+        # next 'reconnected' replays the outbox
+        if seq is not None:
+            self.pipeline.put('undelivered', seq, maybe_sent)
+        self.set_connected(False)
+
+    def control_failed(self, message):
+        error = ControlProcessError(message)
+        # dispatched to a loop that is not running, it would be raised in
+        # the forwarder thread
+        if self.runtime is not None and not self.runtime.paused:
+            self.runtime.dispatch(_raise, error)
+        else:
+            logger.critical('control process: %s' % message)
+
+    def stop_all_pumps(self):
+        data = {'param': 'pump',
+                'value': ['0'] * 48,
+                'recurring': False,
+                'immediate': True}
+        logger.info('stopping all pumps')
+        self.emit('command', data, namespace = '/dpu-evolver')
+
+    def stop_exp(self):
+        # right away from here, then the control process stops its pumps
+        # and has the persistence process sync its files
+        self.stop_all_pumps()
+        if self.pipeline is not None:
+            self.pipeline.put('stop')
+
+def _raise(error):
+    raise error
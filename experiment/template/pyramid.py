@@ -0,0 +1,145 @@
+"""
+Multi-resolution summaries of the OD and temperature series.
+
+For each data file (e.g. OD/vial0_OD.txt) every level is a text file in
+<data dir>/pyramid/ (e.g. OD/pyramid/vial0_OD.10min.txt) with one line per
+closed bucket:
+
+    bucket_start,min,max,mean,count
+
+Buckets are kept in memory while open and appended when the first row of
+the next bucket arrives, so the file only ever holds complete buckets. The
+open bucket is rebuilt from the data file when the DPU restarts.
+"""
+import os
+import math
+import logging
+import numpy as np
+
+import time_index
+
+logger = logging.getLogger('eVOLVER')
+
+PYRAMID_DIR = 'pyramid'
+# (name, bucket width in hours)
+LEVELS = (('1min', 1 / 60.), ('10min', 10 / 60.), ('1h', 1.))
+
+def level_path(path, level):
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, PYRAMID_DIR, '{0}.{1}.txt'.format(
+        os.path.splitext(file_name)[0], level))
+
+def _bucket_of(elapsed_time, width):
+    return int(math.floor(elapsed_time / width))
+
+def _last_bucket(path, width):
+    """Index of the last bucket written to a level file, or None."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256))
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    for line in reversed(lines):
+        try:
+            return _bucket_of(float(line.split(b',', 1)[0]) + width / 2, width)
+        except ValueError:
+            continue
+    return None
+
+class _Level:
+    __slots__ = ('name', 'width', 'path', 'last', 'index', 'low', 'high',
+                 'total', 'count')
+
+    def __init__(self, name, width, path):
+        self.name = name
+        self.width = width
+        self.path = path
+        self.last = _last_bucket(path, width)
+        self.index = None
+
+    def add(self, elapsed_time, value):
+        index = _bucket_of(elapsed_time, self.width)
+        if self.last is not None and index <= self.last:
+            # bucket already on disk (rows replayed after a restart)
+            return
+        if index != self.index:
+            self.close()
+            self.index = index
+            self.low = math.inf
+            self.high = -math.inf
+            self.total = 0.
+            self.count = 0
+        if math.isnan(value):
+            return
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        self.total += value
+        self.count += 1
+
+    def close(self):
+        if self.index is None:
+            return
+        if self.count:
+            with open(self.path, 'a') as f:
+                f.write('{0},{1},{2},{3},{4}\n'.format(
+                    self.index * self.width, self.low, self.high,
+                    self.total / self.count, self.count))
+        self.last = self.index
+        self.index = None
+
+class PyramidWriter:
+    """
+    Maintains the levels of every data file it is fed, one row at a time.
+    """
+
+    def __init__(self, levels=LEVELS):
+        self.levels = levels
+        self._files = {}
+
+    def _open(self, path, elapsed_time):
+        os.makedirs(os.path.join(os.path.dirname(path), PYRAMID_DIR),
+                    exist_ok=True)
+        levels = [_Level(name, width, level_path(path, name))
+                  for name, width in self.levels]
+        self._files[path] = levels
+        # rebuild the open buckets from the rows already in the data file
+        widest = max(width for name, width in self.levels)
+        start = _bucket_of(elapsed_time, widest) * widest
+        rows = time_index.read_range(path, t0=start, t1=elapsed_time)
+        for row in rows:
+            if row[0] < elapsed_time:
+                for level in levels:
+                    level.add(float(row[0]), float(row[1]))
+        return levels
+
+    def add(self, path, elapsed_time, value):
+        """
+        Called before a row is appended to a data file.
+
+        Args:
+            path (str): The data file.
+            elapsed_time (float): Time of the row in hours.
+            value: The value of the row.
+        """
+        levels = self._files.get(path)
+        if levels is None:
+            levels = self._open(path, elapsed_time)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        for level in levels:
+            level.add(elapsed_time, value)
+
+def read_level(path, level):
+    """
+    Returns the closed buckets of a level as an (n, 5) array of
+    bucket_start, min, max, mean, count.
+    """
+    try:
+        data = np.genfromtxt(level_path(path, level), delimiter=',')
+    except (FileNotFoundError, OSError):
+        return np.empty((0, 5))
+    return data.reshape(-1, 5)
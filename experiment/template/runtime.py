@@ -0,0 +1,381 @@
+"""
+Event-driven main loop of eVOLVER.py.
+
+The eVOLVER socket, the command stream from the electron app (stdin) and
+timers are awaited together on one asyncio loop instead of polling each of
+them ten times a second:
+
+- socketIO.wait runs in a worker thread for SOCKET_WAIT_S at a time; the
+  namespace's callbacks hand their work to the loop with `dispatch`, and
+  broadcasts with `receive_broadcast`, so they are processed as tasks on
+  the loop thread. A wait cannot be interrupted, and connecting or
+  disconnecting (pause, stop, continue, Ctrl-C) runs on that thread after
+  it, so those commands take effect at most SOCKET_WAIT_S later.
+- Broadcasts are timestamped on receipt and queued. If processing falls
+  behind, the queue is coalesced: every queued broadcast is saved, but
+  temperature control and custom functions only run on the newest one.
+  Lag and coalesced counts are logged, which replaces the legacy loop's
+  hourly reconnect.
+- stdin is watched with loop.add_reader, or read by a
+  NonBlockingStreamReader thread that posts lines to the loop where the
+  stream cannot be watched (pipes on Windows, regular files).
+- `call_every` runs periodic work, e.g. the stats report.
+
+LoopStats counts loop wakeups and command latency for this runtime and for
+the legacy polling loop (eVOLVER.py --legacy-loop), so the two can be
+compared in the log.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import LatencyStats
+from nbstreamreader import NonBlockingStreamReader
+
+logger = logging.getLogger('eVOLVER')
+
+# seconds per socketIO.wait call in the worker thread, also the longest
+# pause/stop/continue wait before reaching the socket
+SOCKET_WAIT_S = 1
+# seconds between two stats reports in the log
+STATS_INTERVAL_S = 600
+# broadcast processing lag (s) that is logged as a warning
+LAG_WARNING_S = 30
+
+class LoopStats:
+    """Wakeups of the main loop and latency of commands and broadcasts."""
+
+    def __init__(self, name):
+        self.name = name
+        self.wakeups = 0
+        self.since = time.monotonic()
+        self.commands = LatencyStats('command latency')
+        # connect/disconnect waiting for the socket thread, <= socket_wait
+        self.socket_commands = LatencyStats('socket command latency')
+        self.lag = LatencyStats('broadcast lag')
+        self.handling = LatencyStats('broadcast handling')
+        self.coalesced = 0
+        self.max_backlog = 0
+
+    def wakeup(self):
+        self.wakeups += 1
+
+    def wakeups_per_minute(self):
+        minutes = (time.monotonic() - self.since) / 60.
+        return self.wakeups / minutes if minutes > 0 else 0.
+
+    def summary(self):
+        return ('%s: %.1f wakeups/min | %s | %s | %s | %s | coalesced=%d '
+                'max backlog=%d' % (
+                    self.name, self.wakeups_per_minute(), self.commands.summary(),
+                    self.socket_commands.summary(), self.lag.summary(), self.handling.summary(), self.coalesced,
+                    self.max_backlog))
+
+    def reset(self):
+        self.wakeups = 0
+        self.since = time.monotonic()
+        self.coalesced = 0
+        self.max_backlog = 0
+        for stats in (self.commands, self.socket_commands, self.lag,
+                      self.handling):
+            stats.reset()
+
+class AsyncRuntime:
+    """
+    Runs the experiment loop on asyncio until an error stops it.
+
+    Commands from the electron app ('stop-script', 'pause-script',
+    'continue-script') behave as in the legacy loop.
+    """
+
+    def __init__(self, socketIO, namespace, stream=None,
+                 socket_wait=SOCKET_WAIT_S, stats_interval=STATS_INTERVAL_S):
+        """
+        Args:
+            socketIO (SocketIO): The connection to the eVOLVER.
+            namespace (EvolverNamespace): Its namespace; gets `runtime` set.
+            stream (file): The command stream, sys.stdin by default.
+            socket_wait (float): Seconds per socketIO.wait call.
+            stats_interval (float): Seconds between stats reports, None to
+                disable them.
+        """
+        self.socketIO = socketIO
+        self.namespace = namespace
+        self.stream = stream if stream is not None else sys.stdin
+        self.socket_wait = socket_wait
+        self.stats_interval = stats_interval
+        self.stats = LoopStats('asyncio loop')
+        self.paused = False
+        self.loop = None
+        # one thread, so a wait left running by a previous run() finishes
+        # before the next one starts
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='socketio')
+        self._reader = None
+        self._buffer = b''
+        self._connected = None
+        self._failed = None
+        self._tasks = set()
+        self._timers = []
+        # (data, received time) of broadcasts not processed yet
+        self._broadcasts = deque()
+        self._draining = False
+
+    # called from the socketIO thread
+
+    def _running(self):
+        loop = self.loop
+        return loop is not None and not loop.is_closed() and loop.is_running()
+
+    def dispatch(self, func, *args):
+        """Runs func(*args) on the loop thread, as a task."""
+        if not self._running():
+            # between two runs (e.g. paused on Ctrl-C), run it here
+            func(*args)
+            return
+        self.loop.call_soon_threadsafe(self._start_task, self._run_handler(func, args))
+
+    def receive_broadcast(self, data, received_time):
+        """
+        Queues a broadcast for namespace.handle_broadcast.
+
+        Args:
+            data (dict): The broadcast.
+            received_time (float): time.time() when it arrived.
+        """
+        if self.paused:
+            # received by a wait still running when the run was paused
+            logger.debug('experiment paused, ignoring broadcast')
+            return
+        self._broadcasts.append((data, received_time))
+        if not self._running():
+            self._drain()
+            return
+        self.loop.call_soon_threadsafe(self._schedule_drain)
+
+    # loop thread
+
+    def _start_task(self, coroutine):
+        self.stats.wakeup()
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_handler(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            self._fail(e)
+
+    def _schedule_drain(self):
+        if not self._draining:
+            self._draining = True
+            self._start_task(self._drain_task())
+
+    async def _drain_task(self):
+        try:
+            self._drain()
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._draining = False
+
+    def _drain(self):
+        """
+        Processes the queued broadcasts: all are saved, only the newest
+        runs control.
+        """
+        batch = []
+        while self._broadcasts:
+            batch.append(self._broadcasts.popleft())
+        if not batch:
+            return
+        self.stats.max_backlog = max(self.stats.max_backlog, len(batch))
+        lag = time.time() - batch[0][1]
+        if len(batch) > 1:
+            self.stats.coalesced += len(batch) - 1
+            logger.warning('broadcast processing is %.1f s behind, coalescing '
+                           '%d queued broadcasts' % (lag, len(batch)))
+        elif lag > LAG_WARNING_S:
+            logger.warning('broadcast processing is %.1f s behind' % lag)
+        for i, (data, received_time) in enumerate(batch):
+            self.stats.lag.add(time.time() - received_time)
+            with self.stats.handling.time():
+                self.namespace.handle_broadcast(data, received_time,
+                                                control=(i == len(batch) - 1))
+
+    def _fail(self, error):
+        if self._failed is not None and not self._failed.done():
+            self._failed.set_exception(error)
+
+    def call_every(self, seconds, func, *args, socket_thread=False):
+        """
+        Runs func(*args) every `seconds`, on the loop or, for work on the
+        connection itself (e.g. reconnecting), between two socketIO.wait
+        calls on the socket thread.
+        """
+        self._timers.append((seconds, func, args, socket_thread))
+
+    async def _timer(self, seconds, func, args, socket_thread):
+        while True:
+            await asyncio.sleep(seconds)
+            self.stats.wakeup()
+            try:
+                if socket_thread:
+                    await self.loop.run_in_executor(self._executor, func, *args)
+                else:
+                    func(*args)
+            except Exception as e:
+                self._fail(e)
+                return
+
+    async def _socket(self):
+        try:
+            while True:
+                if self.paused:
+                    await self._connected.wait()
+                    continue
+                await self.loop.run_in_executor(self._executor,
+                                                self.socketIO.wait,
+                                                self.socket_wait)
+                self.stats.wakeup()
+        except Exception as e:
+            self._fail(e)
+
+    def _watch_stream(self):
+        try:
+            self.loop.add_reader(self.stream.fileno(), self._read_stream)
+            logger.debug('watching the command stream with add_reader')
+        except (AttributeError, ValueError, OSError, NotImplementedError):
+            # not selectable here, read it on a thread instead
+            if self._reader is None:
+                self._reader = NonBlockingStreamReader(self.stream,
+                                                       callback=self._post_line)
+            logger.debug('reading the command stream on a thread')
+
+    def _unwatch_stream(self):
+        try:
+            self.loop.remove_reader(self.stream.fileno())
+        except (AttributeError, ValueError, OSError, NotImplementedError):
+            pass
+
+    def _post_line(self, line, received):
+        # reader thread
+        loop = self.loop
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(self.command, line, received)
+
+    def _read_stream(self):
+        received = time.monotonic()
+        data = os.read(self.stream.fileno(), 4096)
+        if not data:
+            logger.warning('command stream closed')
+            self._unwatch_stream()
+            return
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            self.command(line.decode('utf-8', 'replace'), received)
+
+    def command(self, message, received=None):
+        """Handles a command line from the electron app."""
+        self.stats.wakeup()
+        if 'stop-script' in message:
+            logger.info('Stop message received - halting all pumps');
+            self.pause()
+            self.namespace.stop_exp()
+            self._on_socket_thread(self.socketIO.disconnect)
+        if 'pause-script' in message:
+            print('Pausing experiment', flush = True)
+            logger.info('Pausing experiment in dpu')
+            self.pause()
+            self.namespace.stop_exp()
+            self._on_socket_thread(self.socketIO.disconnect)
+        if 'continue-script' in message:
+            print('Restarting experiment', flush = True)
+            logger.info('Restarting experiment')
+            self._on_socket_thread(self.socketIO.connect, then=self.resume)
+        if received is not None:
+            self.stats.commands.add(time.monotonic() - received)
+
+    def _on_socket_thread(self, func, then=None):
+        """
+        Runs func (connect/disconnect) on the socket thread once the wait in
+        progress there has returned, within socket_wait seconds:
+        socketIO_client reopens a closed connection at the end of a wait,
+        so a disconnect from the loop thread would not last.
+        """
+        self._start_task(self._run_on_socket_thread(func, then))
+
+    async def _run_on_socket_thread(self, func, then):
+        submitted = time.monotonic()
+        try:
+            await self.loop.run_in_executor(self._executor, func)
+            self.stats.socket_commands.add(time.monotonic() - submitted)
+            if then is not None:
+                then()
+        except Exception as e:
+            self._fail(e)
+
+    def pause(self):
+        """Stops waiting on the socket and ignores broadcasts until resume."""
+        self.paused = True
+        if self._connected is not None:
+            self._connected.clear()
+
+    def settle(self):
+        """
+        Blocks until the wait left running on the socket thread returns
+        (at most socket_wait seconds), for connecting/disconnecting while
+        the loop is not running.
+        """
+        self._executor.submit(lambda: None).result()
+
+    def resume(self):
+        self.paused = False
+        if self._connected is not None:
+            self._connected.set()
+
+    def report(self):
+        logger.info('%s | connects=%d reconnects=%d disconnects=%d' % (
+            self.stats.summary(), getattr(self.namespace, 'connects', 0),
+            getattr(self.namespace, 'reconnects', 0),
+            getattr(self.namespace, 'disconnects', 0)))
+        if getattr(self.namespace, 'commands', None) is not None:
+            logger.info(self.namespace.commands.summary())
+        if getattr(self.namespace, 'outbox', None) is not None:
+            logger.info(self.namespace.outbox.summary())
+        self.stats.reset()
+
+    async def run(self):
+        """Runs until a broadcast handler or timer raises, then re-raises."""
+        self.loop = asyncio.get_running_loop()
+        self._failed = self.loop.create_future()
+        self._connected = asyncio.Event()
+        if not self.paused:
+            self._connected.set()
+        self.namespace.runtime = self
+        self._watch_stream()
+        tasks = [self.loop.create_task(self._socket())]
+        timers = list(self._timers)
+        if self.stats_interval:
+            timers.append((self.stats_interval, self.report, (), False))
+        for seconds, func, args, socket_thread in timers:
+            tasks.append(self.loop.create_task(
+                self._timer(seconds, func, args, socket_thread)))
+        try:
+            await self._failed
+        finally:
+            self._unwatch_stream()
+            # the namespace keeps its runtime: broadcasts the socket thread
+            # still receives are ignored until resume (e.g. after Ctrl-C)
+            self.pause()
+            for task in tasks + list(self._tasks):
+                task.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
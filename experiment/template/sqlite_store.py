@@ -0,0 +1,124 @@
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('eVOLVER')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    time REAL NOT NULL,
+    vial INTEGER NOT NULL,
+    param TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS measurements_vial_time ON measurements (vial, time);
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    vial INTEGER NOT NULL,
+    event_type TEXT NOT NULL,
+    value REAL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_vial_type ON events (vial, event_type, time);
+"""
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class SQLiteStore:
+    """
+    One WAL-mode SQLite database per experiment holding every broadcast
+    measurement (OD, temp, raw channels) and every logged event (pump_log,
+    ODset, step_log, light_log, growth rates). WAL lets the dashboard read
+    while the DPU writes, without ever seeing a half-written row.
+
+    Events keep the same fields as their text log line: `value` is the first
+    field after the time and `data` the comma separated remainder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def write_broadcast(self, elapsed_time, series, vials):
+        """
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            series (dict): Maps parameter name to a per-vial sequence of values.
+            vials (list): The vials to write.
+        """
+        rows = []
+        for param, data in series.items():
+            if len(data) == 0:
+                continue
+            for x in vials:
+                rows.append((elapsed_time, x, param, _to_float(data[x])))
+        with self._lock:
+            self._conn.executemany('INSERT INTO measurements VALUES (?, ?, ?, ?)',
+                                   rows)
+            self._conn.commit()
+
+    def log_event(self, vial, event_type, elapsed_time, values):
+        values = list(values)
+        value = _to_float(values[0]) if values else None
+        data = ','.join(str(v) for v in values)
+        with self._lock:
+            self._conn.execute('INSERT INTO events VALUES (?, ?, ?, ?, ?)',
+                               (elapsed_time, vial, event_type, value, data))
+            self._conn.commit()
+
+    def last_event(self, vial, event_type):
+        """
+        Returns the last (time, value, data) row for a vial and event type
+        (e.g. last_event(7, 'pump_log')), or None.
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT time, value, data FROM events '
+                'WHERE vial = ? AND event_type = ? ORDER BY time DESC LIMIT 1',
+                (vial, event_type)).fetchone()
+
+    def events(self, vial, event_type, t0=None, t1=None):
+        """Returns (time, value, data) rows with t0 < time <= t1."""
+        query = ('SELECT time, value, data FROM events '
+                 'WHERE vial = ? AND event_type = ?')
+        args = [vial, event_type]
+        if t0 is not None:
+            query += ' AND time > ?'
+            args.append(t0)
+        if t1 is not None:
+            query += ' AND time <= ?'
+            args.append(t1)
+        with self._lock:
+            return self._conn.execute(query + ' ORDER BY time', args).fetchall()
+
+    def measurements(self, vial, param, t0=None, t1=None):
+        """Returns (time, value) rows of a parameter with t0 <= time <= t1."""
+        query = 'SELECT time, value FROM measurements WHERE vial = ?'
+        args = [vial]
+        if t0 is not None:
+            query += ' AND time >= ?'
+            args.append(t0)
+        if t1 is not None:
+            query += ' AND time <= ?'
+            args.append(t1)
+        query += ' AND param = ? ORDER BY time'
+        args.append(param)
+        with self._lock:
+            return self._conn.execute(query, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_readonly(path):
+    """Opens an experiment database for concurrent reads (e.g. the dashboard)."""
+    return sqlite3.connect('file:{0}?mode=ro'.format(path), uri=True)
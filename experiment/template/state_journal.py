@@ -0,0 +1,194 @@
+import os
+import json
+import zlib
+import logging
+import threading
+import numpy as np
+
+from controller_state import RECENT_GROWTH_RATES, RECENT_PUMPS
+
+logger = logging.getLogger('eVOLVER')
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+def _encode(obj):
+    text = json.dumps(obj, sort_keys=True, default=_json_default)
+    return '{0:08x}\t{1}\n'.format(zlib.crc32(text.encode('utf-8')), text)
+
+def _decode(line):
+    """Returns the decoded object, or None if the line is torn or corrupt."""
+    if not line.endswith('\n'):
+        return None
+    try:
+        crc, text = line[:-1].split('\t', 1)
+        if int(crc, 16) != zlib.crc32(text.encode('utf-8')):
+            return None
+        return json.loads(text)
+    except ValueError:
+        return None
+
+# per-vial events of which the last N [time, values...] are kept, as
+# ControllerState needs them
+RECENT_RECORDS = {'pump_log': RECENT_PUMPS, 'gr': RECENT_GROWTH_RATES}
+
+def empty_state():
+    return {'seq': 0, 'variables': {}, 'vials': {}, 'complete': False}
+
+def apply_record(state, record):
+    """
+    Applies one journal record to the in-memory state.
+
+    'variables' records replace the experiment variables (start_time,
+    OD_initial); a 'start' record marks a journal kept since the experiment
+    started, so it holds every controller event (see `complete`). Every
+    other record type is a per-vial event (ODset, pump_log, step_log, gr,
+    light_log, <name>_config, ...) whose latest values and count are kept,
+    plus the recent ones for RECENT_RECORDS.
+    """
+    state['seq'] = record['seq']
+    if record['type'] == 'variables':
+        state['variables'].update(record['data'])
+        return
+    if record['type'] == 'start':
+        state['complete'] = True
+        return
+    vial_state = state['vials'].setdefault(str(record['vial']), {})
+    previous = vial_state.get(record['type'], {})
+    entry = {'time': record['time'],
+             'values': record['data'],
+             'count': previous.get('count', 0) + 1}
+    keep = RECENT_RECORDS.get(record['type'])
+    if keep:
+        recent = previous.get('recent', []) + [[record['time']] + list(record['data'])]
+        entry['recent'] = recent[-keep:]
+    vial_state[record['type']] = entry
+
+def complete(state):
+    """True if the state holds every controller event of the experiment."""
+    return state.get('complete', False)
+
+class StateJournal:
+    """
+    Append-only, checksummed journal of controller state changes with
+    periodic compacted snapshots.
+
+    Each record is one line, '<crc32>\\t<json>', flushed to the OS when
+    appended. Every `snapshot_every` records the full state is written to
+    the snapshot file (via a temporary file and os.replace) and the journal
+    is truncated. Recovery reads the snapshot and replays the journal in one
+    sequential pass, stopping at the first torn or corrupt line.
+    """
+
+    def __init__(self, journal_path, snapshot_path, snapshot_every=500):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.state = empty_state()
+        self._records_since_snapshot = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return (os.path.exists(self.journal_path) or
+                os.path.exists(self.snapshot_path))
+
+    def recover(self):
+        """
+        Restores the state from the snapshot and the journal.
+
+        Returns:
+            dict: The recovered state.
+        """
+        state = empty_state()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = _decode(f.read())
+            if snapshot is None:
+                logger.error('state snapshot %s is corrupt, replaying journal '
+                             'only' % self.snapshot_path)
+            else:
+                state = snapshot
+
+        replayed = 0
+        valid_bytes = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, newline='\n') as f:
+                for line in f:
+                    record = _decode(line)
+                    if record is None:
+                        logger.warning('journal %s: torn or corrupt record after '
+                                       '%d records, discarding the rest' %
+                                       (self.journal_path, replayed))
+                        break
+                    valid_bytes += len(line.encode('utf-8'))
+                    # records already folded into the snapshot are skipped
+                    if record['seq'] > state['seq']:
+                        apply_record(state, record)
+                        replayed += 1
+            with open(self.journal_path, 'r+') as f:
+                f.truncate(valid_bytes)
+        logger.info('recovered controller state (seq %d, %d journal records)' %
+                    (state['seq'], replayed))
+        self.state = state
+        self._records_since_snapshot = replayed
+        return state
+
+    def append(self, record_type, vial, elapsed_time, data):
+        """
+        Appends one state change and applies it to the in-memory state.
+
+        Args:
+            record_type (str): 'variables' or the event log name.
+            vial (int): The vial number, None for experiment-wide records.
+            elapsed_time (float): Experiment time in hours.
+            data: JSON-serializable values of the change.
+        """
+        with self._lock:
+            record = {'seq': self.state['seq'] + 1, 'type': record_type,
+                      'vial': vial, 'time': elapsed_time, 'data': data}
+            # round-trip so the in-memory state matches what recovery sees
+            line = _encode(record)
+            apply_record(self.state, json.loads(line.split('\t', 1)[1]))
+            if self._file is None:
+                self._file = open(self.journal_path, 'a')
+            self._file.write(line)
+            self._file.flush()
+            self._records_since_snapshot += 1
+            if self._records_since_snapshot >= self.snapshot_every:
+                self._snapshot()
+
+    def _snapshot(self):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(_encode(self.state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # the snapshot holds everything, start a new journal
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, 'w')
+        self._records_since_snapshot = 0
+        logger.debug('wrote state snapshot at seq %d' % self.state['seq'])
+
+    def snapshot(self):
+        with self._lock:
+            self._snapshot()
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
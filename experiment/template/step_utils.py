@@ -6,12 +6,15 @@ import logging
 import os.path
 import pandas as pd
 from scipy.stats import linregress
+import log_segments
+import time_index
 
 #### GENERAL HELPER FUNCTIONS ####
 def tail_to_np(path, window=10, BUFFER_SIZE=512):
     """
     Reads file from the end and returns a numpy array with the data of the last 'window' lines.
     Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
+    If the file has been rotated (see log_segments.py), missing lines are read from the newest segments.
     """
     try:
         f = open(path, 'rb')
@@ -48,6 +51,8 @@ def tail_to_np(path, window=10, BUFFER_SIZE=512):
 
     f.close()
     data = ''.join(reversed(data)).splitlines()[-window:]
+    if len(data) < window:
+        data = log_segments.previous_lines(path, window - len(data)) + data
 
     if len(data) < window:
         # Not enough data
@@ -96,6 +101,23 @@ def get_last_n_lines(var_name, vial, n_lines):
             print(f"Unable to read file using np.genfromtxt: {file_path}.\n\tError: {e}")
             return np.asarray([])
         
+def read_range(var_name, vial, t0=None, t1=None):
+    """
+    Retrieves the rows of a vial's file with t0 <= time <= t1, seeking with the time index sidecar.
+    Args:
+        var_name (str): The name of the variable.
+        vial (int): The vial number.
+        t0 (float): Start time in hours, None for the beginning.
+        t1 (float): End time in hours, None for the end.
+    Returns:
+        numpy.ndarray: The rows in the range.
+    """
+    file_name = f"vial{vial}_{var_name}.txt"
+    if var_name == "gr":
+        var_name = "growthrate"
+    file_path = os.path.join(EXP_NAME, f'{var_name}', file_name)
+    return time_index.read_range(file_path, t0, t1)
+
 def labeled_last_n_lines(var_name, vial, n_lines):
     """
     Gets the last n lines of a variable in a vial's data, then labels them with the header from the CSV file.
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import numpy as np
+
+import step_utils as su
+
+logger = logging.getLogger('eVOLVER')
+
+class TemperatureController:
+    """
+    Holds the temperature setpoints of every vial in memory and decides when
+    a temperature command has to be sent.
+
+    The setpoints start from the last line of each temp_config file; changes
+    made with `set` (and the end points of ramps) are appended through the
+    `on_setpoint` callback. A command is emitted only when the raw values
+    it would carry change. If the server config still disagrees after
+    `resend_after` seconds (e.g. the server restarted), the command is sent
+    once more.
+
+    Ramps move a vial linearly from its setpoint at scheduling time to a
+    target between two experiment times, e.g.
+    `eVOLVER.temperature.ramp(3, 42, elapsed_time, elapsed_time + 2)`.
+    They are reported through `on_ramp` so they survive a restart.
+    """
+
+    def __init__(self, exp_dir, vials, on_setpoint=None, on_ramp=None,
+                 resend_after=300):
+        """
+        Args:
+            exp_dir (str): The experiment data directory (EXP_DIR).
+            vials (list): The vials to control.
+            on_setpoint (callable): on_setpoint(vial, elapsed_time, temp)
+                persists a new setpoint.
+            on_ramp (callable): on_ramp(vial, elapsed_time, ramp) persists a
+                ramp [t_start, from_temp, t_end, to_temp], [] when it ends.
+            resend_after (float): Seconds to wait for the server config to
+                match before sending the same command again.
+        """
+        self.exp_dir = exp_dir
+        self.vials = list(vials)
+        self.on_setpoint = on_setpoint
+        self.on_ramp = on_ramp
+        self.resend_after = resend_after
+        self.setpoints = np.array([self._load(x) for x in self.vials])
+        self.ramps = {}
+        self.current = self.setpoints.copy()
+        self.last_raw = None
+        self.last_sent = 0
+        self.commands_sent = 0
+
+    def _load(self, vial):
+        file_name = "vial{0}_temp_config.txt".format(vial)
+        file_path = os.path.join(self.exp_dir, 'temp_config', file_name)
+        last = su.tail_to_np(file_path, 1)
+        if last.size < 2:
+            logger.warning('no temperature setpoint in %s' % file_path)
+            return np.nan
+        return float(last[0][1])
+
+    def set(self, vial, temp, elapsed_time):
+        """Sets a vial's setpoint right away, cancelling any ramp."""
+        if self.ramps.pop(vial, None) is not None and self.on_ramp:
+            self.on_ramp(vial, elapsed_time, [])
+        self.setpoints[self.vials.index(vial)] = temp
+        if self.on_setpoint:
+            self.on_setpoint(vial, elapsed_time, temp)
+
+    def ramp(self, vial, temp, t_start, t_end):
+        """
+        Schedules a linear ramp of a vial to temp between t_start and t_end
+        (experiment hours).
+        """
+        ramp = [t_start, float(self.setpoints[self.vials.index(vial)]), t_end, temp]
+        self.ramps[vial] = ramp
+        if self.on_ramp:
+            self.on_ramp(vial, t_start, ramp)
+        logger.info('vial %d: temperature ramp to %.2f C from %.2f h to %.2f h'
+                    % (vial, temp, t_start, t_end))
+
+    def restore(self, ramps):
+        """Restores ramps saved through on_ramp, {vial: ramp}."""
+        for vial, ramp in ramps.items():
+            if ramp:
+                self.ramps[int(vial)] = list(ramp)
+
+    def target(self, elapsed_time):
+        """Returns the setpoints at elapsed_time, finishing ramps that are over."""
+        temps = self.setpoints.copy()
+        self.current = temps
+        for vial, (t_start, from_temp, t_end, to_temp) in list(self.ramps.items()):
+            if elapsed_time >= t_end:
+                # the end point becomes the setpoint
+                self.set(vial, to_temp, elapsed_time)
+                temps[self.vials.index(vial)] = to_temp
+            elif elapsed_time > t_start:
+                fraction = (elapsed_time - t_start) / (t_end - t_start)
+                temps[self.vials.index(vial)] = from_temp + (to_temp - from_temp) * fraction
+        return temps
+
+    def update(self, elapsed_time, server_temps, to_raw):
+        """
+        Called on every broadcast.
+
+        Args:
+            elapsed_time (float): Experiment time in hours.
+            server_temps (numpy.ndarray): The server's setpoints, calibrated.
+            to_raw (callable): Converts temperatures to raw setpoints.
+        Returns:
+            list: The raw values to send, or None if no command is needed.
+        """
+        temps = self.target(elapsed_time)
+        if np.isnan(temps).any():
+            logger.error('missing temperature setpoints, not updating temperatures')
+            return None
+        raw = [str(int(value)) for value in to_raw(temps)]
+        matches = np.abs(np.asarray(server_temps) - temps).max() <= 0.2
+        if raw == self.last_raw:
+            if matches or time.time() - self.last_sent < self.resend_after:
+                return None
+            logger.warning('server temperature config still differs, sending '
+                           'the temperature command again')
+        elif self.last_raw is None and matches:
+            # the server already has these setpoints (e.g. after a restart)
+            self.last_raw = raw
+            return None
+        else:
+            logger.info('updating temperatures to %s' % np.round(temps, 2).tolist())
+        self.last_raw = raw
+        self.last_sent = time.time()
+        self.commands_sent += 1
+        return raw
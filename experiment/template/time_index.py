@@ -0,0 +1,150 @@
+"""
+Sparse time index sidecars for the per-vial text logs.
+
+Next to each indexed file (e.g. OD/vial0_OD.txt) a sidecar
+(OD/vial0_OD.txt.idx) holds one 'time,byte_offset' checkpoint every
+`stride` rows. A range read seeks to the last checkpoint at or before t0
+instead of parsing the file from the top. The text files themselves are
+unchanged, so the GUI keeps reading them as before.
+"""
+import os
+import bisect
+import logging
+import numpy as np
+
+import log_segments
+
+logger = logging.getLogger('eVOLVER')
+
+INDEX_SUFFIX = '.idx'
+DEFAULT_STRIDE = 64
+
+def _line_time(line):
+    try:
+        return float(line.split(',', 1)[0])
+    except ValueError:
+        return None
+
+class TimeIndexWriter:
+    """
+    Tracks the rows appended to each file and writes a checkpoint to its
+    sidecar every `stride` rows.
+    """
+
+    def __init__(self, stride=DEFAULT_STRIDE):
+        self.stride = stride
+        self._rows = {}
+
+    def record(self, path, elapsed_time, offset):
+        """
+        Called before a row is appended.
+
+        Args:
+            path (str): The data file.
+            elapsed_time (float): Time of the row about to be appended.
+            offset (int): Byte offset the row will start at.
+        """
+        rows = self._rows.get(path)
+        # a file seen for the first time gets a checkpoint right away
+        if rows is None or rows >= self.stride:
+            with open(path + INDEX_SUFFIX, 'a') as f:
+                f.write('{0},{1}\n'.format(elapsed_time, offset))
+            rows = 0
+        self._rows[path] = rows + 1
+
+    def reset(self, path):
+        """Drops the sidecar of a file that was emptied (e.g. rotated)."""
+        self._rows.pop(path, None)
+        try:
+            os.remove(path + INDEX_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+def load_index(path):
+    """Returns the (times, offsets) checkpoints of a file's sidecar."""
+    times = []
+    offsets = []
+    try:
+        with open(path + INDEX_SUFFIX) as f:
+            for line in f:
+                try:
+                    t, offset = line.split(',')
+                    times.append(float(t))
+                    offsets.append(int(offset))
+                except ValueError:
+                    # torn last line
+                    continue
+    except FileNotFoundError:
+        pass
+    return times, offsets
+
+def _seek_offset(path, t0):
+    """Byte offset of the last checkpoint at or before t0 (0 if none)."""
+    if t0 is None:
+        return 0, None
+    times, offsets = load_index(path)
+    i = bisect.bisect_right(times, t0) - 1
+    if i < 0:
+        return 0, None
+    return offsets[i], times[i]
+
+def _active_range_lines(path, t0, t1, after=None):
+    offset, checkpoint_time = _seek_offset(path, t0)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return []
+    with f:
+        f.seek(offset)
+        first = f.readline()
+        # stale sidecar (file rewritten): fall back to a full scan
+        if offset and (not first or _line_time(first.decode('utf-8')) != checkpoint_time):
+            logger.debug('time index of %s is stale, scanning file' % path)
+            f.seek(0)
+            first = f.readline()
+        lines = []
+        line = first
+        while line:
+            text = line.decode('utf-8')
+            t = _line_time(text)
+            if t is not None:
+                if t1 is not None and t > t1:
+                    break
+                if (t0 is None or t >= t0) and (after is None or t > after):
+                    lines.append(text)
+            line = f.readline()
+    return lines
+
+def read_range_lines(path, t0=None, t1=None):
+    """
+    Returns the lines of a data file with t0 <= time <= t1, reading rotated
+    segments only when the range reaches back into them.
+    """
+    lines = []
+    entries = log_segments.segments(path)
+    for entry in entries:
+        if (t0 is not None and entry['t1'] < t0) or \
+                (t1 is not None and entry['t0'] > t1):
+            continue
+        for line in log_segments._read_segment(path, entry):
+            t = _line_time(line)
+            if t is not None and (t0 is None or t >= t0) and \
+                    (t1 is None or t <= t1):
+                lines.append(line)
+    after = entries[-1]['t1'] if entries else None
+    if t1 is None or after is None or t1 > after:
+        lines.extend(_active_range_lines(path, t0, t1, after))
+    return lines
+
+def read_range(path, t0=None, t1=None):
+    """
+    Returns rows with t0 <= time <= t1 as a 2D numpy array (float when
+    possible, like step_utils.tail_to_np).
+    """
+    rows = [line.rstrip('\n').split(',') for line in read_range_lines(path, t0, t1)]
+    if not rows:
+        return np.asarray([])
+    try:
+        return np.asarray(rows, dtype=np.float64)
+    except ValueError:
+        return np.asarray(rows, dtype=object)
@@ -0,0 +1,148 @@
+"""
+Turbidostat decisions for all vials in one NumPy pass.
+
+`turbidostat_step` evaluates, for every vial at once, what the per-vial loop
+of custom_script.turbidostat used to: the end (upper threshold crossed) and
+start (lower third reached) of growth curves, the OD setpoint toggling,
+the dilution time -(log(lower/OD)*VOLUME)/flow_rate with its 20 s clamp and
+the pump_wait gate. It returns the fluidic MESSAGE and the events the
+caller has to log, in the order the loop produced them.
+
+tests/test_turbidostat_kernel.py checks it against the loop (`_loop_step`);
+run `python3 turbidostat_kernel.py` to time both for 16, 32 and 64 vials.
+"""
+import timeit
+import numpy as np
+
+# event kinds, in the order they happen for one vial
+ODSET_LOWER = 'ODset_lower'  # value: new ODset (the lower threshold)
+GROWTH_CURVE = 'growth_curve'  # value: start time of the finished curve
+ODSET_UPPER = 'ODset_upper'  # value: new ODset (the upper threshold)
+DILUTION = 'dilution'  # value: influx time_in (s)
+NAN_DILUTION = 'nan_dilution'  # value: None, time_in was NaN
+
+MAX_TIME_IN = 20
+
+def turbidostat_step(elapsed_time, average_od, ODset, ODset_time, num_curves,
+                     last_pump, lower_thresh, upper_thresh, flow_rate,
+                     stop_after_n_curves, volume, pump_wait, time_out):
+    """
+    Args:
+        elapsed_time (float): Experiment time in hours.
+        average_od (array): Median recent OD per vial, NaN for vials that
+            are not controlled or have too little data.
+        ODset, ODset_time, num_curves, last_pump (array): Controller state
+            per vial (see controller_state.VialState).
+        lower_thresh, upper_thresh (array): OD thresholds per vial.
+        flow_rate (array): Influx pump flow rates per vial.
+        stop_after_n_curves (float): Stop diluting after this many curves.
+        volume (float): Culture volume (mL).
+        pump_wait (float): Minutes to wait between pump events.
+        time_out (float): Seconds the efflux pump runs longer than influx.
+    Returns:
+        tuple: (MESSAGE, events). MESSAGE has 3 fields per vial ('--' for
+        no change); events is a list of (vial, kind, value) tuples.
+    """
+    od = np.asarray(average_od, dtype=np.float64)
+    n = len(od)
+    ODset = np.asarray(ODset, dtype=np.float64)
+    lower = np.asarray(lower_thresh, dtype=np.float64)[:n]
+    upper = np.asarray(upper_thresh, dtype=np.float64)[:n]
+    collecting = np.asarray(num_curves) <= (stop_after_n_curves + 2)
+
+    # end of a growth curve: back to the lower threshold
+    to_lower = (od > upper) & (ODset != lower)
+    ODset = np.where(to_lower, lower, ODset)
+    # start of a growth curve: grow up to the upper threshold
+    to_upper = (od < (lower + (upper - lower) / 3)) & (ODset != upper)
+    ODset = np.where(to_upper, upper, ODset)
+
+    dilute = (od > ODset) & collecting
+    with np.errstate(divide='ignore', invalid='ignore'):
+        time_in = - (np.log(lower / od) * volume) / np.asarray(flow_rate, dtype=np.float64)[:n]
+    clamped = time_in > MAX_TIME_IN
+    time_in = np.round(np.where(clamped, MAX_TIME_IN, time_in), 2)
+    dilute &= ((elapsed_time - np.asarray(last_pump, dtype=np.float64)) * 60) >= pump_wait
+    pumped = dilute & ~np.isnan(time_in)
+
+    # the clamp is an int, sent and logged as '20' like the loop did
+    time_in = time_in.astype(object)
+    time_in[clamped] = MAX_TIME_IN
+    message = ['--'] * (3 * n)
+    for x in np.flatnonzero(pumped):
+        message[x] = str(time_in[x])
+        message[x + n] = str(time_in[x] + time_out)
+
+    events = []
+    # only vials with something to log, in the loop's order
+    for x in np.flatnonzero(to_lower | to_upper | dilute):
+        x = int(x)
+        if to_lower[x]:
+            events.append((x, ODSET_LOWER, lower[x]))
+            events.append((x, GROWTH_CURVE, ODset_time[x]))
+        if to_upper[x]:
+            events.append((x, ODSET_UPPER, upper[x]))
+        if pumped[x]:
+            events.append((x, DILUTION, time_in[x]))
+        elif dilute[x]:
+            events.append((x, NAN_DILUTION, None))
+    return message, events
+
+def _loop_step(elapsed_time, average_od, ODset, ODset_time, num_curves,
+               last_pump, lower_thresh, upper_thresh, flow_rate,
+               stop_after_n_curves, volume, pump_wait, time_out):
+    """The per-vial loop turbidostat_step replaces, for tests and timing."""
+    n = len(average_od)
+    MESSAGE = ['--'] * (3 * n)
+    events = []
+    for x in range(n):
+        if np.isnan(average_od[x]):
+            continue
+        average_OD = float(average_od[x])
+        vial_ODset = ODset[x]
+        collecting_more_curves = (num_curves[x] <= (stop_after_n_curves + 2))
+        if (average_OD > upper_thresh[x]) and (vial_ODset != lower_thresh[x]):
+            events.append((x, ODSET_LOWER, lower_thresh[x]))
+            vial_ODset = lower_thresh[x]
+            events.append((x, GROWTH_CURVE, ODset_time[x]))
+        if (average_OD < (lower_thresh[x] + (upper_thresh[x] - lower_thresh[x]) / 3)) and (vial_ODset != upper_thresh[x]):
+            events.append((x, ODSET_UPPER, upper_thresh[x]))
+            vial_ODset = upper_thresh[x]
+        if average_OD > vial_ODset and collecting_more_curves:
+            time_in = - (np.log(lower_thresh[x]/average_OD)*volume)/flow_rate[x]
+            if time_in > 20:
+                time_in = 20
+            time_in = round(time_in, 2)
+            if (((elapsed_time - last_pump[x])*60) >= pump_wait):
+                if not np.isnan(time_in):
+                    MESSAGE[x] = str(time_in)
+                    MESSAGE[x + n] = str(time_in + time_out)
+                    events.append((x, DILUTION, time_in))
+                else:
+                    events.append((x, NAN_DILUTION, None))
+    return MESSAGE, events
+
+def _random_inputs(rng, n_vials):
+    lower = rng.choice([0.2, 0.3, 9999], n_vials)
+    upper = np.where(lower == 9999, 9999, lower + rng.choice([0.2, 0.4], n_vials))
+    od = rng.uniform(0, 1, n_vials)
+    od[rng.random(n_vials) < 0.1] = np.nan
+    ODset = np.where(rng.random(n_vials) < 0.5, lower, upper)
+    flow = rng.uniform(0.8, 1.2, n_vials)
+    flow[rng.random(n_vials) < 0.05] = np.nan
+    return dict(elapsed_time=10., average_od=od, ODset=ODset,
+                ODset_time=rng.uniform(0, 10, n_vials),
+                num_curves=rng.integers(0, 10, n_vials).astype(float),
+                last_pump=rng.uniform(9, 10, n_vials), lower_thresh=lower,
+                upper_thresh=upper, flow_rate=flow,
+                stop_after_n_curves=rng.choice([np.inf, 5]), volume=25,
+                pump_wait=20, time_out=5)
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for n_vials in (16, 32, 64):
+        inputs = _random_inputs(rng, n_vials)
+        for name, func in (('loop', _loop_step), ('kernel', turbidostat_step)):
+            runs, total = timeit.Timer(lambda: func(**inputs)).autorange()
+            print('%2d vials, %-6s: %7.1f us per broadcast' %
+                  (n_vials, name, total / runs * 1e6))
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+from cloudevolution.segments import read_lines
+
+# Reads the min/max/mean summaries written by the DPU
+# (experiment/template/pyramid.py): <data dir>/pyramid/vial{x}_{param}.<level>.txt
+# with one 'bucket_start,min,max,mean,count' line per closed bucket
+
+# (name, bucket width in hours), finest first
+LEVELS = (('1min', 1 / 60.), ('10min', 10 / 60.), ('1h', 1.))
+# experiments shorter than this are plotted from the data file itself
+RAW_SPAN_HOURS = 6
+
+def level_path(path, level):
+	directory, file_name = os.path.split(path)
+	return os.path.join(directory, 'pyramid', '{0}.{1}.txt'.format(
+		os.path.splitext(file_name)[0], level))
+
+def has_pyramid(path):
+	return os.path.exists(level_path(path, LEVELS[-1][0]))
+
+def _read_level(path, level):
+	if not os.path.exists(level_path(path, level)):
+		return np.empty((0, 5))
+	return np.genfromtxt(level_path(path, level), delimiter=',').reshape(-1, 5)
+
+def _raw_rows(path, t0=None):
+	data = np.genfromtxt(read_lines(path, t0), delimiter=',')
+	data = data.reshape(-1, 2) if data.size else np.empty((0, 2))
+	if t0 is not None:
+		data = data[data[:, 0] >= t0]
+	return data
+
+def load(path, max_points=2000):
+	"""
+	Returns (time, mean, low, high) arrays of a data file at the finest
+	level that fits in max_points. Rows newer than the last closed bucket
+	are appended from the data file, so the plot is always up to date.
+	"""
+	coarse_name, coarse_width = LEVELS[-1]
+	coarse = _read_level(path, coarse_name)
+	span = len(coarse) * coarse_width
+	if span < RAW_SPAN_HOURS:
+		raw = _raw_rows(path)
+		return raw[:, 0], raw[:, 1], raw[:, 1], raw[:, 1]
+
+	for name, width in LEVELS:
+		if span / width <= max_points:
+			break
+	buckets = coarse if name == coarse_name else _read_level(path, name)
+	t_end = buckets[-1, 0] + width
+	tail = _raw_rows(path, t_end)
+	time = np.concatenate((buckets[:, 0] + width / 2, tail[:, 0]))
+	mean = np.concatenate((buckets[:, 3], tail[:, 1]))
+	low = np.concatenate((buckets[:, 1], tail[:, 1]))
+	high = np.concatenate((buckets[:, 2], tail[:, 1]))
+	return time, mean, low, high
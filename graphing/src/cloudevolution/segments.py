@@ -0,0 +1,41 @@
+import os
+import gzip
+import json
+
+# Reads data files rotated by the DPU (experiment/template/log_segments.py):
+# older segments are gzip files listed in <data dir>/manifest.json
+
+def _line_time(line):
+	try:
+		return float(line.split(',', 1)[0])
+	except ValueError:
+		return None
+
+def read_lines(path, t0=None):
+	"""
+	Yields every line of a data file across its compressed segments and the
+	active file. Segments that end before t0 are skipped.
+	"""
+	directory, file_name = os.path.split(path)
+	manifest_path = os.path.join(directory, 'manifest.json')
+	entries = []
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as f:
+			entries = json.load(f).get(file_name, [])
+
+	for entry in entries:
+		if t0 is not None and entry['t1'] < t0:
+			continue
+		with gzip.open(os.path.join(directory, entry['file']), 'rt') as f:
+			for line in f:
+				yield line
+
+	last_time = entries[-1]['t1'] if entries else None
+	with open(path) as f:
+		for line in f:
+			# rows already in the last segment (interrupted rotation)
+			if last_time is not None:
+				line_time = _line_time(line)
+				if line_time is not None and line_time <= last_time:
+					continue
+			yield line
@@ -8,6 +8,27 @@ import itertools
 import os
 import time
 import math
+from cloudevolution.segments import read_lines
+from cloudevolution import pyramid
+
+def load_series(path, step):
+	# min/max/mean summaries when the DPU writes them; experiments from before
+	# they existed fall back to plotting every step-th row
+	if pyramid.has_pyramid(path):
+		return pyramid.load(path)
+	data = np.genfromtxt(itertools.islice(read_lines(path), 0, None, step), delimiter=',')
+	if len(data) < 1000:
+		data = np.genfromtxt(read_lines(path), delimiter=',')
+	return data[:,0], data[:,1], data[:,1], data[:,1]
+
+
+def plot_series(p, series):
+	t, mean, low, high = series
+	# bucket extremes keep short spikes visible at every zoom level
+	p.line(t, high, line_width=1, line_alpha=0.3)
+	p.line(t, low, line_width=1, line_alpha=0.3)
+	p.line(t, mean, line_width=1)
+
 
 # Create your views here.
 def home(request):
@@ -45,10 +66,7 @@ def vial_num(request, experiment, vial):
 	OD PLOT
 	"""
 
-	with open(OD_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 5), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(OD_dir, delimiter=',')
+	data = load_series(OD_dir, 5)
 
 	last_OD_update = time.ctime(os.path.getmtime(OD_dir))
 
@@ -56,7 +74,7 @@ def vial_num(request, experiment, vial):
 	p.y_range = Range1d(-.05, 2)
 	p.xaxis.axis_label = 'Hours'
 	p.yaxis.axis_label = 'Optical Density'
-	p.line(data[:,0], data[:,1], line_width=1)
+	plot_series(p, data)
 	OD_script, OD_div = components(p)
 	od_x_range = p.x_range  # Save plot size for later
 
@@ -106,10 +124,7 @@ def vial_num(request, experiment, vial):
 	TEMPERATURE PLOT
 	"""
 
-	with open(temp_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 10), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(temp_dir, delimiter=',')
+	data = load_series(temp_dir, 10)
 
 	last_temp_update = time.ctime(os.path.getmtime(temp_dir))
 
@@ -118,7 +133,7 @@ def vial_num(request, experiment, vial):
 	p.x_range = od_x_range  # Set same size as the OD plot
 	p.xaxis.axis_label = 'Hours'
 	p.yaxis.axis_label = 'Temp (C)'
-	p.line(data[:,0], data[:,1], line_width=1)
+	plot_series(p, data)
 	temp_script, temp_div = components(p)
 
 	context = {
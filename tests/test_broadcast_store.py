@@ -0,0 +1,33 @@
+import numpy as np
+
+from broadcast_store import BroadcastStore, RawArchive, RecordFile
+from broadcast_store import broadcast_dtype, RAW_MAX
+
+RAW = {'od_135': [RAW_MAX, 'NaN', 1200, -5]}
+
+def test_saturated_reading_is_not_missing(tmp_path):
+    store = BroadcastStore(str(tmp_path / 'broadcasts.bin'), ['od_135'], n_vials=4)
+    store.append_broadcast(0.5, [0.1] * 4, [30] * 4, RAW)
+    values = [store.series('od_135_raw', x)[0, 1] for x in range(4)]
+    assert values[0] == RAW_MAX and values[2] == 1200
+    assert np.isnan(values[1]) and np.isnan(values[3])
+    store.close()
+
+def test_raw_archive_load_masks_missing_readings(tmp_path):
+    archive = RawArchive(str(tmp_path / 'raw.bin'), ['od_135'], n_vials=4)
+    archive.append_raw(0.5, RAW)
+    times, values = archive.load('od_135')
+    assert times.tolist() == [0.5]
+    assert values.mask.tolist() == [[False, True, False, True]]
+    assert values[0, 0] == RAW_MAX
+    archive.close()
+
+def test_store_from_before_the_bitmap_keeps_its_layout(tmp_path):
+    path = str(tmp_path / 'broadcasts.bin')
+    RecordFile(path, broadcast_dtype(['od_135'], 4, missing_bitmap=False)).close()
+    store = BroadcastStore(path, ['od_135'], n_vials=4)
+    store.append_broadcast(0.5, [0.1] * 4, [30] * 4, RAW)
+    assert 'od_135_missing' not in store.dtype.names
+    values = store.series('od_135_raw', 1)
+    assert np.isnan(values[0, 1])
+    store.close()
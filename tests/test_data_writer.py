@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import log_segments
+from data_writer import DataWriter
+
+def _write(writer, times):
+    for t in times:
+        writer.write_broadcast(t, {'OD': [t]}, [0])
+    writer.close()
+
+@pytest.mark.parametrize('pooled', [True, False])
+def test_rotates_into_segments(tmp_path, pooled):
+    os.makedirs(tmp_path / 'OD')
+    _write(DataWriter(str(tmp_path), pooled=pooled, segment_hours=1),
+           [0.5, 0.9, 1.1, 2.5])
+    path = str(tmp_path / 'OD' / 'vial0_OD.txt')
+    assert [(e['t0'], e['t1']) for e in log_segments.segments(path)] == \
+        [(0.5, 0.9), (1.1, 1.1)]
+    assert [float(l.split(',')[0]) for l in log_segments.read_lines(path)] == \
+        [0.5, 0.9, 1.1, 2.5]
+
+def test_restart_continues_the_segment_of_the_first_row(tmp_path):
+    os.makedirs(tmp_path / 'OD')
+    _write(DataWriter(str(tmp_path), segment_hours=1), [0.5])
+    # restarted in a later segment: the rows of segment 0 are rotated on
+    # their own, not kept with those of segment 3
+    _write(DataWriter(str(tmp_path), segment_hours=1), [3.2, 3.4])
+    path = str(tmp_path / 'OD' / 'vial0_OD.txt')
+    entries = log_segments.segments(path)
+    assert [(e['file'], e['t1']) for e in entries] == \
+        [(os.path.join('segments', 'vial0_OD.0000.txt.gz'), 0.5)]
+    assert log_segments.first_time(path) == 3.2
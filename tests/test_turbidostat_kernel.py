@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from turbidostat_kernel import turbidostat_step, DILUTION
+from turbidostat_kernel import _loop_step, _random_inputs
+
+def _same_events(a, b):
+    if len(a) != len(b):
+        return False
+    for (x1, k1, v1), (x2, k2, v2) in zip(a, b):
+        if x1 != x2 or k1 != k2:
+            return False
+        if v1 is not None and not (str(v1) == str(v2) or (np.isnan(v1) and np.isnan(v2))):
+            return False
+    return True
+
+@pytest.mark.parametrize('n_vials', [16, 32, 64])
+def test_matches_loop_on_random_broadcasts(n_vials):
+    rng = np.random.default_rng(n_vials)
+    for trial in range(500):
+        inputs = _random_inputs(rng, n_vials)
+        expected = _loop_step(**inputs)
+        result = turbidostat_step(**inputs)
+        assert result[0] == expected[0], trial
+        assert _same_events(result[1], expected[1]), (trial, result[1], expected[1])
+
+def test_dilution_is_clamped_and_gated_by_pump_wait():
+    inputs = dict(elapsed_time=10., average_od=np.array([0.9, 0.9]),
+                  ODset=np.array([0.2, 0.2]), ODset_time=np.array([1., 1.]),
+                  num_curves=np.zeros(2), last_pump=np.array([9., 9.9]),
+                  lower_thresh=np.array([0.2, 0.2]),
+                  upper_thresh=np.array([0.4, 0.4]), flow_rate=np.ones(2),
+                  stop_after_n_curves=np.inf, volume=25, pump_wait=20,
+                  time_out=5)
+    message, events = turbidostat_step(**inputs)
+    # vial 0 pumped an hour ago, vial 1 six minutes ago (< pump_wait)
+    assert message[:2] == ['20', '--']
+    assert message[2:4] == ['25', '--']
+    assert (0, DILUTION, 20) in events
+    assert _same_events(events, _loop_step(**inputs)[1])